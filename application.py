@@ -1,20 +1,203 @@
 # Importação
-from flask import Flask, request, jsonify
+import base64
+import bisect
+import click
+import codecs
+import gzip
+import hashlib
+import hmac
+import io
+import json
+import math
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import weakref
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from flask import Blueprint, Flask, current_app, request, session, jsonify, Response, g, has_request_context, stream_with_context
 from flask_sqlalchemy import SQLAlchemy # uma classe
+from flask_sqlalchemy.session import Session
+from sqlalchemy import DDL, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from flask_cors import CORS
 from flask_login import UserMixin, login_user, LoginManager, login_required, logout_user, current_user
-from flasgger import Swagger
+from itsdangerous import BadData, URLSafeTimedSerializer
+try:
+  import orjson # opcional: serializa JSON bem mais rapido que o modulo json
+except ImportError:
+  orjson = None
+try:
+  import brotli # opcional: Content-Encoding br, menor que o gzip no mesmo tempo
+except ImportError:
+  brotli = None
+from werkzeug.routing import IntegerConverter, ValidationError
+from werkzeug.security import check_password_hash, generate_password_hash
 
-# Instância 
-application = Flask(__name__)
-application.config['SECRET_KEY'] = "minha_chave_123"
-application.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///ecommerce.db' # banco SQLite 
+# Configuracao
+# valores padrao de cada app criada por create_app; o ambiente e lido na hora de criar
+def configure_defaults(app):
+  app.config['SECRET_KEY'] = "minha_chave_123"
+  # banco e perfil do SQLite vem do ambiente (DATABASE_URI, DB_PROFILE); sem nada usa o ecommerce.db
+  app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URI', 'sqlite:///ecommerce.db') # banco SQLite
+  app.config['DB_PROFILE'] = os.environ.get('DB_PROFILE', 'production')
+  app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 10)) # conexoes mantidas abertas
+  app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 20)) # conexoes extras em pico
+  # leituras: rotas marcadas com @read_only usam um pool separado, so de leitura. Sem DATABASE_READ_URI
+  # e o mesmo arquivo SQLite aberto em modo read-only (mode=ro); com uma replica, a URI dela
+  app.config['READ_ROUTING_ENABLED'] = os.environ.get('READ_ROUTING_ENABLED', '1') == '1'
+  app.config['DATABASE_READ_URI'] = os.environ.get('DATABASE_READ_URI')
+  app.config['DB_READ_POOL_SIZE'] = int(os.environ.get('DB_READ_POOL_SIZE', 10))
+  # depois de uma escrita o mesmo cliente le do primario por esse tempo (le o que acabou de gravar)
+  app.config['READ_YOUR_WRITES_SECONDS'] = float(os.environ.get('READ_YOUR_WRITES_SECONDS', 5))
+  app.config['DB_LOCK_RETRIES'] = int(os.environ.get('DB_LOCK_RETRIES', 5)) # novas tentativas em "database is locked"
+  app.config['DB_LOCK_BACKOFF'] = 0.05 # segundos; dobra a cada tentativa
+  app.config['PRODUCTS_PAGE_SIZE'] = 100 # tamanho padrao da pagina em GET /api/products
+  app.config['PRODUCTS_MAX_PAGE_SIZE'] = 1000
+  app.config['PRODUCTS_STREAM_BATCH'] = 500 # linhas buscadas por vez no modo stream
+  app.config['PRODUCTS_BULK_BATCH_SIZE'] = 5000 # linhas por executemany no import em massa
+  app.config['PRODUCTS_BULK_MAX_ERRORS'] = 1000 # erros detalhados no relatorio do import
+  app.config['CART_BATCH_MAX_OPERATIONS'] = 500 # operacoes por POST /api/cart/batch
+  app.config['CART_MAX_QUANTITY'] = 10000 # unidades de um produto numa linha do carrinho
+  app.config['PRODUCT_CACHE_SIZE'] = 10000 # produtos guardados no cache de detalhes
+  app.config['PRODUCT_CACHE_TTL'] = 300 # segundos; so limita a memoria: todo acerto e conferido com a versao do produto no banco
+  # custo do hash de senha por deploy, ex. "scrypt:32768:8:1" ou "pbkdf2:sha256:600000".
+  # mudar o custo e seguro: cada senha e refeita com o custo novo no proximo login
+  app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+  app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 2)) # threads de hash
+  app.config['PASSWORD_HASH_QUEUE'] = int(os.environ.get('PASSWORD_HASH_QUEUE', 64)) # hashes esperando; acima disso responde 503
+  app.config['AUTH_TOKENS_ENABLED'] = True # aceita token assinado no header Authorization
+  app.config['AUTH_TOKEN_MAX_AGE'] = 3600 # segundos de validade do token
+  app.config['AUTH_TOKEN_VERSION_TTL'] = 30 # segundos que a versao do token fica em cache (revogacao entre processos)
+  # compressao das respostas (Accept-Encoding): br se o pacote brotli estiver instalado, senao gzip
+  app.config['COMPRESSION_ENABLED'] = os.environ.get('COMPRESSION_ENABLED', '1') == '1'
+  app.config['COMPRESSION_MIN_SIZE'] = 1024 # bytes; corpos menores vao sem compressao
+  app.config['COMPRESSION_GZIP_LEVEL'] = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6)) # 1 (rapido) a 9 (menor)
+  app.config['COMPRESSION_BROTLI_QUALITY'] = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 4)) # 0 a 11
+  app.config['COMPRESSION_MIMETYPES'] = ('application/json', 'text/plain', 'text/html')
+  app.config['COMPRESSION_CACHE_SIZE'] = 500 # corpos comprimidos guardados (por ETag e encoding)
+  # limite de requisicoes por usuario (ou IP, sem login) e por rota: (requisicoes, segundos).
+  # Balde de fichas: cabem `requisicoes` de uma vez e ele reenche nesse ritmo. None: sem limite
+  app.config['RATELIMIT_ENABLED'] = os.environ.get('RATELIMIT_ENABLED', '1') == '1'
+  app.config['RATELIMIT_DEFAULT'] = (600, 60) # rotas que nao estao em RATELIMIT_RULES
+  app.config['RATELIMIT_RULES'] = {
+    'login': (10, 60),
+    'create_token': (10, 60),
+    'add_user': (10, 60),
+    'get_products': (300, 60),
+    'search_products': (120, 60),
+    'bulk_products': (10, 60),
+    'initial': None,
+    'metrics': None,
+  }
+  app.config['RATELIMIT_MAX_BUCKETS'] = 100000 # baldes em memoria; acima disso os parados saem primeiro
+  # fila de jobs (efeitos colaterais do checkout): gravados na tabela outbox_job na mesma transacao
+  # da escrita e executados depois por threads de cada processo, com novas tentativas e backoff
+  app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2)) # threads por processo; 0: so grava, outro processo executa
+  app.config['JOB_MAX_ATTEMPTS'] = 5 # depois disso o job fica 'dead' (flask requeue-jobs devolve para a fila)
+  app.config['JOB_RETRY_DELAY'] = 2.0 # segundos ate a 2a tentativa; dobra a cada falha
+  app.config['JOB_RETRY_MAX_DELAY'] = 300.0
+  app.config['JOB_BATCH_SIZE'] = 20 # jobs reservados (e apagados no fim) por transacao
+  app.config['JOB_LEASE'] = 300 # segundos que um lote fica reservado; se o processo morrer no meio ele volta para a fila
+  app.config['JOB_POLL_INTERVAL'] = 1.0 # segundos entre buscas por jobs de outros processos e novas tentativas
+  app.config['IDEMPOTENCY_TTL'] = 86400 # segundos que a resposta de um Idempotency-Key fica guardada
+  app.config['IDEMPOTENCY_WAIT'] = 10 # segundos que uma repeticao espera a requisicao original terminar
+  app.config['IDEMPOTENCY_PENDING_TTL'] = 60 # segundos; chave sem resposta ha mais tempo (processo que caiu) e retomada
+  app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') == '1' # contagem de consultas e /metrics
+  app.config['SERVER_TIMING'] = True # header Server-Timing com o tempo de banco de cada resposta
+  app.config['SLOW_REQUEST_MS'] = int(os.environ.get('SLOW_REQUEST_MS', 500)) # acima disso grava um log da requisicao
+  app.config['METRICS_BUCKETS'] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5) # segundos (histograma)
+  # documentacao: "flasgger" gera o spec das docstrings e serve a UI em /apidocs (desenvolvimento);
+  # "static" serve o apispec.json gerado no build por "flask build-apispec", sem carregar o flasgger;
+  # "off" nao publica documentacao
+  app.config['SWAGGER_MODE'] = os.environ.get('SWAGGER_MODE', 'flasgger')
+  app.config['APISPEC_FILE'] = os.environ.get('APISPEC_FILE', os.path.join(app.root_path, 'apispec.json'))
 
+# Perfis do SQLite: PRAGMAs aplicados em cada conexao nova do pool
+SQLITE_PROFILES = {
+  # comportamento padrao do SQLite (journal de rollback, synchronous=FULL)
+  'default': {},
+  # WAL: leitores nao bloqueiam o escritor e vice-versa.
+  # synchronous=NORMAL e seguro com WAL (so perde a ultima transacao numa queda de energia)
+  'production': {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000, # ms esperando o lock antes de "database is locked"
+    'mmap_size': 268435456, # 256 MB lidos direto do arquivo via mmap
+    'cache_size': -65536, # 64 MB de cache de paginas por conexao (negativo = KiB)
+    'temp_store': 'MEMORY',
+  },
+}
+def engine_options(config, uri, pool_size=None):
+  # o SQLite em memoria usa StaticPool (uma conexao so), onde nao existe tamanho de pool
+  database = make_url(uri).database
+  if database in (None, '', ':memory:'):
+    return {}
+  return {
+    'pool_size': config['DB_POOL_SIZE'] if pool_size is None else pool_size,
+    'max_overflow': config['DB_MAX_OVERFLOW'],
+    'pool_timeout': 30,
+  }
+
+def set_sqlite_pragmas(dbapi_connection, pragmas):
+  cursor = dbapi_connection.cursor()
+  for name, value in pragmas.items():
+    try:
+      cursor.execute(f'PRAGMA {name}={value}')
+    except sqlite3.OperationalError:
+      # conexao read-only (pool de leitura) num banco que ainda nao esta em WAL: quem muda e o primario
+      if name != 'journal_mode':
+        raise
+  cursor.close()
+
+# Leituras e escritas
+# A sessao manda cada instrucao para um engine: escritas (INSERT/UPDATE/DELETE, flush) sempre
+# para o primario; SELECTs de uma rota @read_only para o engine de leitura (bind 'read'), a nao
+# ser que o cliente tenha escrito ha pouco (ver read_only). Fora de requisicao tudo vai para o primario
+class RoutingSession(Session):
+  def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+    if (bind is None and not self._flushing and has_request_context() and g.get('read_engine')
+        and not getattr(clause, 'is_dml', False)):
+      return g.read_engine
+    return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+  def commit(self):
+    # numa rota @idempotent o commit da rota vira flush: o commit de verdade e o do idempotent,
+    # depois de gravar a resposta na mesma transacao (ver finish_idempotency_key)
+    if has_request_context() and g.get('idempotency_record') is not None:
+      self.flush()
+      return
+    super().commit()
+
+def read_only_uri(uri):
+  # mesmo arquivo SQLite aberto so para leitura; None se nao da (banco em memoria, outro banco)
+  url = make_url(uri)
+  if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:') or url.query.get('uri'):
+    return None
+  return url.set(database=f'file:{url.database}', query={**url.query, 'mode': 'ro', 'uri': 'true'}).render_as_string()
+
+def apply_sqlite_pragmas(engine, pragmas):
+  # cada engine da app recebe os PRAGMAs do perfil dela; o engine assincrono (asgi.py) liga o
+  # set_sqlite_pragmas no proprio engine
+  @event.listens_for(engine, 'connect')
+  def connect(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+      set_sqlite_pragmas(dbapi_connection, pragmas)
+
+# extensoes e rotas sem app: create_app (no fim do arquivo) liga cada uma na app que cria
 login_manager = LoginManager()
-db = SQLAlchemy(application)
-login_manager.init_app(application)
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+# cli_group=None: os comandos (flask upgrade-db, ...) ficam no nivel de cima, sem o prefixo "api"
+routes = Blueprint('api', __name__, cli_group=None)
 # login_manager.login_view = 'login'
-CORS(application)
 
 # Configuração do Swagger
 template = {
@@ -39,14 +222,37 @@ template = {
     }
 }
 
-Swagger(application, template=template)
+# Spec pre-compilado: lido do disco no primeiro acesso e mantido em memoria
+apispec_body = None
+
+def static_apispec():
+  global apispec_body
+  if apispec_body is None:
+    try:
+      with open(current_app.config['APISPEC_FILE'], 'rb') as apispec_file:
+        apispec_body = apispec_file.read()
+    except FileNotFoundError:
+      return jsonify({"message": "API spec not built, run flask build-apispec"}), 404
+  response = Response(apispec_body, mimetype='application/json')
+  response.headers['Cache-Control'] = 'public, max-age=3600'
+  return response
+
+def init_docs(app):
+  # o flasgger (e o jsonschema, mistune e yaml que ele importa) so entra no processo
+  # quando a documentacao e gerada das docstrings
+  if app.config['SWAGGER_MODE'] == 'flasgger':
+    from flasgger import Swagger
+    Swagger(app, template=template)
+  elif app.config['SWAGGER_MODE'] == 'static':
+    app.add_url_rule('/apispec_1.json', view_func=static_apispec, methods=["GET"])
 
 #Modelagem
 # User (id, username, password)
 class User(db.Model, UserMixin): #UserMixin e uma herança então estou herdando dele 
   id = db.Column(db.Integer, primary_key=True)
   username = db.Column(db.String(80), nullable=False, unique=True)
-  password = db.Column(db.String(80), nullable=False)
+  password = db.Column(db.String(255), nullable=False) # hash "metodo$salt$hash" (texto puro em bancos antigos)
+  token_version = db.Column(db.Integer, nullable=False, default=0, server_default='0') # subir invalida os tokens do usuario
   cart = db.relationship('CartItem', backref='user', lazy=True) 
   """lazy='True' ele so vai acessar as informações do carrinho 
   quando eu tentar acessar o cart não sempre isso para performace
@@ -54,24 +260,1252 @@ class User(db.Model, UserMixin): #UserMixin e uma herança então estou herdando
   
 #Produto (id, name, price, description)
 class Product(db.Model): # Classe produto
+  # indices (coluna, id) servem filtro/ordenacao e o cursor keyset ao mesmo tempo.
+  # Filtro e ordem em colunas diferentes (ex. sort=id ou name com min_price, sort=id ou price com
+  # name_prefix) nao cabem num indice so: a busca usa o indice do filtro e o SQLite ordena as
+  # linhas filtradas (USE TEMP B-TREE). tests/test_product_listing.py confere os planos
+  __table_args__ = (
+    db.Index('ix_product_price_id', 'price', 'id'),
+    db.Index('ix_product_name_id', 'name', 'id'),
+  )
   id = db.Column(db.Integer, primary_key=True)
   name = db.Column(db.String(120), nullable=False)
   price = db.Column(db.Float, nullable=False) 
   description = db.Column(db.Text, nullable=True)
+  version = db.Column(db.Integer, nullable=False, default=0, server_default='0') # usada no ETag do produto
+  stock = db.Column(db.Integer, nullable=True) # unidades disponiveis; None: estoque nao controlado
+
+# Versao do catalogo (uma linha so). Sobe a cada escrita em produtos e nunca volta,
+# entao (id, version) de um produto e unico mesmo que o SQLite reaproveite o id
+class CatalogVersion(db.Model):
+  id = db.Column(db.Integer, primary_key=True)
+  version = db.Column(db.Integer, nullable=False)
+
+event.listen(CatalogVersion.__table__, 'after_create', DDL('INSERT INTO catalog_version (id, version) VALUES (1, 1)'))
 
 # cart
+# uma linha por (usuario, produto); adicionar o mesmo produto de novo so aumenta a quantity
 class CartItem(db.Model):
+  __table_args__ = (db.UniqueConstraint('user_id', 'product_id', name='uq_cart_item_user_product'),)
   id = db.Column(db.Integer, primary_key=True)
   user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
   product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+  quantity = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+# Pedido (snapshot do carrinho no checkout, com o preco da hora da compra)
+class Order(db.Model):
+  id = db.Column(db.Integer, primary_key=True)
+  user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+  total = db.Column(db.Float, nullable=False)
+  created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.current_timestamp())
+  lines = db.relationship('OrderLine', backref='order', lazy=True)
+
+class OrderLine(db.Model):
+  id = db.Column(db.Integer, primary_key=True)
+  order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False, index=True)
+  product_id = db.Column(db.Integer, nullable=False) # sem FK: o pedido continua valido se o produto for apagado
+  product_name = db.Column(db.String(120), nullable=False)
+  unit_price = db.Column(db.Float, nullable=False)
+  quantity = db.Column(db.Integer, nullable=False)
+
+# Resposta guardada de um POST com Idempotency-Key (ver idempotent). status NULL: ainda rodando
+class IdempotencyKey(db.Model):
+  __table_args__ = (db.UniqueConstraint('user_id', 'key', name='uq_idempotency_key_user_key'),)
+  id = db.Column(db.Integer, primary_key=True)
+  user_id = db.Column(db.Integer, nullable=False) # sem FK: a linha expira sozinha
+  key = db.Column(db.String(255), nullable=False)
+  fingerprint = db.Column(db.String(64), nullable=False) # sha256 de metodo, caminho e corpo
+  status = db.Column(db.Integer, nullable=True)
+  content_type = db.Column(db.String(100), nullable=True)
+  body = db.Column(db.LargeBinary, nullable=True)
+  created_at = db.Column(db.Float, nullable=False, index=True) # time.time()
+
+# Job da fila (ver enqueue_jobs). run_at: quando pode rodar; enquanto roda e o fim da reserva.
+# Sucesso apaga a linha; status 'dead': esgotou as tentativas
+class OutboxJob(db.Model):
+  __table_args__ = (db.Index('ix_outbox_job_status_run_at', 'status', 'run_at'),)
+  id = db.Column(db.Integer, primary_key=True)
+  kind = db.Column(db.String(50), nullable=False)
+  payload = db.Column(db.Text, nullable=False) # JSON
+  status = db.Column(db.String(10), nullable=False, default='pending', server_default='pending')
+  attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+  run_at = db.Column(db.Float, nullable=False) # time.time()
+  created_at = db.Column(db.Float, nullable=False)
+  last_error = db.Column(db.Text, nullable=True)
+
+# Busca (FTS5)
+# indice de texto com conteudo externo: o texto fica so na tabela product, o FTS guarda o indice.
+# os triggers mantem o indice em dia em qualquer escrita (rotas, import em massa, flask shell)
+PRODUCT_SEARCH_DDL = [
+  "CREATE VIRTUAL TABLE IF NOT EXISTS product_fts USING fts5("
+  "name, description, content='product', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+  # o nome pesa mais que a descricao no BM25
+  "INSERT INTO product_fts(product_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)')",
+  "CREATE TRIGGER IF NOT EXISTS product_fts_insert AFTER INSERT ON product BEGIN "
+  "INSERT INTO product_fts(rowid, name, description) VALUES (new.id, new.name, new.description); END",
+  "CREATE TRIGGER IF NOT EXISTS product_fts_delete AFTER DELETE ON product BEGIN "
+  "INSERT INTO product_fts(product_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); END",
+  "CREATE TRIGGER IF NOT EXISTS product_fts_update AFTER UPDATE OF name, description ON product BEGIN "
+  "INSERT INTO product_fts(product_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); "
+  "INSERT INTO product_fts(rowid, name, description) VALUES (new.id, new.name, new.description); END",
+]
+
+def create_product_search(connection):
+  for statement in PRODUCT_SEARCH_DDL:
+    connection.exec_driver_sql(statement)
+  rebuild_product_search(connection)
+
+def rebuild_product_search(connection):
+  # refaz o indice inteiro a partir da tabela product
+  connection.exec_driver_sql("INSERT INTO product_fts(product_fts) VALUES ('rebuild')")
+
+# o indice nasce e morre junto com a tabela product (db.create_all / db.drop_all)
+event.listen(Product.__table__, 'after_create', lambda target, connection, **kw: create_product_search(connection))
+event.listen(Product.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS product_fts'))
+
+@routes.cli.command('rebuild-search')
+def rebuild_search():
+  """Rebuild the product full-text search index."""
+  with db.engine.begin() as connection:
+    if db.inspect(connection).has_table('product_fts'):
+      rebuild_product_search(connection)
+    else:
+      create_product_search(connection)
+  print('search index rebuilt')
+
+# Migrações
+# cada passo confere o schema antes de mudar, entao rodar de novo nao faz nada
+def migrate_cart_quantity(inspector):
+  # versoes antigas gravavam uma linha por clique; junta as repetidas na coluna quantity
+  if not inspector.has_table('cart_item'):
+    return False
+  columns = [column['name'] for column in inspector.get_columns('cart_item')]
+  if 'quantity' in columns:
+    return False
+  # SQLite nao altera constraints com ALTER TABLE, entao a tabela e recriada
+  with db.engine.begin() as connection:
+    connection.exec_driver_sql('ALTER TABLE cart_item RENAME TO cart_item_old')
+    CartItem.__table__.create(connection)
+    connection.exec_driver_sql(
+      'INSERT INTO cart_item (id, user_id, product_id, quantity) '
+      'SELECT MIN(id), user_id, product_id, COUNT(*) FROM cart_item_old GROUP BY user_id, product_id'
+    )
+    connection.exec_driver_sql('DROP TABLE cart_item_old')
+  return True
+
+def add_column(inspector, table, column, definition):
+  if not inspector.has_table(table):
+    return False
+  if column in [existing['name'] for existing in inspector.get_columns(table)]:
+    return False
+  with db.engine.begin() as connection:
+    connection.exec_driver_sql(f'ALTER TABLE "{table}" ADD COLUMN {column} {definition}')
+  return True
+
+def migrate_product_version(inspector):
+  return add_column(inspector, 'product', 'version', 'INTEGER NOT NULL DEFAULT 0')
+
+def migrate_user_token_version(inspector):
+  return add_column(inspector, 'user', 'token_version', 'INTEGER NOT NULL DEFAULT 0')
+
+def migrate_product_stock(inspector):
+  # produtos que ja existem ficam com NULL (sem controle de estoque) e continuam vendendo
+  return add_column(inspector, 'product', 'stock', 'INTEGER')
+
+def migrate_product_search(inspector):
+  if not inspector.has_table('product') or inspector.has_table('product_fts'):
+    return False
+  with db.engine.begin() as connection:
+    create_product_search(connection)
+  return True
+
+def migrate_product_indexes(inspector):
+  if not inspector.has_table('product'):
+    return False
+  existing = {index['name'] for index in inspector.get_indexes('product')}
+  missing = [index for index in Product.__table__.indexes if index.name not in existing]
+  with db.engine.begin() as connection:
+    for index in missing:
+      index.create(connection)
+  return bool(missing)
+
+MIGRATIONS = [
+  migrate_cart_quantity,
+  migrate_product_version,
+  migrate_product_search,
+  migrate_product_indexes,
+  migrate_user_token_version,
+  migrate_product_stock,
+]
+
+@routes.cli.command('upgrade-db')
+def upgrade_db():
+  """Bring an existing database up to date and create missing tables."""
+  for migration in MIGRATIONS:
+    # inspector novo a cada passo, o anterior pode ter mudado o schema
+    if migration(db.inspect(db.engine)):
+      print(f'{migration.__name__}: applied')
+  db.create_all()
+  print('database up to date')
+
+@routes.cli.command('build-apispec')
+@click.option('--output', help='JSON file to write (default: APISPEC_FILE)')
+@click.option('--yaml', 'yaml_output', help='also write the spec as YAML, e.g. swagger.yaml')
+def build_apispec(output, yaml_output):
+  """Generate the OpenAPI spec from the route docstrings."""
+  app = current_app._get_current_object()
+  swagger = getattr(app, 'swag', None)
+  if swagger is None:
+    from flasgger import Swagger # so o build precisa do flasgger nos modos static/off
+    swagger = Swagger(app, template=template)
+  with app.test_request_context():
+    spec = swagger.get_apispecs('apispec_1')
+  body = json.dumps(spec, sort_keys=True, separators=(',', ':'))
+  output = output or current_app.config['APISPEC_FILE']
+  with open(output, 'w') as spec_file:
+    spec_file.write(body)
+  print(f'api spec written to {output}')
+  if yaml_output:
+    import yaml
+
+    class IndentedDumper(yaml.SafeDumper):
+      # listas indentadas dentro da chave, como no swagger.yaml
+      def increase_indent(self, flow=False, indentless=False):
+        return super().increase_indent(flow, False)
+
+    with open(yaml_output, 'w') as yaml_file:
+      # volta do JSON: o spec do flasgger tem defaultdicts que o yaml nao representa
+      yaml.dump(json.loads(body), yaml_file, Dumper=IndentedDumper, sort_keys=True, allow_unicode=True, width=1000,
+                default_flow_style=False)
+    print(f'api spec written to {yaml_output}')
+
+# JSON
+# backend de JSON: orjson se estiver instalado, senao o json da biblioteca padrao
+if orjson is not None:
+  def dumps_json(value):
+    return orjson.dumps(value)
+else:
+  def dumps_json(value):
+    return json.dumps(value, separators=(',', ':')).encode()
+
+def json_response(body, status=200):
+  # resposta com o JSON ja serializado (bytes)
+  return Response(body, status=status, mimetype='application/json')
+
+# Serializador declarativo: chave de saida -> coluna. Funciona direto nas linhas do
+# SQLAlchemy Core (tuplas), sem montar objetos do ORM. Para cada projecao (campos
+# pedidos + posicao inicial na linha) gera uma vez uma funcao linha -> dict
+class RowSerializer:
+  def __init__(self, **fields):
+    self.fields = fields
+    self.keys = tuple(fields)
+    self._compiled = {}
+
+  def columns(self, keys=None):
+    return [self.fields[key] for key in keys or self.keys]
+
+  def compile(self, keys=None, offset=0):
+    keys = tuple(keys or self.keys)
+    function = self._compiled.get((keys, offset))
+    if function is None:
+      # as chaves vem do codigo (self.fields), nunca da requisicao
+      items = ', '.join(f'{key!r}: row[{offset + index}]' for index, key in enumerate(keys))
+      namespace = {}
+      exec(f'def row_to_dict(row):\n  return {{{items}}}', namespace)
+      function = self._compiled[(keys, offset)] = namespace['row_to_dict']
+    return function
+
+  def dumps(self, rows, keys=None, offset=0):
+    row_to_dict = self.compile(keys, offset)
+    return dumps_json([row_to_dict(row) for row in rows])
+
+  def dumps_one(self, row, keys=None, offset=0):
+    return dumps_json(self.compile(keys, offset)(row))
+
+product_serializer = RowSerializer(
+  id=Product.id,
+  name=Product.name,
+  price=Product.price,
+  description=Product.description,
+  stock=Product.stock,
+)
+
+cart_item_serializer = RowSerializer(
+  id=CartItem.id,
+  user_id=CartItem.user_id,
+  product_id=CartItem.product_id,
+  product_name=Product.name,
+  product_price=Product.price,
+  quantity=CartItem.quantity,
+)
+
+# Cache
+# Interface do cache: qualquer backend (ex. um cache compartilhado) so precisa desses metodos
+class CacheBackend(ABC):
+  @abstractmethod
+  def get(self, key):
+    ...
+
+  @abstractmethod
+  def set(self, key, value):
+    ...
+
+  @abstractmethod
+  def delete(self, key):
+    ...
+
+  @abstractmethod
+  def clear(self):
+    ...
+
+  @abstractmethod
+  def stats(self):
+    ...
+
+# LRU em memoria com TTL, seguro entre threads
+class LRUCache(CacheBackend):
+  def __init__(self, max_entries, ttl):
+    self.max_entries = max_entries
+    self.ttl = ttl
+    self._data = OrderedDict() # chave -> (expira_em, valor)
+    self._lock = threading.Lock()
+    self.hits = self.misses = self.evictions = self.expirations = 0
+
+  def get(self, key):
+    with self._lock:
+      entry = self._data.get(key)
+      if entry is None:
+        self.misses += 1
+        return None
+      if entry[0] < time.monotonic():
+        del self._data[key]
+        self.expirations += 1
+        self.misses += 1
+        return None
+      self._data.move_to_end(key)
+      self.hits += 1
+      return entry[1]
+
+  def set(self, key, value):
+    with self._lock:
+      self._data[key] = (time.monotonic() + self.ttl, value)
+      self._data.move_to_end(key)
+      while len(self._data) > self.max_entries:
+        self._data.popitem(last=False)
+        self.evictions += 1
+
+  def delete(self, key):
+    with self._lock:
+      self._data.pop(key, None)
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+
+  def stats(self):
+    with self._lock:
+      return {
+        "backend": "memory-lru",
+        "entries": len(self._data),
+        "max_entries": self.max_entries,
+        "ttl": self.ttl,
+        "hits": self.hits,
+        "misses": self.misses,
+        "evictions": self.evictions,
+        "expirations": self.expirations
+      }
+
+# guarda (etag, JSON do produto ja serializado em bytes), pronto para a resposta.
+# Um por processo, criado em init_process_state
+product_cache = None
+# incrementado a cada invalidacao: uma leitura que comecou antes de uma escrita nao grava dado velho no cache
+product_cache_generation = 0
+
+def invalidate_product(product_id):
+  global product_cache_generation
+  product_cache_generation += 1
+  product_cache.delete(product_id)
+
+def invalidate_all_products():
+  global product_cache_generation
+  product_cache_generation += 1
+  product_cache.clear()
+
+def get_product_entry(product_id, if_none_match=None):
+  # read-through: procura no cache, senao busca no banco e guarda.
+  # devolve (etag, body); body e None quando o cliente ja tem essa versao (304).
+  # devolve None se o produto nao existe
+  entry = product_cache.get(product_id)
+  if entry is not None:
+    version = db.session.execute(product_version_query(product_id)).scalar()
+    entry = fresh_product_entry(product_id, entry, version, if_none_match)
+    if entry is not None:
+      return entry
+  generation = product_cache_generation
+  row = db.session.execute(product_details_query(product_id)).first()
+  return product_entry_from_row(product_id, row, generation, if_none_match)
+
+# partes do get_product_entry, reaproveitadas pela versao assincrona (asgi.py)
+def product_version_query(product_id):
+  return db.select(Product.version).where(Product.id == product_id)
+
+def fresh_product_entry(product_id, entry, version, if_none_match=None):
+  # o cache e de cada processo e a invalidacao so limpa o processo que fez a escrita. Por isso
+  # todo acerto e conferido com a versao atual do produto no banco (uma leitura pela chave):
+  # se outro worker (ou o checkout, ou o CLI) mudou o produto, a entrada sai e a linha e relida.
+  # version: Product.version lida agora, None se o produto nao existe mais
+  if version is None or entry[0] != product_etag(product_id, version):
+    product_cache.delete(product_id)
+    return None
+  if if_none_match and if_none_match.contains_weak(entry[0]):
+    return entry[0], None
+  return entry
+
+def product_details_query(product_id):
+  return db.select(*product_serializer.columns(), Product.version).where(Product.id == product_id)
+
+def product_entry_from_row(product_id, row, generation, if_none_match=None):
+  # generation: valor de product_cache_generation lido antes da consulta
+  if row is None:
+    return None
+  etag = product_etag(row.id, row.version)
+  if if_none_match and if_none_match.contains_weak(etag):
+    return etag, None # nem serializa
+  body = product_serializer.dumps_one(row)
+  if generation == product_cache_generation:
+    product_cache.set(product_id, (etag, body))
+  return etag, body
+
+# ETags
+def product_etag(product_id, version):
+  return f'p{product_id}-{version}'
+
+def catalog_etag(version, query_string=None):
+  # a listagem depende da versao do catalogo e dos parametros (limit, after, fields...)
+  query_string = request.query_string if query_string is None else query_string
+  return f'c{version}-' + hashlib.sha1(query_string).hexdigest()[:16]
+
+def catalog_version_query():
+  return db.select(CatalogVersion.version).where(CatalogVersion.id == 1)
+
+def current_catalog_version():
+  return db.session.execute(catalog_version_query()).scalar() or 0
+
+def bump_catalog_version():
+  # chamado dentro da transacao da escrita; o commit fica com quem chamou
+  return db.session.execute(
+    db.update(CatalogVersion).where(CatalogVersion.id == 1)
+    .values(version=CatalogVersion.version + 1)
+    .returning(CatalogVersion.version)
+  ).scalar()
+
+def not_modified(etag):
+  response = Response(status=304)
+  response.set_etag(etag)
+  response.headers['Cache-Control'] = 'no-cache'
+  return response
+
+def with_etag(response, etag):
+  response.set_etag(etag)
+  response.headers['Cache-Control'] = 'no-cache' # o cliente sempre revalida com If-None-Match
+  return response
+
+# Compressao
+# Negocia o Accept-Encoding (br, gzip) no after_request. Corpos pequenos vao sem compressao;
+# respostas em stream sao comprimidas pedaco a pedaco. Uma resposta com ETag forte tem sempre
+# os mesmos bytes, entao o corpo comprimido fica no compressed_cache por (ETag, encoding) e
+# nao e comprimido de novo. Com compressao o ETag vira fraco (W/"..."): os bytes mudam com o
+# encoding, e as comparacoes de If-None-Match sao fracas
+compressed_cache = None # um por processo, criado em init_process_state
+
+def choose_encoding(accept_encodings):
+  # accept_encodings: o MIMEAccept/Accept do werkzeug (respeita q=0)
+  offers = ['br', 'gzip'] if brotli is not None else ['gzip']
+  return accept_encodings.best_match(offers)
+
+def compress_body(body, encoding):
+  if encoding == 'br':
+    return brotli.compress(body, quality=current_app.config['COMPRESSION_BROTLI_QUALITY'])
+  # mtime=0: o mesmo corpo gera sempre os mesmos bytes
+  return gzip.compress(body, current_app.config['COMPRESSION_GZIP_LEVEL'], mtime=0)
+
+def compressed_body(body, encoding, etag=None):
+  if etag is None:
+    return compress_body(body, encoding)
+  compressed = compressed_cache.get((etag, encoding))
+  if compressed is None:
+    compressed = compress_body(body, encoding)
+    compressed_cache.set((etag, encoding), compressed)
+  return compressed
+
+def stream_compressor(encoding):
+  # devolve (comprime um pedaco ja com flush, finaliza): cada pedaco sai assim que chega
+  if encoding == 'br':
+    compressor = brotli.Compressor(quality=current_app.config['COMPRESSION_BROTLI_QUALITY'])
+    return (lambda chunk: compressor.process(chunk) + compressor.flush()), compressor.finish
+  compressor = zlib.compressobj(current_app.config['COMPRESSION_GZIP_LEVEL'], zlib.DEFLATED, 31) # 31: formato gzip
+  return (lambda chunk: compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)), compressor.flush
+
+def compress_stream(chunks, encoding):
+  compress, finish = stream_compressor(encoding)
+  try:
+    for chunk in chunks:
+      if chunk:
+        yield compress(chunk.encode() if isinstance(chunk, str) else chunk)
+    yield finish()
+  finally:
+    if hasattr(chunks, 'close'):
+      chunks.close()
+
+@routes.after_app_request
+def compress_response(response):
+  if (not current_app.config['COMPRESSION_ENABLED'] or request.method == 'HEAD'
+      or response.mimetype not in current_app.config['COMPRESSION_MIMETYPES']
+      or 'Content-Encoding' in response.headers or response.direct_passthrough):
+    return response
+  response.vary.add('Accept-Encoding')
+  encoding = choose_encoding(request.accept_encodings)
+  if encoding is None:
+    return response
+  etag, weak = response.get_etag()
+  if response.status_code == 304:
+    if etag and not weak:
+      response.set_etag(etag, weak=True)
+    return response
+  if response.status_code != 200:
+    return response
+  if response.is_streamed:
+    response.response = compress_stream(response.response, encoding)
+    response.headers.pop('Content-Length', None)
+  else:
+    body = response.get_data()
+    if len(body) < current_app.config['COMPRESSION_MIN_SIZE']:
+      return response
+    response.set_data(compressed_body(body, encoding, etag if etag and not weak else None))
+  response.headers['Content-Encoding'] = encoding
+  if etag and not weak:
+    response.set_etag(etag, weak=True)
+  return response
+
+# Escritas concorrentes
+def retry_on_locked(view):
+  # SQLite tem um escritor por vez. Se o lock nao sair dentro do busy_timeout,
+  # a transacao e desfeita e a rota roda de novo com backoff exponencial (com jitter)
+  @wraps(view)
+  def wrapper(*args, **kwargs):
+    retries = current_app.config['DB_LOCK_RETRIES']
+    for attempt in range(retries + 1):
+      try:
+        return view(*args, **kwargs)
+      except OperationalError as error:
+        db.session.rollback()
+        if attempt == retries or 'database is locked' not in str(error.orig):
+          raise
+        time.sleep(current_app.config['DB_LOCK_BACKOFF'] * (2 ** attempt) * (0.5 + random.random()))
+  return wrapper
+
+# Idempotencia
+# POST com o header Idempotency-Key: a primeira requisicao roda e a resposta fica guardada
+# (por usuario e chave) na tabela idempotency_key; as repeticoes devolvem a mesma resposta
+# sem rodar a rota de novo. Uma repeticao que chega enquanto a original ainda roda espera
+# por ela: no mesmo processo por um Event, entre processos consultando a tabela.
+# A reserva da chave usa uma conexao propria (as outras requisicoes precisam ve-la na hora);
+# a resposta e gravada pela sessao da requisicao, no mesmo commit das escritas da rota: ou as
+# duas ficam ou nenhuma. Se o processo morrer antes, nada da rota foi gravado e a chave
+# pendente pode rodar de novo depois de IDEMPOTENCY_PENDING_TTL sem duplicar nada
+idempotency_lock = None # criados em init_process_state
+idempotency_in_flight = None # (user_id, chave) -> Event da requisicao que esta rodando
+
+def request_fingerprint():
+  digest = hashlib.sha256(f'{request.method} {request.full_path}\n'.encode())
+  digest.update(request.get_data(cache=True))
+  return digest.hexdigest()
+
+def claim_idempotency_key(user_id, key, fingerprint):
+  # devolve (id, None) se esta requisicao ficou com a chave (nova, expirada ou abandonada),
+  # senao (None, registro existente)
+  now = time.time()
+  statement = sqlite_insert(IdempotencyKey).values(user_id=user_id, key=key, fingerprint=fingerprint, created_at=now)
+  statement = statement.on_conflict_do_update(
+    index_elements=['user_id', 'key'],
+    set_={'fingerprint': fingerprint, 'status': None, 'content_type': None, 'body': None, 'created_at': now},
+    where=(IdempotencyKey.created_at < now - current_app.config['IDEMPOTENCY_TTL'])
+    | (IdempotencyKey.status.is_(None) & (IdempotencyKey.created_at < now - current_app.config['IDEMPOTENCY_PENDING_TTL'])),
+  ).returning(IdempotencyKey.id)
+  with db.engine.begin() as connection:
+    if random.random() < 0.01: # de vez em quando apaga as expiradas, para a tabela nao crescer
+      connection.execute(db.delete(IdempotencyKey).where(IdempotencyKey.created_at < now - current_app.config['IDEMPOTENCY_TTL']))
+    claimed = connection.execute(statement).first()
+    if claimed is not None:
+      return claimed.id, None
+    return None, connection.execute(idempotency_record_query(user_id, key)).first()
+
+def idempotency_record_query(user_id, key):
+  return (
+    db.select(IdempotencyKey.fingerprint, IdempotencyKey.status, IdempotencyKey.content_type, IdempotencyKey.body)
+    .where(IdempotencyKey.user_id == user_id, IdempotencyKey.key == key)
+  )
+
+def finish_idempotency_key(record_id, response):
+  # guarda a resposta e faz o commit junto com as escritas da rota. Erro 5xx (ou excecao,
+  # response None) desfaz tudo e libera a chave para uma nova tentativa
+  if response is None or response.status_code >= 500 or response.is_streamed:
+    db.session.rollback()
+    release_idempotency_key(record_id)
+    return
+  try:
+    db.session.execute(
+      db.update(IdempotencyKey).where(IdempotencyKey.id == record_id)
+      .values(status=response.status_code, content_type=response.content_type, body=response.get_data())
+    )
+    db.session.commit()
+  except Exception:
+    # nada foi gravado (nem a rota): a chave volta a ficar livre e o cliente pode repetir
+    db.session.rollback()
+    release_idempotency_key(record_id)
+    raise
+  if g.pop('jobs_enqueued', False):
+    job_workers.notify() # o notify da rota veio antes deste commit
+
+def release_idempotency_key(record_id):
+  try:
+    with db.engine.begin() as connection:
+      connection.execute(db.delete(IdempotencyKey).where(IdempotencyKey.id == record_id))
+  except OperationalError:
+    # banco ocupado: a chave fica pendente e e liberada pelo IDEMPOTENCY_PENDING_TTL
+    current_app.logger.warning(json.dumps({'event': 'idempotency_release_failed', 'record_id': record_id}))
+
+def replay_idempotent(user_id, key, fingerprint, record=None):
+  # devolve a resposta guardada, esperando ate IDEMPOTENCY_WAIT se a original ainda roda
+  deadline = time.monotonic() + current_app.config['IDEMPOTENCY_WAIT']
+  while True:
+    if record is None:
+      with db.engine.connect() as connection:
+        record = connection.execute(idempotency_record_query(user_id, key)).first()
+    if record is None:
+      # a original falhou e liberou a chave
+      return jsonify({"message": "The original request with this Idempotency-Key failed, retry it"}), 409
+    if record.fingerprint != fingerprint:
+      return jsonify({"message": "Idempotency-Key was already used with a different request"}), 422
+    if record.status is not None:
+      response = Response(record.body, status=record.status, content_type=record.content_type)
+      response.headers['Idempotent-Replayed'] = 'true'
+      return response
+    if time.monotonic() >= deadline:
+      return jsonify({"message": "A request with this Idempotency-Key is still in progress"}), 409
+    time.sleep(0.05)
+    record = None
+
+def idempotent(view):
+  # vai depois do login_required: a chave e por usuario
+  @wraps(view)
+  def wrapper(*args, **kwargs):
+    key = request.headers.get('Idempotency-Key')
+    if key is None:
+      return view(*args, **kwargs)
+    if not key.strip() or len(key) > 255:
+      return jsonify({"message": "Invalid Idempotency-Key"}), 400
+    user_id = current_user.id
+    fingerprint = request_fingerprint()
+    scope = (user_id, key)
+    with idempotency_lock:
+      running = idempotency_in_flight.get(scope)
+      if running is None:
+        idempotency_in_flight[scope] = threading.Event()
+    if running is not None:
+      # mesma chave rodando neste processo: nem consulta o banco ate ela terminar
+      running.wait(current_app.config['IDEMPOTENCY_WAIT'])
+      return replay_idempotent(user_id, key, fingerprint)
+    try:
+      record_id, record = claim_idempotency_key(user_id, key, fingerprint)
+      if record_id is None:
+        return replay_idempotent(user_id, key, fingerprint, record)
+      response = None
+      g.idempotency_record = record_id
+      try:
+        response = current_app.make_response(view(*args, **kwargs))
+      finally:
+        g.idempotency_record = None
+        finish_idempotency_key(record_id, response)
+      return response
+    finally:
+      with idempotency_lock:
+        idempotency_in_flight.pop(scope).set()
+  return wrapper
+
+# Metricas
+# Toda instrucao SQL passa pelos eventos do engine. Dentro de uma requisicao a contagem,
+# o tempo total de banco e a instrucao mais lenta ficam no g e saem no after_request.
+# Consultas feitas depois da resposta (corpo em streaming) nao entram na conta
+class QueryStats:
+  __slots__ = ('started', 'count', 'duration', 'slowest', 'slowest_statement')
+
+  def __init__(self):
+    self.started = time.perf_counter()
+    self.count = 0
+    self.duration = 0.0
+    self.slowest = 0.0
+    self.slowest_statement = None
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(connection, cursor, statement, parameters, context, executemany):
+  connection.info['query_started'] = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(connection, cursor, statement, parameters, context, executemany):
+  if not has_request_context():
+    return
+  stats = g.get('query_stats')
+  if stats is None:
+    return
+  elapsed = time.perf_counter() - connection.info['query_started']
+  stats.count += 1
+  stats.duration += elapsed
+  if elapsed > stats.slowest:
+    stats.slowest = elapsed
+    stats.slowest_statement = statement
+
+# Histograma de latencia por rota no formato texto do Prometheus
+class RequestMetrics:
+  def __init__(self, buckets):
+    self.buckets = tuple(buckets)
+    self.lock = threading.Lock()
+    # (metodo, rota, status) -> contagem por faixa (+Inf no fim), soma, total, consultas, tempo de banco
+    self.series = {}
+
+  def observe(self, method, route, status, duration, stats):
+    index = bisect.bisect_left(self.buckets, duration)
+    with self.lock:
+      series = self.series.get((method, route, status))
+      if series is None:
+        series = self.series[(method, route, status)] = [[0] * (len(self.buckets) + 1), 0.0, 0, 0, 0.0]
+      series[0][index] += 1
+      series[1] += duration
+      series[2] += 1
+      series[3] += stats.count
+      series[4] += stats.duration
+
+  def render(self):
+    with self.lock:
+      series = sorted((key, [list(value[0])] + value[1:]) for key, value in self.series.items())
+    lines = [
+      '# HELP http_request_duration_seconds Request latency by route',
+      '# TYPE http_request_duration_seconds histogram',
+    ]
+    for (method, route, status), (counts, total, count, _, _) in series:
+      labels = f'method="{method}",route="{route}",status="{status}"'
+      cumulative = 0
+      for bound, bucket in zip(self.buckets + ('+Inf',), counts):
+        cumulative += bucket
+        lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+      lines.append(f'http_request_duration_seconds_sum{{{labels}}} {total:.6f}')
+      lines.append(f'http_request_duration_seconds_count{{{labels}}} {count}')
+    lines += [
+      '# HELP db_queries_total SQL statements executed while handling requests',
+      '# TYPE db_queries_total counter',
+    ]
+    for (method, route, status), (_, _, _, queries, _) in series:
+      lines.append(f'db_queries_total{{method="{method}",route="{route}",status="{status}"}} {queries}')
+    lines += [
+      '# HELP db_query_duration_seconds_total Time spent in SQL statements while handling requests',
+      '# TYPE db_query_duration_seconds_total counter',
+    ]
+    for (method, route, status), (_, _, _, _, db_time) in series:
+      lines.append(f'db_query_duration_seconds_total{{method="{method}",route="{route}",status="{status}"}} {db_time:.6f}')
+    return '\n'.join(lines) + '\n'
+
+request_metrics = None # um por processo, criado em init_process_state
+
+@routes.before_app_request
+def start_request_metrics():
+  if current_app.config['METRICS_ENABLED']:
+    g.query_stats = QueryStats()
+
+def finish_request_metrics(method, path, route, status, stats):
+  # registra a requisicao no histograma e no log de lentas; devolve o valor do header
+  # Server-Timing (ou None). Usado pelo after_request e pela versao ASGI (asgi.py)
+  duration = time.perf_counter() - stats.started
+  request_metrics.observe(method, route, status, duration, stats)
+  if duration * 1000 >= current_app.config['SLOW_REQUEST_MS']:
+    current_app.logger.warning(json.dumps({
+      'event': 'slow_request',
+      'method': method,
+      'path': path,
+      'route': route,
+      'status': status,
+      'duration_ms': round(duration * 1000, 2),
+      'db_queries': stats.count,
+      'db_ms': round(stats.duration * 1000, 2),
+      'slowest_ms': round(stats.slowest * 1000, 2),
+      'slowest_statement': '' if stats.slowest_statement is None else str(stats.slowest_statement)[:500],
+    }))
+  if current_app.config['SERVER_TIMING']:
+    return (
+      f'db;dur={stats.duration * 1000:.2f};desc="{stats.count} queries", '
+      f'db-slowest;dur={stats.slowest * 1000:.2f}, app;dur={duration * 1000:.2f}'
+    )
+  return None
+
+@routes.after_app_request
+def record_request_metrics(response):
+  stats = g.get('query_stats')
+  if stats is None:
+    return response
+  # a regra da rota (ex. /api/products/<int:product_id>), nao a URL, para nao explodir as series
+  route = request.url_rule.rule if request.url_rule else 'unmatched'
+  server_timing = finish_request_metrics(request.method, request.path, route, response.status_code, stats)
+  if server_timing:
+    response.headers['Server-Timing'] = server_timing
+  return response
+
+# Limite de requisicoes
+# Interface do armazenamento dos baldes: um backend compartilhado (ex. Redis) so precisa do take
+class RateLimitBackend(ABC):
+  @abstractmethod
+  def take(self, key, capacity, period):
+    # tira uma ficha do balde; devolve 0 se a requisicao pode seguir, senao os segundos ate a proxima ficha
+    ...
+
+  @abstractmethod
+  def stats(self):
+    ...
+
+# Baldes em memoria, divididos em shards com um lock cada: threads com chaves diferentes
+# quase nunca disputam o mesmo lock. Cada balde e (fichas, atualizado_em, cheio_em); um balde
+# cheio e igual a um que nao existe, entao os parados podem sair sem mudar nenhum limite
+class TokenBucketStore(RateLimitBackend):
+  def __init__(self, max_buckets, shards=16):
+    self.shards = [({}, threading.Lock()) for _ in range(shards)]
+    self.max_per_shard = max(1, max_buckets // shards)
+    self.evictions = 0
+
+  def take(self, key, capacity, period):
+    buckets, lock = self.shards[hash(key) % len(self.shards)]
+    rate = capacity / period
+    now = time.monotonic()
+    with lock:
+      bucket = buckets.get(key)
+      if bucket is None:
+        if len(buckets) >= self.max_per_shard:
+          self._evict(buckets, now)
+        tokens = capacity
+      else:
+        tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+      if tokens >= 1:
+        tokens -= 1
+        buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+        return 0
+      buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+      return (1 - tokens) / rate
+
+  def _evict(self, buckets, now):
+    # primeiro os baldes que ja reencheram; se nao bastar, os mais antigos do shard
+    idle = [key for key, bucket in buckets.items() if bucket[2] <= now]
+    if len(idle) < len(buckets) // 10:
+      idle += list(buckets)[:len(buckets) // 10 - len(idle)]
+    for key in idle:
+      buckets.pop(key, None)
+    self.evictions += len(idle)
+
+  def stats(self):
+    return {
+      "backend": "memory-token-bucket",
+      "buckets": sum(len(buckets) for buckets, _ in self.shards),
+      "max_buckets": self.max_per_shard * len(self.shards),
+      "evictions": self.evictions
+    }
+
+rate_limiter = None # um por processo, criado em init_process_state
+
+def rate_limit_rule(endpoint):
+  return current_app.config['RATELIMIT_RULES'].get(endpoint, current_app.config['RATELIMIT_DEFAULT'])
+
+def rate_limit_retry_after(endpoint, client):
+  # client: "u<id>" com usuario autenticado, senao "ip<endereco>". Devolve None ou os segundos de espera
+  rule = rate_limit_rule(endpoint)
+  if rule is None:
+    return None
+  wait = rate_limiter.take(f'{endpoint}:{client}', *rule)
+  return wait or None
+
+def too_many_requests(retry_after):
+  response = jsonify({"message": "Too many requests"})
+  response.status_code = 429
+  response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+  return response
+
+def client_key():
+  # quem faz a requisicao: o id da sessao do Flask-Login ou do token assinado, sem login o IP.
+  # Nao usa current_user: para quem tem cookie de sessao ele carrega o User (um SELECT) em toda
+  # requisicao, mesmo nas rotas que nem precisam do usuario. O token so tem a assinatura
+  # conferida; a versao (revogacao) fica para load_user_from_token nas rotas com login
+  user_id = session.get('_user_id')
+  if user_id is None:
+    payload = token_payload(request)
+    user_id = payload[0] if payload else None
+  return f'ip{request.remote_addr}' if user_id is None else f'u{user_id}'
+
+@routes.before_app_request
+def check_rate_limit():
+  if not current_app.config['RATELIMIT_ENABLED'] or request.endpoint is None:
+    return None
+  # cada processo tem os seus baldes: com N workers o limite efetivo e ate N vezes maior.
+  # RATELIMIT_RULES usa o nome da funcao da rota, sem o prefixo do blueprint ("api.")
+  retry_after = rate_limit_retry_after(request.endpoint.rpartition('.')[2], client_key())
+  if retry_after is not None:
+    return too_many_requests(retry_after)
+  return None
+
+# Pool de leitura
+# Rotas que so leem (@read_only) consultam o engine de leitura, e as leituras nao disputam conexoes
+# com as escritas. Read-your-writes: uma escrita com sucesso marca o cliente em recent_writers
+# por READ_YOUR_WRITES_SECONDS e, nesse tempo, as leituras dele voltam para o primario. Assim
+# quem acabou de gravar nunca le uma replica atrasada; os outros clientes podem ler
+recent_writers = None # cliente -> True, com TTL; um por processo, criado em init_process_state
+
+def read_engine():
+  if not current_app.config['READ_ROUTING_ENABLED']:
+    return None
+  return db.engines.get('read')
+
+def read_only(view):
+  @wraps(view)
+  def wrapper(*args, **kwargs):
+    engine = read_engine()
+    if engine is not None and recent_writers.get(client_key()) is None:
+      g.read_engine = engine
+    return view(*args, **kwargs)
+  return wrapper
+
+@routes.after_app_request
+def remember_writes(response):
+  if (request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400
+      and read_engine() is not None):
+    # a marca e deste processo: com varios workers a proxima leitura pode cair em outro
+    # (ver README); com o mesmo arquivo SQLite em WAL a leitura ja ve o commit de qualquer jeito
+    recent_writers.set(client_key(), True)
+  return response
+
+# Jobs em segundo plano
+# Outbox: a rota grava os jobs (enqueue_jobs) na mesma transacao da escrita, entao um job existe
+# se e so se a escrita foi confirmada, e a resposta sai sem esperar os efeitos colaterais.
+# Threads de cada processo (JobWorkers) pegam um lote dos jobs vencidos mais antigos com um UPDATE
+# que empurra o run_at para o fim da reserva (JOB_LEASE): outro worker, deste ou de outro processo,
+# so pega os mesmos jobs se este morrer no meio. Reservar e apagar em lote deixa o lock de escrita
+# do SQLite livre para as rotas. Sucesso apaga a linha; falha agenda de novo com
+# backoff exponencial e, depois de JOB_MAX_ATTEMPTS, deixa o job como 'dead'.
+# Um job pode rodar mais de uma vez (processo morto no meio), entao os handlers sao idempotentes
+job_handlers = {} # kind -> funcao(payload)
+
+def job_handler(kind):
+  def register(function):
+    job_handlers[kind] = function
+    return function
+  return register
+
+def enqueue_jobs(jobs):
+  # jobs: [(kind, payload)]. Vai na sessao da requisicao: quem chamou faz o commit e depois job_workers.notify()
+  now = time.time()
+  if has_request_context():
+    g.jobs_enqueued = True # numa rota @idempotent o commit de verdade vem depois (finish_idempotency_key)
+  db.session.execute(OutboxJob.__table__.insert(), [
+    {'kind': kind, 'payload': dumps_json(payload).decode(), 'status': 'pending', 'attempts': 0,
+     'run_at': now, 'created_at': now}
+    for kind, payload in jobs
+  ])
+
+def next_job_at():
+  # leitura sem lock de escrita: com a fila vazia os workers nao disputam o banco com as rotas
+  return db.session.execute(db.select(db.func.min(OutboxJob.run_at)).where(OutboxJob.status == 'pending')).scalar()
+
+def claim_jobs(now):
+  due = (
+    db.select(OutboxJob.id)
+    .where(OutboxJob.status == 'pending', OutboxJob.run_at <= now)
+    .order_by(OutboxJob.run_at, OutboxJob.id)
+    .limit(current_app.config['JOB_BATCH_SIZE'])
+  )
+  with db.engine.begin() as connection:
+    jobs = connection.execute(
+      db.update(OutboxJob)
+      .where(OutboxJob.id.in_(due))
+      .values(run_at=now + current_app.config['JOB_LEASE'], attempts=OutboxJob.attempts + 1)
+      .returning(OutboxJob.id, OutboxJob.kind, OutboxJob.payload, OutboxJob.attempts)
+    ).all()
+  return sorted(jobs, key=lambda job: job.id) # RETURNING nao garante a ordem
+
+def job_retry_delay(attempts):
+  # 2, 4, 8... segundos (ate JOB_RETRY_MAX_DELAY), com jitter para as falhas nao voltarem juntas
+  delay = current_app.config['JOB_RETRY_DELAY'] * 2 ** (attempts - 1)
+  return min(delay, current_app.config['JOB_RETRY_MAX_DELAY']) * random.uniform(0.5, 1.0)
+
+class JobWorkers:
+  def __init__(self, app, threads):
+    self.app = app # as threads rodam fora de requisicao, cada lote num app context desta app
+    self.threads = threads
+    self.wake = threading.Event()
+    self.stopping = threading.Event()
+    self.lock = threading.Lock()
+    self.running = []
+    self.processed = 0
+    self.retried = 0
+    self.dead = 0
+
+  def start(self):
+    # as threads sobem no warm_up ou no primeiro notify, nunca no import (flask shell, CLI)
+    with self.lock:
+      if self.running or self.stopping.is_set():
+        return
+      self.running = [
+        threading.Thread(target=self.loop, name=f'jobs-{number}', daemon=True) for number in range(self.threads)
+      ]
+    for thread in self.running:
+      thread.start()
+
+  def notify(self):
+    # chamado depois do commit que gravou jobs: um worker acorda sem esperar o JOB_POLL_INTERVAL
+    self.start()
+    self.wake.set()
+
+  def stop(self, timeout=None):
+    # espera os jobs em andamento; os que nem comecaram ficam na tabela
+    self.stopping.set()
+    self.wake.set()
+    for thread in self.running:
+      thread.join(timeout)
+
+  def loop(self):
+    while not self.stopping.is_set():
+      # limpa antes de procurar: um notify durante a busca faz o wait voltar na hora
+      self.wake.clear()
+      try:
+        with self.app.app_context():
+          delay = self.run_due_jobs()
+      except Exception:
+        self.app.logger.exception('job worker failed')
+        delay = self.app.config['JOB_POLL_INTERVAL']
+      self.wake.wait(delay)
+
+  def run_due_jobs(self):
+    # roda jobs ate nao sobrar nenhum vencido; devolve quanto esperar pelo proximo
+    while not self.stopping.is_set():
+      now = time.time()
+      run_at = next_job_at()
+      db.session.rollback() # solta a leitura antes de rodar o job
+      if run_at is None or run_at > now:
+        wait = current_app.config['JOB_POLL_INTERVAL']
+        return wait if run_at is None else min(wait, run_at - now)
+      done = [job.id for job in claim_jobs(now) if self.run_job(job)]
+      if done:
+        with db.engine.begin() as connection:
+          connection.execute(db.delete(OutboxJob).where(OutboxJob.id.in_(done)))
+        with self.lock:
+          self.processed += len(done)
+    return 0
+
+  def run_job(self, job):
+    # devolve True se o job terminou (quem chamou apaga a linha)
+    handler = job_handlers.get(job.kind)
+    try:
+      if handler is None:
+        raise LookupError(f'no handler for job kind {job.kind!r}')
+      handler(json.loads(job.payload))
+      db.session.commit()
+    except Exception as error:
+      db.session.rollback()
+      self.fail(job, error)
+      return False
+    return True
+
+  def fail(self, job, error):
+    dead = job.attempts >= current_app.config['JOB_MAX_ATTEMPTS']
+    now = time.time()
+    with db.engine.begin() as connection:
+      connection.execute(
+        db.update(OutboxJob)
+        .where(OutboxJob.id == job.id)
+        .values(
+          status='dead' if dead else 'pending',
+          run_at=now if dead else now + job_retry_delay(job.attempts),
+          last_error=f'{type(error).__name__}: {error}'[:1000],
+        )
+      )
+    with self.lock:
+      if dead:
+        self.dead += 1
+      else:
+        self.retried += 1
+    current_app.logger.warning(json.dumps({
+      'event': 'job_dead' if dead else 'job_retry',
+      'job_id': job.id,
+      'kind': job.kind,
+      'attempt': job.attempts,
+      'error': f'{type(error).__name__}: {error}'[:500],
+    }))
+
+  def stats(self):
+    with self.lock:
+      return {
+        "workers": len(self.running),
+        "processed": self.processed,
+        "retried": self.retried,
+        "dead_lettered": self.dead
+      }
+
+job_workers = None # um por processo, criado em init_process_state
+
+def stop_job_workers(timeout=None):
+  # encerramento do processo (worker_exit do gunicorn.conf.py, lifespan do asgi.py)
+  if job_workers is not None:
+    job_workers.stop(timeout)
+
+@routes.cli.command('requeue-jobs')
+@click.option('--kind', help='only jobs of this kind')
+def requeue_jobs(kind):
+  """Put dead jobs back in the queue with their attempts reset."""
+  query = db.update(OutboxJob).where(OutboxJob.status == 'dead')
+  if kind:
+    query = query.where(OutboxJob.kind == kind)
+  with db.engine.begin() as connection:
+    count = connection.execute(query.values(status='pending', attempts=0, run_at=time.time())).rowcount
+  print(f'{count} jobs requeued')
 
 # Autenticação
 @login_manager.user_loader # isso existe para ver qual usuario esta acessando a rota altenticada
 def load_user(user_id):
   return User.query.get(int(user_id))
 
+# Senhas
+# hashlib.scrypt/pbkdf2 soltam o GIL, entao o pool calcula varios hashes em paralelo
+# sem travar as threads que atendem requisicoes. O semaforo limita a fila: numa
+# avalanche de logins a API responde 503 rapido em vez de acumular trabalho
+# pool e semaforo sao criados em init_process_state (threads nao sobrevivem a um fork)
+password_pool = None
+password_slots = None
+# hash usado quando o usuario nao existe, para o tempo de resposta nao revelar isso
+dummy_password_hash = None
+
+class PasswordPoolBusy(Exception):
+  pass
+
+def run_password_job(function, *args):
+  if not password_slots.acquire(blocking=False):
+    raise PasswordPoolBusy()
+  try:
+    # a thread do pool nao tem o app context da requisicao (hash_password le a configuracao)
+    return password_pool.submit(run_in_app_context, current_app._get_current_object(), function, *args).result()
+  finally:
+    password_slots.release()
+
+def run_in_app_context(app, function, *args):
+  with app.app_context():
+    return function(*args)
+
+def is_password_hash(stored):
+  return stored.startswith(('scrypt:', 'pbkdf2:')) and stored.count('$') == 2
+
+def hash_password(password):
+  return generate_password_hash(password, method=current_app.config['PASSWORD_HASH_METHOD'])
+
+def check_password(stored, password):
+  # devolve (ok, hash novo ou None). Senha em texto puro (banco antigo) ou com outro custo
+  # e refeita com o metodo atual quando confere
+  if is_password_hash(stored):
+    ok = check_password_hash(stored, password)
+  else:
+    ok = hmac.compare_digest(stored.encode(), password.encode())
+  if ok and stored.split('$', 1)[0] != current_app.config['PASSWORD_HASH_PREFIX']:
+    return True, hash_password(password)
+  return ok, None
+
+def authenticate(data):
+  # confere usuario e senha; None se nao conferir. Pode levantar PasswordPoolBusy
+  global dummy_password_hash
+  username, password = data.get("username"), data.get("password")
+  if not isinstance(password, str):
+    return None
+  user = User.query.filter_by(username=username).first()
+  if user is None:
+    if dummy_password_hash is None:
+      dummy_password_hash = hash_password('dummy-password')
+    run_password_job(check_password, dummy_password_hash, password)
+    return None
+  ok, new_hash = run_password_job(check_password, user.password, password)
+  if not ok:
+    return None
+  if new_hash:
+    user.password = new_hash
+    try:
+      db.session.commit()
+    except OperationalError:
+      db.session.rollback() # fica para o proximo login
+  return user
+
+def password_pool_busy():
+  response = jsonify({"message": "Too many login attempts, try again"})
+  response.status_code = 503
+  response.headers['Retry-After'] = '1'
+  return response
+
+# Token assinado (HMAC com validade): carrega [user_id, token_version] e dispensa a sessao.
+# A rota confia no token sem buscar o usuario no banco; so a versao e conferida, com cache
+# (serializador e cache sao criados em init_process_state, com o SECRET_KEY e o TTL da configuracao)
+token_serializer = None
+# user_id -> token_version atual (-1 se o usuario foi apagado)
+token_version_cache = None
+
+# usuario vindo do token: so o id, que e o que as rotas usam (current_user.id)
+class TokenUser(UserMixin):
+  def __init__(self, user_id):
+    self.id = user_id
+
+def issue_token(user):
+  return token_serializer.dumps([user.id, user.token_version])
+
+def current_token_version(user_id):
+  version = token_version_cache.get(user_id)
+  if version is None:
+    version = db.session.execute(db.select(User.token_version).where(User.id == user_id)).scalar()
+    # usuario apagado vira -1 no cache, para nao consultar o banco a cada token dele
+    version = -1 if version is None else version
+    token_version_cache.set(user_id, version)
+  return version
+
+def revoke_tokens(user_id):
+  # chamado dentro da transacao da escrita; o commit fica com quem chamou
+  db.session.execute(db.update(User).where(User.id == user_id).values(token_version=User.token_version + 1))
+  token_version_cache.delete(user_id)
+
+def token_payload(request):
+  # [user_id, token_version] do token da requisicao se a assinatura e a validade conferem, senao None.
+  # Guardado em g: o rate limit e o login da mesma requisicao conferem o HMAC uma vez so
+  if 'token_payload' not in g:
+    g.token_payload = parse_token(request.headers.get('Authorization', ''))
+  return g.token_payload
+
+def parse_token(header):
+  # o valor do header Authorization ("Bearer <token>" ou so o token); tambem usado pelo asgi.py
+  token = header[7:] if header.startswith('Bearer ') else header
+  if token and current_app.config['AUTH_TOKENS_ENABLED']:
+    try:
+      user_id, version = token_serializer.loads(token, max_age=current_app.config['AUTH_TOKEN_MAX_AGE'])
+      return user_id, version
+    except (BadData, TypeError, ValueError):
+      pass
+  return None
+
+@login_manager.request_loader # usado quando a requisicao nao tem sessao
+def load_user_from_token(request):
+  payload = token_payload(request)
+  if payload is None:
+    return None
+  user_id, version = payload
+  if current_token_version(user_id) != version:
+    return None
+  return TokenUser(user_id)
+
 # Rotas/endpoint
-@application.route('/')
+@routes.route('/')
 def initial():
   """
   Check if the API is running
@@ -83,7 +1517,7 @@ def initial():
   return 'API up'
 
 #Rota de login
-@application.route('/login', methods=["POST"])
+@routes.route('/login', methods=["POST"])
 def login():
   """
   User login
@@ -124,17 +1558,22 @@ def login():
           message:
             type: string
             example: "Unauthorized. Invalid credentials"
+    429:
+      description: Too many login attempts. Retry after the Retry-After header
+    503:
+      description: Too many concurrent logins. Retry after the Retry-After header
   """
-  data = request.json
-  user = User.query.filter_by(username=data.get("username")).first()
-
-  if user and data.get("password") == user.password: # verifica a senha
+  try:
+    user = authenticate(request.json) # verifica a senha (hash) fora da thread da requisicao
+  except PasswordPoolBusy:
+    return password_pool_busy()
+  if user:
       login_user(user) # authentica o user
       return jsonify({"message": "Logged in successfully"})
   return jsonify({"message": "Unauthorized. Invalid credentials"}), 401
 
 #Rota de logout
-@application.route('/logout', methods=["POST"])
+@routes.route('/logout', methods=["POST"])
 @login_required
 def logout():
   """
@@ -165,8 +1604,99 @@ def logout():
   logout_user()
   return jsonify({"message": "Logout successfully"})
 
+# Rota para gerar token de acesso
+@routes.route('/api/token', methods=["POST"])
+def create_token():
+  """
+  Issue a signed access token
+  ---
+  tags:
+    - Authentication
+  parameters:
+    - name: body
+      in: body
+      required: true
+      schema:
+        type: object
+        required:
+          - username
+          - password
+        properties:
+          username:
+            type: string
+            description: User's unique username
+          password:
+            type: string
+            format: password
+            description: User's password
+  responses:
+    200:
+      description: Token issued. Send it as "Authorization Bearer token" instead of the session cookie
+      schema:
+        type: object
+        properties:
+          token:
+            type: string
+            example: "WzEsMF0.Zx4k2Q.c2lnbmF0dXJl"
+          expires_in:
+            type: integer
+            example: 3600
+    401:
+      description: Unauthorized. Invalid credentials
+      schema:
+        type: object
+        properties:
+          message:
+            type: string
+            example: "Unauthorized. Invalid credentials"
+    404:
+      description: Token authentication is disabled
+    429:
+      description: Too many login attempts. Retry after the Retry-After header
+    503:
+      description: Too many concurrent logins. Retry after the Retry-After header
+  """
+  if not current_app.config['AUTH_TOKENS_ENABLED']:
+    return jsonify({"message": "Token authentication is disabled"}), 404
+  try:
+    user = authenticate(request.json)
+  except PasswordPoolBusy:
+    return password_pool_busy()
+  if user:
+    return jsonify({"token": issue_token(user), "expires_in": current_app.config['AUTH_TOKEN_MAX_AGE']})
+  return jsonify({"message": "Unauthorized. Invalid credentials"}), 401
+
+# Rota para revogar os tokens do usuario
+@routes.route('/api/token/revoke', methods=["POST"])
+@login_required
+@retry_on_locked
+def revoke_token():
+  """
+  Revoke every access token of the logged in user
+  ---
+  tags:
+    - Authentication
+  security:
+    - ApiKeyAuth: []
+  responses:
+    200:
+      description: All tokens issued so far for this user stop working
+      schema:
+        type: object
+        properties:
+          message:
+            type: string
+            example: "Tokens revoked"
+    401:
+      description: Unauthorized. User must be logged in
+  """
+  revoke_tokens(current_user.id)
+  db.session.commit()
+  return jsonify({"message": "Tokens revoked"})
+
 # Rota para adicionar usuario
-@application.route('/api/user/add', methods=["POST"])
+@routes.route('/api/user/add', methods=["POST"])
+@retry_on_locked
 def add_user():
   """
   Add a new user
@@ -206,18 +1736,25 @@ def add_user():
           message:
             type: string
             example: "Invalid user data"
+    429:
+      description: Too many sign ups. Retry after the Retry-After header
   """  
   data = request.json
-  if 'username' in data and 'password' in data :
-    user = User(username=data["username"], password=data["password"]) 
+  if 'username' in data and isinstance(data.get('password'), str) :
+    try:
+      password = run_password_job(hash_password, data["password"])
+    except PasswordPoolBusy:
+      return password_pool_busy()
+    user = User(username=data["username"], password=password)
     db.session.add(user)
     db.session.commit()
     return jsonify({"message": "User added successfully"})
   return jsonify({"message": "Invalid user data"}), 400
 
 # Rota deletar usuario
-@application.route('/api/user/delete/<int:user_id>', methods=["DELETE"])
+@routes.route('/api/user/delete/<int:user_id>', methods=["DELETE"])
 @login_required 
+@retry_on_locked
 def delete_user(user_id):
   """
   Delete a user by ID
@@ -262,13 +1799,15 @@ def delete_user(user_id):
   if user and current_user.id == user_id :
     db.session.delete(user)
     db.session.commit()
+    token_version_cache.delete(user_id)
     return jsonify({"message": "User deleted successfully"})
   return jsonify({"message": "User not found"}), 404
 
 
 # Rota de atualizar usuarios
-@application.route('/api/user/update/<int:user_id>', methods=["PUT"])
+@routes.route('/api/user/update/<int:user_id>', methods=["PUT"])
 @login_required 
+@retry_on_locked
 def update_user(user_id):
   """
   Update user information
@@ -302,6 +1841,14 @@ def update_user(user_id):
           message:
             type: string
             example: "User updated successfully"
+    400:
+      description: Invalid user data
+      schema:
+        type: object
+        properties:
+          message:
+            type: string
+            example: "Invalid user data"
     404:
       description: User not found
       schema:
@@ -327,19 +1874,28 @@ def update_user(user_id):
   
   if user and current_user.id == user_id :
     data = request.json
+    if 'password' in data and not isinstance(data['password'], str):
+      return jsonify({"message": "Invalid user data"}), 400
     if 'username' in data:
       user.username = data['username']
     if 'password' in data:
-      user.password = data['password']
+      try:
+        user.password = run_password_job(hash_password, data['password'])
+      except PasswordPoolBusy:
+        return password_pool_busy()
+      user.token_version += 1 # trocar a senha derruba os tokens antigos
     db.session.commit()
+    token_version_cache.delete(user_id)
     return jsonify({'message': 'User updated successfully'})
   return jsonify({"message": "insufficient permission"}), 403
   
 
 # Rota para adicionar produto
 #description=data.get("description", "") ele adiciona o vazio "" como default, caso não venha nada no get
-@application.route('/api/products/add', methods=["POST"])
+@routes.route('/api/products/add', methods=["POST"])
 @login_required # exige senha nessa rota
+@idempotent
+@retry_on_locked
 def add_product():
   """
   Add a new product
@@ -349,6 +1905,11 @@ def add_product():
   security:
     - ApiKeyAuth: []
   parameters:
+    - name: Idempotency-Key
+      in: header
+      type: string
+      required: false
+      description: Unique key for this operation (up to 255 characters). Retries with the same key return the stored response (header Idempotent-Replayed) without running it again; a retry that arrives while the first request is still running waits for it. Reusing a key with a different request returns 422
     - name: body
       in: body
       required: true
@@ -368,6 +1929,9 @@ def add_product():
           description:
             type: string
             description: Optional product description
+          stock:
+            type: integer
+            description: Optional units available. Without it the stock is not tracked and checkout never runs out
   responses:
     200:
       description: Product added successfully
@@ -395,17 +1959,231 @@ def add_product():
             example: "Unauthorized. Please log in."
   """
   data = request.json
-  if 'name' in data and 'price' in data :
-    product = Product(name=data["name"], price=data["price"], description=data.get("description", "")) 
+  if 'name' in data and 'price' in data and is_valid_stock(data.get('stock')):
+    product = Product(name=data["name"], price=data["price"], description=data.get("description", ""), stock=data.get('stock'), version=bump_catalog_version()) 
     db.session.add(product)
     db.session.commit()
     return jsonify({"message": "Product added successfully"})
   return jsonify({"message": "Invalid product data"}), 400
 
 
+# Import em massa de produtos
+INVALID_JSON = object() # marca uma linha NDJSON que nao e JSON valido
+
+def read_ndjson(stream):
+  # um produto por linha; uma linha invalida vira erro so daquela linha.
+  # o BufferedReader evita uma leitura no stream do WSGI para cada linha
+  for line in io.BufferedReader(stream, 65536):
+    if line.strip():
+      try:
+        yield json.loads(line)
+      except ValueError:
+        yield INVALID_JSON
+
+def read_json_array(stream, chunk_size=65536):
+  # le um array JSON aos pedacos e devolve um item por vez, sem carregar o corpo inteiro
+  decoder = json.JSONDecoder()
+  text = codecs.getincrementaldecoder('utf-8')()
+  buffer, started, finished = '', False, False
+  while not finished:
+    chunk = stream.read(chunk_size)
+    buffer += text.decode(chunk, final=not chunk)
+    position = 0
+    while True:
+      while position < len(buffer) and buffer[position] in ' \t\r\n,':
+        position += 1
+      if position == len(buffer):
+        break
+      if not started:
+        if buffer[position] != '[':
+          raise ValueError('Expected a JSON array')
+        started = True
+        position += 1
+        continue
+      if buffer[position] == ']':
+        finished = True
+        break
+      try:
+        item, position = decoder.raw_decode(buffer, position)
+      except ValueError:
+        if not chunk:
+          raise
+        break # item cortado no meio, espera o proximo pedaco
+      yield item
+    buffer = buffer[position:]
+    if not chunk and not finished:
+      raise ValueError('Unexpected end of JSON array')
+
+def is_valid_stock(stock):
+  # None desliga o controle de estoque do produto
+  return stock is None or (isinstance(stock, int) and not isinstance(stock, bool) and stock >= 0)
+
+def validate_product_row(item):
+  # devolve (valores, None) ou (None, mensagem de erro)
+  if item is INVALID_JSON:
+    return None, 'Invalid JSON'
+  if not isinstance(item, dict):
+    return None, 'Row must be a JSON object'
+  name, price, description = item.get('name'), item.get('price'), item.get('description', '')
+  if not isinstance(name, str) or not name.strip() or len(name) > 120:
+    return None, 'name must be a non-empty string of up to 120 characters'
+  if isinstance(price, bool) or not isinstance(price, (int, float)) or price < 0:
+    return None, 'price must be a non-negative number'
+  if description is not None and not isinstance(description, str):
+    return None, 'description must be a string'
+  stock = item.get('stock')
+  if not is_valid_stock(stock):
+    return None, 'stock must be a non-negative integer or null'
+  values = {'name': name, 'price': float(price), 'description': description, 'stock': stock}
+  if 'id' in item:
+    product_id = item['id']
+    if isinstance(product_id, bool) or not isinstance(product_id, int) or not 1 <= product_id <= SQLITE_MAX_INTEGER:
+      return None, 'id must be a positive integer'
+    values['id'] = product_id
+    # campos opcionais que nao vieram na linha mantem o valor do produto existente (ver product_bulk_upsert);
+    # "stock": null explicito continua desligando o controle de estoque
+    values['keep_description'] = 'description' not in item
+    values['keep_stock'] = 'stock' not in item
+  return values, None
+
+def product_bulk_upsert():
+  # linhas com id: atualiza se existir, senao insere com esse id. description e stock so mudam
+  # se vieram na linha (parametros keep_description/keep_stock de cada linha do executemany)
+  statement = sqlite_insert(Product.__table__)
+  set_ = {column: statement.excluded[column] for column in ('name', 'price', 'version')}
+  for column in ('description', 'stock'):
+    set_[column] = db.case((db.bindparam(f'keep_{column}'), Product.__table__.c[column]), else_=statement.excluded[column])
+  return statement.on_conflict_do_update(index_elements=['id'], set_=set_)
+
+@routes.route('/api/products/bulk', methods=["POST"])
+@login_required # exige senha nessa rota
+def bulk_products():
+  """
+  Import or update many products in one request
+  ---
+  tags:
+    - Products
+  security:
+    - ApiKeyAuth: []
+  consumes:
+    - application/json
+    - application/x-ndjson
+  parameters:
+    - name: batch_size
+      in: query
+      type: integer
+      required: false
+      description: Rows written per executemany batch (default 5000)
+    - name: body
+      in: body
+      required: true
+      description: A JSON array of products, or one product per line when sent as application/x-ndjson. Rows with an id are upserted, rows without one are inserted. The whole body is read and validated before anything is written
+      schema:
+        type: array
+        items:
+          type: object
+          required:
+            - name
+            - price
+          properties:
+            id:
+              type: integer
+              description: Optional product ID. An existing product with this ID is updated; description and stock are only changed when present in the row
+            name:
+              type: string
+            price:
+              type: number
+              format: float
+            description:
+              type: string
+            stock:
+              type: integer
+              description: Units available. null means the stock is not tracked. When omitted, an updated product keeps its stock and a new one is not tracked
+  responses:
+    200:
+      description: Import finished. Invalid rows are skipped and listed in errors
+      schema:
+        type: object
+        properties:
+          rows:
+            type: integer
+            example: 3
+          inserted:
+            type: integer
+            example: 1
+          upserted:
+            type: integer
+            example: 1
+          error_count:
+            type: integer
+            example: 1
+          errors:
+            type: array
+            items:
+              type: object
+              properties:
+                row:
+                  type: integer
+                  example: 3
+                message:
+                  type: string
+                  example: "price must be a non-negative number"
+    400:
+      description: Invalid request body or parameters
+      schema:
+        type: object
+        properties:
+          message:
+            type: string
+            example: "Invalid JSON body"
+    401:
+      description: Unauthorized - Authentication required
+  """
+  batch_size = parse_int_arg('batch_size', current_app.config['PRODUCTS_BULK_BATCH_SIZE'], 1, 100000)
+  if batch_size is None:
+    return jsonify({"message": "Invalid query parameters"}), 400
+  max_errors = current_app.config['PRODUCTS_BULK_MAX_ERRORS']
+  if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+    items = read_ndjson(request.stream)
+  else:
+    items = read_json_array(request.stream)
+
+  # primeiro le e valida o corpo inteiro, fora de qualquer transacao: o lock de escrita do SQLite
+  # so e pego depois, entao um upload lento (ou parado) nao trava as outras escritas.
+  # As linhas validas ficam na memoria ate o fim da leitura
+  report = {'rows': 0, 'inserted': 0, 'upserted': 0, 'error_count': 0, 'errors': []}
+  inserts, upserts = [], []
+  try:
+    for number, item in enumerate(items, 1):
+      report['rows'] = number
+      values, error = validate_product_row(item)
+      if error:
+        report['error_count'] += 1
+        if len(report['errors']) < max_errors:
+          report['errors'].append({'row': number, 'message': error})
+        continue
+      (upserts if 'id' in values else inserts).append(values)
+  except ValueError:
+    return jsonify({"message": "Invalid JSON body"}), 400
+
+  # depois uma transacao curta: a versao do catalogo e os executemany, um commit (um fsync) no final
+  version = bump_catalog_version()
+  for statement, rows, counter in ((Product.__table__.insert(), inserts, 'inserted'),
+                                   (product_bulk_upsert(), upserts, 'upserted')):
+    for start in range(0, len(rows), batch_size):
+      batch = rows[start:start + batch_size]
+      for values in batch:
+        values['version'] = version
+      db.session.execute(statement, batch) # executemany
+      report[counter] += len(batch)
+  db.session.commit()
+  invalidate_all_products()
+  return jsonify(report)
+
 # Rota deletar produto
-@application.route('/api/products/delete/<int:product_id>', methods=["DELETE"])
+@routes.route('/api/products/delete/<int:product_id>', methods=["DELETE"])
 @login_required # exige senha nessa rota
+@retry_on_locked
 def delete_produto(product_id):
   """
   Delete a product by ID
@@ -456,12 +2234,15 @@ def delete_produto(product_id):
   """
   if product:
     db.session.delete(product)
+    bump_catalog_version()
     db.session.commit()
+    invalidate_product(product_id)
     return jsonify({"message": "Product deleted successfully"})
   return jsonify({"message": "Product not found"}), 404
 
 # Rota de recuperar detalhes do produto
-@application.route('/api/products/<int:product_id>', methods=["GET"])
+@routes.route('/api/products/<int:product_id>', methods=["GET"])
+@read_only
 def get_product_details(product_id):
   """
   Retrieve product details by ID
@@ -474,9 +2255,18 @@ def get_product_details(product_id):
       required: true
       type: integer
       description: The ID of the product to retrieve
+    - name: If-None-Match
+      in: header
+      type: string
+      required: false
+      description: ETag from a previous response. If it still matches, 304 is returned without a body
   responses:
     200:
       description: Product details retrieved successfully
+      headers:
+        ETag:
+          type: string
+          description: ETag of this product version (weak, W/"...", when the body is compressed)
       schema:
         type: object
         properties:
@@ -493,6 +2283,12 @@ def get_product_details(product_id):
           description:
             type: string
             example: "Latest model with advanced features"
+          stock:
+            type: integer
+            example: 25
+            description: Units available, null when stock is not tracked
+    304:
+      description: Not modified. The product still matches the If-None-Match ETag
     404:
       description: Product not found
       schema:
@@ -502,19 +2298,18 @@ def get_product_details(product_id):
             type: string
             example: "Product not found"
   """
-  product = Product.query.get(product_id)
-  if product:
-    return jsonify({
-      "id": product.id,
-      "name": product.name,
-      "price": product.price,
-      "description": product.description
-    })
-  return jsonify({"message": "Product not found"}), 404
+  entry = get_product_entry(product_id, request.if_none_match)
+  if entry is None:
+    return jsonify({"message": "Product not found"}), 404
+  etag, body = entry
+  if body is None:
+    return not_modified(etag)
+  return with_etag(json_response(body), etag)
 
 # Rota de atualizar produtos
-@application.route('/api/products/update/<int:product_id>', methods=["PUT"])
+@routes.route('/api/products/update/<int:product_id>', methods=["PUT"])
 @login_required # exige senha nessa rota
+@retry_on_locked
 def update_product(product_id):
   """
   Update an existing product by ID
@@ -543,6 +2338,10 @@ def update_product(product_id):
           description:
             type: string
             example: "Updated version with better battery life"
+          stock:
+            type: integer
+            example: 40
+            description: Units available. null stops tracking the stock of this product
   responses:
     200:
       description: Product updated successfully
@@ -552,6 +2351,14 @@ def update_product(product_id):
           message:
             type: string
             example: "Product updated successfully"
+    400:
+      description: Invalid product data
+      schema:
+        type: object
+        properties:
+          message:
+            type: string
+            example: "Invalid product data"
     404:
       description: Product not found
       schema:
@@ -566,6 +2373,9 @@ def update_product(product_id):
     return jsonify({"message": "Product not found"}), 404
   
   data = request.json
+  if 'stock' in data and not is_valid_stock(data['stock']):
+    return jsonify({"message": "Invalid product data"}), 400
+
   if 'name' in data:
     product.name = data['name']
   
@@ -574,21 +2384,235 @@ def update_product(product_id):
 
   if 'description' in data:
     product.description = data['description']
+
+  if 'stock' in data:
+    product.stock = data['stock']
   
+  product.version = bump_catalog_version()
   db.session.commit()
+  invalidate_product(product_id)
   return jsonify({'message': 'Product updated successfully'})
 
 # Listar produtos
-@application.route('/api/products', methods=["GET"])
+# Campos que podem ser pedidos com ?fields= (a ordem e a da resposta)
+PRODUCT_FIELDS = product_serializer.keys
+
+def parse_product_fields(raw):
+  # ?fields=name,price -> ('name', 'price'); sem parametro devolve todos os campos
+  if not raw:
+    return PRODUCT_FIELDS
+  fields = tuple(field.strip() for field in raw.split(',') if field.strip())
+  invalid = [field for field in fields if field not in PRODUCT_FIELDS]
+  if invalid or not fields:
+    return None
+  return fields
+
+SQLITE_MAX_INTEGER = 2 ** 63 - 1 # maior inteiro que o SQLite guarda; acima disso o bind levanta OverflowError
+
+class SQLiteIntegerConverter(IntegerConverter):
+  # o <int:...> das rotas: um id acima de SQLITE_MAX_INTEGER nao existe no banco, entao e 404 (e nao
+  # OverflowError no bind). O tamanho e conferido antes do int(): numeros enormes nem sao convertidos
+  def __init__(self, map, *args, **kwargs):
+    kwargs.setdefault('max', SQLITE_MAX_INTEGER)
+    super().__init__(map, *args, **kwargs)
+
+  def to_python(self, value):
+    if len(value.lstrip('0')) > len(str(SQLITE_MAX_INTEGER)):
+      raise ValidationError()
+    return super().to_python(value)
+
+def parse_int_arg(name, default, minimum=0, maximum=None, args=None):
+  # le um inteiro da query string (ou de args); None indica valor invalido
+  raw = (request.args if args is None else args).get(name)
+  if raw is None or raw == '':
+    return default
+  try:
+    value = int(raw)
+  except ValueError:
+    return None
+  if value < minimum or (maximum is not None and value > maximum):
+    return None
+  return value
+
+def parse_float_arg(name, args=None):
+  # le um numero da query string (ou de args); devolve (valor, ok)
+  raw = (request.args if args is None else args).get(name)
+  if raw is None or raw == '':
+    return None, True
+  try:
+    return float(raw), True
+  except ValueError:
+    return None, False
+
+def is_truthy(raw):
+  return (raw or '').lower() in ('1', 'true', 'yes', 'on')
+
+# ordenacoes aceitas em ?sort=; sempre desempata pelo id
+PRODUCT_SORT_KEYS = {'id': Product.id, 'price': Product.price, 'name': Product.name}
+
+def encode_cursor(value, product_id):
+  # cursor opaco (valor da ordenacao, id) para sort=price|name
+  return base64.urlsafe_b64encode(json.dumps([value, product_id]).encode()).decode()
+
+def decode_cursor(raw, sort):
+  # devolve (valor, id), None sem cursor, ou False se invalido
+  if not raw:
+    return None
+  try:
+    value, product_id = json.loads(base64.urlsafe_b64decode(raw.encode()))
+  except (TypeError, ValueError): # TypeError: JSON valido que nao e uma lista (ex. um numero)
+    return False
+  if sort == 'name':
+    valid_value = isinstance(value, str)
+  else:
+    valid_value = isinstance(value, float) or (isinstance(value, int) and not isinstance(value, bool)
+                                               and abs(value) <= SQLITE_MAX_INTEGER)
+  if (not valid_value or isinstance(product_id, bool) or not isinstance(product_id, int)
+      or abs(product_id) > SQLITE_MAX_INTEGER):
+    return False
+  return value, product_id
+
+def prefix_upper_bound(prefix):
+  # name_prefix vira um intervalo [prefixo, proximo) e usa o indice; LIKE 'x%' nao usaria.
+  # Caracteres U+10FFFF no fim nao tem proximo e saem; so com eles nao ha limite de cima (None).
+  # O proximo de U+D7FF pula os surrogates, que nao existem em UTF-8
+  while prefix:
+    following = ord(prefix[-1]) + 1
+    if following <= 0x10FFFF:
+      return prefix[:-1] + chr(0xE000 if 0xD800 <= following <= 0xDFFF else following)
+    prefix = prefix[:-1]
+  return None
+
+def build_product_listing(args):
+  # valida os parametros da listagem e monta o SELECT; None se algum for invalido.
+  # devolve (query, fields, skip, limit, sort): limit None e o modo stream, senao a query
+  # ja busca limit + 1 linhas para saber se existe proxima pagina (ver product_page)
+  fields = parse_product_fields(args.get('fields'))
+  sort = args.get('sort') or 'id'
+  if sort == 'id':
+    after = parse_int_arg('after', 0, maximum=SQLITE_MAX_INTEGER, args=args)
+  else:
+    after = decode_cursor(args.get('after'), sort)
+  stream = is_truthy(args.get('stream'))
+  max_page = current_app.config['PRODUCTS_MAX_PAGE_SIZE']
+  # no modo stream o limite e opcional, a memoria fica constante de qualquer jeito
+  limit = parse_int_arg('limit', None if stream else current_app.config['PRODUCTS_PAGE_SIZE'], 1, max_page, args)
+  min_price, min_ok = parse_float_arg('min_price', args)
+  max_price, max_ok = parse_float_arg('max_price', args)
+  name_prefix = args.get('name_prefix')
+  if (fields is None or sort not in PRODUCT_SORT_KEYS or (sort == 'id' and after is None) or after is False
+      or (limit is None and args.get('limit')) or not min_ok or not max_ok):
+    return None
+
+  # keyset: WHERE (chave, id) > (:valor, :id) ORDER BY chave, id, usa o indice e nao precisa de OFFSET.
+  # as colunas da chave sempre sao selecionadas porque formam o cursor
+  sort_column = PRODUCT_SORT_KEYS[sort]
+  key_columns = [Product.id] if sort == 'id' else [Product.id, sort_column]
+  columns = key_columns + product_serializer.columns(fields)
+  order_id, order_column = Product.id, sort_column
+  if sort != 'price' and not name_prefix and (min_price is not None or max_price is not None):
+    # filtro de preco com ordem por id/name: sem estatisticas o SQLite percorre a ordem inteira
+    # (tabela ou ix_product_name_id) testando o preco linha a linha. "+ 0" e "|| ''" nao mudam a
+    # ordem, mas tiram esses indices do plano: ele busca a faixa em ix_product_price_id e ordena
+    # so as linhas que passaram (TEMP B-TREE)
+    order_id = Product.id + 0
+    order_column = Product.name + '' if sort == 'name' else order_id
+  order = [order_id] if sort == 'id' else [order_column, order_id]
+  query = db.select(*columns).order_by(*order)
+  if sort == 'id':
+    query = query.where(order_id > after)
+  elif after:
+    query = query.where(db.tuple_(order_column, order_id) > db.tuple_(*after))
+  if min_price is not None:
+    query = query.where(Product.price >= min_price)
+  if max_price is not None:
+    query = query.where(Product.price <= max_price)
+  if name_prefix:
+    query = query.where(Product.name >= name_prefix)
+    upper_bound = prefix_upper_bound(name_prefix)
+    if upper_bound is not None:
+      query = query.where(Product.name < upper_bound)
+
+  skip = len(key_columns)
+  if stream:
+    return (query.limit(limit) if limit is not None else query), fields, skip, None, sort
+  return query.limit(limit + 1), fields, skip, limit, sort
+
+def product_page(rows, fields, skip, limit, sort):
+  # devolve (JSON da pagina, cursor da proxima pagina ou None)
+  has_next = len(rows) > limit
+  rows = rows[:limit]
+  cursor = None
+  if has_next:
+    last = rows[-1]
+    cursor = str(last[0]) if sort == 'id' else encode_cursor(last[1], last[0])
+  return product_serializer.dumps(rows, fields, skip), cursor
+
+@routes.route('/api/products', methods=["GET"])
+@read_only
 def get_products():
   """
-  Retrieve all products
+  Retrieve products (keyset paginated)
   ---
   tags:
     - Products
+  parameters:
+    - name: limit
+      in: query
+      type: integer
+      required: false
+      description: Maximum number of products per page (default 100, maximum 1000)
+    - name: after
+      in: query
+      type: string
+      required: false
+      description: Cursor. With sort=id, only products with an ID greater than this value are returned. With other sort keys, pass the X-Next-Cursor value of the previous page
+    - name: fields
+      in: query
+      type: string
+      required: false
+      description: Comma-separated list of fields to return (id, name, price, description, stock)
+    - name: stream
+      in: query
+      type: boolean
+      required: false
+      description: Stream the rows as a chunked JSON array. Without limit the whole catalog after the cursor is streamed
+    - name: min_price
+      in: query
+      type: number
+      required: false
+      description: Only products with price greater than or equal to this value
+    - name: max_price
+      in: query
+      type: number
+      required: false
+      description: Only products with price less than or equal to this value
+    - name: name_prefix
+      in: query
+      type: string
+      required: false
+      description: Only products whose name starts with this text (case-sensitive)
+    - name: sort
+      in: query
+      type: string
+      enum: [id, price, name]
+      required: false
+      description: Sort key (default id). Ties are ordered by ID
+    - name: If-None-Match
+      in: header
+      type: string
+      required: false
+      description: ETag from a previous response. If the catalog did not change, 304 is returned without a body
   responses:
     200:
-      description: A list of all available products
+      description: A page of products ordered by ID. The X-Next-Cursor header holds the value for the next "after" when more products exist
+      headers:
+        X-Next-Cursor:
+          type: string
+          description: Cursor for the next page (absent on the last page and in stream mode)
+        ETag:
+          type: string
+          description: ETag of the catalog version for these query parameters (weak, W/"...", when the body is compressed)
       schema:
         type: array
         items:
@@ -607,23 +2631,278 @@ def get_products():
             description:
               type: string
               example: "Noise-canceling wireless headphones with 20 hours of battery life"
+            stock:
+              type: integer
+              example: 25
+              description: Units available, null when stock is not tracked
+    304:
+      description: Not modified. The catalog did not change since the If-None-Match ETag
+    400:
+      description: Invalid query parameters
+      schema:
+        type: object
+        properties:
+          message:
+            type: string
+            example: "Invalid query parameters"
   """
-  products = Product.query.all() # retorna todos os produtos cadastrados com o .all()
-  product_list = []
-  for product in products: # for para percorrer os produtos
-    product_data = {
-      "id": product.id,
-      "name": product.name,
-      "price": product.price,
-      "description": product.description
-    }
-    product_list.append(product_data)
-  return jsonify(product_list)
+  listing = build_product_listing(request.args)
+  if listing is None:
+    return jsonify({"message": "Invalid query parameters"}), 400
+  query, fields, skip, limit, sort = listing
+
+  # a versao e lida antes das linhas: se uma escrita cair no meio, o ETag fica velho (o cliente so baixa de novo)
+  etag = catalog_etag(current_catalog_version())
+  if request.if_none_match.contains_weak(etag):
+    return not_modified(etag)
+
+  if limit is None:
+    return with_etag(json_response(stream_with_context(stream_product_rows(query, fields, skip))), etag)
+
+  body, cursor = product_page(db.session.execute(query).all(), fields, skip, limit, sort)
+  response = json_response(body)
+  if cursor:
+    response.headers['X-Next-Cursor'] = cursor
+  return with_etag(response, etag)
+
+def stream_product_rows(query, fields, skip):
+  # gera o array JSON aos pedacos, buscando as linhas em lotes (yield_per)
+  result = db.session.execute(query.execution_options(yield_per=current_app.config['PRODUCTS_STREAM_BATCH']))
+  row_to_dict = product_serializer.compile(fields, skip)
+  yield b'['
+  first = True
+  for row in result:
+    chunk = dumps_json(row_to_dict(row))
+    yield chunk if first else b',' + chunk
+    first = False
+  yield b']'
+
+# Busca de produtos
+def build_search_query(raw):
+  # cada palavra vira um termo com prefixo ("fone"*), todos obrigatorios.
+  # so letras/numeros entram, entao o usuario nao consegue mandar sintaxe FTS5
+  terms = re.findall(r'\w+', raw or '')
+  return ' '.join(f'"{term}"*' for term in terms)
+
+def parse_search_cursor(raw):
+  # cursor "rank:id" da ultima linha da pagina anterior
+  if not raw:
+    return None, None
+  try:
+    rank, product_id = raw.rsplit(':', 1)
+    rank, product_id = float(rank), int(product_id)
+  except ValueError:
+    return None, False
+  if abs(product_id) > SQLITE_MAX_INTEGER:
+    return None, False
+  return rank, product_id
+
+@routes.route('/api/products/search', methods=["GET"])
+@read_only
+def search_products():
+  """
+  Full-text search over product name and description
+  ---
+  tags:
+    - Products
+  parameters:
+    - name: q
+      in: query
+      type: string
+      required: true
+      description: Search words. Every word must match, as a prefix, in the name or description
+    - name: limit
+      in: query
+      type: integer
+      required: false
+      description: Maximum number of products per page (default 100, maximum 1000)
+    - name: after
+      in: query
+      type: string
+      required: false
+      description: Cursor from the X-Next-Cursor header of the previous page
+  responses:
+    200:
+      description: Matching products, best matches first (BM25, name weighs more than description)
+      headers:
+        X-Next-Cursor:
+          type: string
+          description: Cursor for the next page (absent on the last page)
+      schema:
+        type: array
+        items:
+          type: object
+          properties:
+            id:
+              type: integer
+              example: 1
+            name:
+              type: string
+              example: "Wireless Headphones"
+            price:
+              type: number
+              format: float
+              example: 149.99
+            description:
+              type: string
+              example: "Noise-canceling wireless headphones with 20 hours of battery life"
+            stock:
+              type: integer
+              example: 25
+              description: Units available, null when stock is not tracked
+    400:
+      description: Invalid query parameters
+      schema:
+        type: object
+        properties:
+          message:
+            type: string
+            example: "Invalid query parameters"
+  """
+  query = build_search_query(request.args.get('q'))
+  limit = parse_int_arg('limit', current_app.config['PRODUCTS_PAGE_SIZE'], 1, current_app.config['PRODUCTS_MAX_PAGE_SIZE'])
+  after_rank, after_id = parse_search_cursor(request.args.get('after'))
+  if not query or limit is None or after_id is False:
+    return jsonify({"message": "Invalid query parameters"}), 400
+
+  # keyset sobre (rank, id): so o FTS e consultado para achar a pagina, depois o JOIN busca as colunas
+  keyset = ''
+  params = {'query': query, 'limit': limit + 1}
+  if after_id is not None:
+    keyset = 'AND (rank > :rank OR (rank = :rank AND rowid > :id))'
+    params.update(rank=after_rank, id=after_id)
+  # as colunas seguem a ordem do product_serializer (id, name, price, description, stock)
+  rows = db.session.execute(db.text(
+    'SELECT product.id, product.name, product.price, product.description, product.stock, hits.rank '
+    'FROM (SELECT rowid, rank FROM product_fts WHERE product_fts MATCH :query ' + keyset +
+    ' ORDER BY rank, rowid LIMIT :limit) AS hits '
+    'JOIN product ON product.id = hits.rowid ORDER BY hits.rank, hits.rowid'
+  ), params).all()
+  has_next = len(rows) > limit
+  rows = rows[:limit]
+  response = json_response(product_serializer.dumps(rows))
+  if has_next:
+    response.headers['X-Next-Cursor'] = f'{rows[-1].rank!r}:{rows[-1].id}'
+  return response
+
+# Estatisticas do cache de produtos (monitoramento)
+@routes.route('/api/cache/stats', methods=["GET"])
+def cache_stats():
+  """
+  Product cache statistics
+  ---
+  tags:
+    - Monitoring
+  responses:
+    200:
+      description: Hit, miss and eviction counters of the product details cache
+      schema:
+        type: object
+        properties:
+          backend:
+            type: string
+            example: "memory-lru"
+          entries:
+            type: integer
+            example: 120
+          max_entries:
+            type: integer
+            example: 10000
+          ttl:
+            type: integer
+            example: 300
+          hits:
+            type: integer
+            example: 5400
+          misses:
+            type: integer
+            example: 130
+          evictions:
+            type: integer
+            example: 0
+          expirations:
+            type: integer
+            example: 10
+  """
+  return jsonify(product_cache.stats())
+
+# Estatisticas da fila de jobs (monitoramento)
+@routes.route('/api/jobs/stats', methods=["GET"])
+def jobs_stats():
+  """
+  Background job queue statistics
+  ---
+  tags:
+    - Monitoring
+  responses:
+    200:
+      description: Jobs waiting and dead in the outbox table, and the counters of this process's workers
+      schema:
+        type: object
+        properties:
+          pending:
+            type: integer
+            example: 3
+          dead:
+            type: integer
+            example: 0
+          oldest_pending_seconds:
+            type: number
+            format: float
+            example: 0.4
+            description: Age of the oldest job still waiting, null when the queue is empty
+          workers:
+            type: integer
+            example: 2
+          processed:
+            type: integer
+            example: 1500
+          retried:
+            type: integer
+            example: 4
+          dead_lettered:
+            type: integer
+            example: 0
+  """
+  counts = dict(db.session.execute(
+    db.select(OutboxJob.status, db.func.count()).group_by(OutboxJob.status)
+  ).all())
+  oldest = db.session.execute(
+    db.select(db.func.min(OutboxJob.created_at)).where(OutboxJob.status == 'pending')
+  ).scalar()
+  return jsonify({
+    "pending": counts.get('pending', 0),
+    "dead": counts.get('dead', 0),
+    "oldest_pending_seconds": None if oldest is None else round(time.time() - oldest, 3),
+    **job_workers.stats()
+  })
+
+# Metricas por rota no formato do Prometheus
+@routes.route('/metrics', methods=["GET"])
+def metrics():
+  """
+  Request metrics in Prometheus text format
+  ---
+  tags:
+    - Monitoring
+  produces:
+    - text/plain
+  responses:
+    200:
+      description: Latency histogram, SQL statement count and SQL time per route, method and status
+    404:
+      description: Metrics are disabled
+  """
+  if not current_app.config['METRICS_ENABLED']:
+    return jsonify({"message": "Metrics are disabled"}), 404
+  return Response(request_metrics.render(), mimetype='text/plain; version=0.0.4')
 
 # Checkout / cart
 # Rota adicionar item ao carrinho
-@application.route('/api/cart/add/<int:product_id>', methods=['POST'])
+@routes.route('/api/cart/add/<int:product_id>', methods=['POST'])
 @login_required
+@idempotent
+@retry_on_locked
 def add_to_cart(product_id):
   """
   Add a product to the user's cart
@@ -636,6 +2915,16 @@ def add_to_cart(product_id):
       type: integer
       required: true
       description: The ID of the product to be added to the cart
+    - name: quantity
+      in: query
+      type: integer
+      required: false
+      description: How many units to add (default 1). The line can hold at most 10000 units
+    - name: Idempotency-Key
+      in: header
+      type: string
+      required: false
+      description: Unique key for this operation (up to 255 characters). Retries with the same key return the stored response (header Idempotent-Replayed) without running it again; a retry that arrives while the first request is still running waits for it. Reusing a key with a different request returns 422
   responses:
     200:
       description: Item added to the cart successfully
@@ -646,7 +2935,7 @@ def add_to_cart(product_id):
             type: string
             example: "Item added to the cart successfully"
     400:
-      description: Failed to add item to the cart
+      description: Failed to add item to the cart (product not found, or the line would exceed 10000 units)
       schema:
         type: object
         properties:
@@ -656,22 +2945,44 @@ def add_to_cart(product_id):
   security:
     - ApiKeyAuth: []
   """
-  # tenho q ter Usuario e o produto, caso contrario tenho q parar
-  # Usuario
-  user = User.query.get(int(current_user.id))
-  # Produto
-  product = Product.query.get(product_id)
-
-  if user and product:
-    cart_item = CartItem(user_id=user.id, product_id= product.id)
-    db.session.add(cart_item)
+  quantity = parse_int_arg('quantity', 1, 1, current_app.config['CART_MAX_QUANTITY'])
+  if quantity is None:
+    return jsonify({'message': 'Failed to add item to the cart'}), 400
+  # o usuario ja vem do current_user; o produto e conferido dentro do proprio INSERT ... SELECT
+  if upsert_cart_item(current_user.id, product_id, quantity):
     db.session.commit()
     return jsonify({'message': 'Item added to the cart successfully'})
+  db.session.rollback()
   return jsonify({'message': 'Failed to add item to the cart'}), 400
 
+def upsert_cart_item(user_id, product_id, quantity):
+  # INSERT ... SELECT FROM product ... ON CONFLICT DO UPDATE: um comando so, atomico.
+  # se o produto nao existe o SELECT nao devolve linha e nada e inserido; se a soma passar
+  # de CART_MAX_QUANTITY o WHERE do DO UPDATE nao deixa mudar a linha
+  source = db.select(db.literal(user_id), Product.id, db.literal(quantity)).where(Product.id == product_id)
+  statement = sqlite_insert(CartItem).from_select(['user_id', 'product_id', 'quantity'], source)
+  statement = statement.on_conflict_do_update(
+    index_elements=['user_id', 'product_id'],
+    set_={'quantity': CartItem.quantity + statement.excluded.quantity},
+    where=CartItem.quantity + statement.excluded.quantity <= current_app.config['CART_MAX_QUANTITY']
+  )
+  return db.session.execute(statement).rowcount > 0
+
+def decrement_cart_item(user_id, product_id, quantity):
+  # tira unidades da linha; se a quantidade chegar a zero a linha e apagada
+  where = (CartItem.user_id == user_id) & (CartItem.product_id == product_id)
+  updated = db.session.execute(
+    db.update(CartItem).where(where, CartItem.quantity > quantity)
+    .values(quantity=CartItem.quantity - quantity)
+  ).rowcount
+  if updated:
+    return True
+  return db.session.execute(db.delete(CartItem).where(where)).rowcount > 0
+
 # Rota para DELETAR item ao carrinho
-@application.route('/api/cart/remove/<int:product_id>', methods=['DELETE'])
+@routes.route('/api/cart/remove/<int:product_id>', methods=['DELETE'])
 @login_required
+@retry_on_locked
 def remove_from_cart(product_id):
   """
   Remove a product from the user's cart
@@ -684,6 +2995,11 @@ def remove_from_cart(product_id):
       type: integer
       required: true
       description: The ID of the product to be removed from the cart
+    - name: quantity
+      in: query
+      type: integer
+      required: false
+      description: How many units to remove (default 1, maximum 10000). The line is removed when its quantity reaches zero
   responses:
     200:
       description: Item removed from the cart successfully
@@ -704,26 +3020,32 @@ def remove_from_cart(product_id):
   security:
     - ApiKeyAuth: []
   """
-  # procurar o item do carrinho com essas duas informações que ja tenho Produto, Usuario = Item carrinho
-  cart_item = CartItem.query.filter_by(user_id=current_user.id, product_id=product_id).first() # se não achar ele vai ficar como nulo
-  if cart_item:
-    db.session.delete(cart_item)
+  quantity = parse_int_arg('quantity', 1, 1, current_app.config['CART_MAX_QUANTITY'])
+  if quantity is not None and decrement_cart_item(current_user.id, product_id, quantity):
     db.session.commit()
     return jsonify({'message': 'Item removed from the cart successfully'})
+  db.session.rollback()
   return jsonify({'message': 'Failed to remove item from the cart'}), 400
 
 # Ver todos os itens no carinho 
-@application.route('/api/cart', methods=['GET'])
+@routes.route('/api/cart', methods=['GET'])
 @login_required
+@read_only
 def view_cart():
   """
   Retrieve the user's shopping cart
   ---
   tags:
     - Cart
+  parameters:
+    - name: aggregate
+      in: query
+      type: boolean
+      required: false
+      description: Group the cart by product and return quantities, line totals and the cart subtotal
   responses:
     200:
-      description: A list of items in the user's cart
+      description: A list of items in the user's cart. With aggregate=true an object with items (product_id, product_name, product_price, quantity, line_total), total_quantity and subtotal is returned instead
       schema:
         type: array
         items:
@@ -750,6 +3072,10 @@ def view_cart():
               format: float
               example: 99.99
               description: Price of the product
+            quantity:
+              type: integer
+              example: 2
+              description: Units of the product in the cart
     401:
       description: Unauthorized. User must be logged in
       schema:
@@ -761,39 +3087,281 @@ def view_cart():
   security:
     - ApiKeyAuth: []
   """
-  # Usuario
-  user = User.query.get(int(current_user.id))
-  cart_items = user.cart # gera uma lista
-  cart_content = []
-  for cart_item in cart_items:
-    product = Product.query.get(cart_item.product_id)
-    cart_content.append( {
-                          "id": cart_item.id,
-                          "user_id": cart_item.user_id,
-                          "product_id": cart_item.product_id,
-                          "product_name": product.name,
-                          "product_price": product.price
-                        })
-  return jsonify(cart_content)
+  # uma unica consulta com JOIN em vez de um Product.query.get por item (N+1)
+  if is_truthy(request.args.get('aggregate')):
+    return jsonify(cart_summary(current_user.id))
+
+  rows = db.session.execute(
+    db.select(*cart_item_serializer.columns())
+    .join(Product, Product.id == CartItem.product_id)
+    .where(CartItem.user_id == current_user.id)
+    .order_by(CartItem.id)
+  ).all()
+  return json_response(cart_item_serializer.dumps(rows))
+
+def cart_summary(user_id):
+  # agrupa no SQL: quantidade e total por produto, e o subtotal do carrinho via window function
+  quantity = db.func.sum(CartItem.quantity)
+  line_total = quantity * Product.price
+  rows = db.session.execute(
+    db.select(
+      Product.id, Product.name, Product.price,
+      quantity.label('quantity'),
+      line_total.label('line_total'),
+      db.func.sum(quantity).over().label('total_quantity'),
+      db.func.sum(line_total).over().label('subtotal'),
+    )
+    .join(CartItem, CartItem.product_id == Product.id)
+    .where(CartItem.user_id == user_id)
+    .group_by(Product.id)
+    .order_by(Product.id)
+  ).all()
+  items = [{
+            "product_id": row.id,
+            "product_name": row.name,
+            "product_price": row.price,
+            "quantity": row.quantity,
+            "line_total": row.line_total
+          } for row in rows]
+  return {
+    "items": items,
+    "total_quantity": rows[0].total_quantity if rows else 0,
+    "subtotal": rows[0].subtotal if rows else 0
+  }
+
+# Varias mudancas no carrinho numa requisicao so
+@routes.route('/api/cart/batch', methods=['POST'])
+@login_required
+@idempotent
+@retry_on_locked
+def cart_batch():
+  """
+  Add, remove or set many cart lines in one request
+  ---
+  tags:
+    - Cart
+  parameters:
+    - name: Idempotency-Key
+      in: header
+      type: string
+      required: false
+      description: Unique key for this operation (up to 255 characters). Retries with the same key return the stored response (header Idempotent-Replayed) without running it again; a retry that arrives while the first request is still running waits for it. Reusing a key with a different request returns 422
+    - name: body
+      in: body
+      required: true
+      description: Operations applied in order, all in one transaction. If any operation is invalid nothing is changed
+      schema:
+        type: object
+        required:
+          - operations
+        properties:
+          operations:
+            type: array
+            items:
+              type: object
+              required:
+                - op
+                - product_id
+              properties:
+                op:
+                  type: string
+                  enum: [add, remove, set]
+                  description: add and remove change the quantity (remove deletes the line when it reaches zero); set replaces it (0 deletes the line)
+                product_id:
+                  type: integer
+                  example: 5
+                quantity:
+                  type: integer
+                  example: 2
+                  description: Units to add, remove or set (default 1 for add and remove, maximum 10000). A line can hold at most 10000 units
+  responses:
+    200:
+      description: Cart updated. The resulting cart is returned, grouped by product
+      schema:
+        type: object
+        properties:
+          message:
+            type: string
+            example: "Cart updated successfully"
+          items:
+            type: array
+            items:
+              type: object
+              properties:
+                product_id:
+                  type: integer
+                  example: 5
+                product_name:
+                  type: string
+                  example: "Wireless Headphones"
+                product_price:
+                  type: number
+                  format: float
+                  example: 99.99
+                quantity:
+                  type: integer
+                  example: 2
+                line_total:
+                  type: number
+                  format: float
+                  example: 199.98
+          total_quantity:
+            type: integer
+            example: 2
+          subtotal:
+            type: number
+            format: float
+            example: 199.98
+    400:
+      description: Invalid operations. Nothing was changed
+      schema:
+        type: object
+        properties:
+          message:
+            type: string
+            example: "Invalid cart operations"
+          errors:
+            type: array
+            items:
+              type: object
+              properties:
+                index:
+                  type: integer
+                  example: 0
+                message:
+                  type: string
+                  example: "Product not found"
+  security:
+    - ApiKeyAuth: []
+  """
+  data = request.get_json(silent=True)
+  operations = data.get('operations') if isinstance(data, dict) else None
+  if not isinstance(operations, list) or not operations or len(operations) > current_app.config['CART_BATCH_MAX_OPERATIONS']:
+    return jsonify({"message": "Invalid cart operations"}), 400
+
+  errors = []
+  for index, operation in enumerate(operations):
+    error = validate_cart_operation(operation)
+    if error:
+      errors.append({"index": index, "message": error})
+  if errors:
+    return jsonify({"message": "Invalid cart operations", "errors": errors}), 400
+
+  # o primeiro comando e uma escrita: o lock de escrita do SQLite fica com esta transacao ate o
+  # commit, entao nenhuma outra escrita muda o carrinho entre a leitura abaixo e o upsert (que
+  # grava valores absolutos). Um escritor concorrente faz esperar e, no limite, cai no retry_on_locked
+  lock_cart(current_user.id)
+  # uma consulta para todos os produtos: se existem e quanto ja tem no carrinho
+  product_ids = {operation['product_id'] for operation in operations}
+  rows = db.session.execute(
+    db.select(Product.id, CartItem.quantity)
+    .outerjoin(CartItem, (CartItem.product_id == Product.id) & (CartItem.user_id == current_user.id))
+    .where(Product.id.in_(product_ids))
+  ).all()
+  existing = {row.id for row in rows}
+  current = {row.id: row.quantity for row in rows if row.quantity is not None}
+
+  # aplica as operacoes em ordem na memoria; o banco so recebe o resultado final
+  quantities = dict(current)
+  max_quantity = current_app.config['CART_MAX_QUANTITY']
+  for index, operation in enumerate(operations):
+    product_id, op = operation['product_id'], operation['op']
+    quantity = operation.get('quantity', 1)
+    if product_id not in existing:
+      errors.append({"index": index, "message": "Product not found"})
+    elif op == 'add' and quantities.get(product_id, 0) + quantity > max_quantity:
+      errors.append({"index": index, "message": f"Cart line can not exceed {max_quantity} units"})
+    elif op == 'add':
+      quantities[product_id] = quantities.get(product_id, 0) + quantity
+    elif op == 'set':
+      quantities[product_id] = quantity
+    elif quantities.get(product_id, 0) == 0:
+      errors.append({"index": index, "message": "Product is not in the cart"})
+    else:
+      quantities[product_id] = max(0, quantities[product_id] - quantity)
+  if errors:
+    db.session.rollback()
+    return jsonify({"message": "Invalid cart operations", "errors": errors}), 400
+
+  # um executemany para as linhas que mudaram e um DELETE para as que zeraram, um commit so
+  upserts = [
+    {'user_id': current_user.id, 'product_id': product_id, 'quantity': quantity}
+    for product_id, quantity in quantities.items() if quantity and quantity != current.get(product_id)
+  ]
+  deletes = [product_id for product_id, quantity in quantities.items() if not quantity and product_id in current]
+  if upserts:
+    statement = sqlite_insert(CartItem)
+    db.session.execute(
+      statement.on_conflict_do_update(index_elements=['user_id', 'product_id'], set_={'quantity': statement.excluded.quantity}),
+      upserts
+    )
+  if deletes:
+    db.session.execute(db.delete(CartItem).where(CartItem.user_id == current_user.id, CartItem.product_id.in_(deletes)))
+  summary = cart_summary(current_user.id)
+  db.session.commit()
+  return jsonify({"message": "Cart updated successfully", **summary})
+
+def lock_cart(user_id):
+  # UPDATE que nao muda nada: so abre a transacao de escrita (pysqlite so manda BEGIN antes de DML)
+  db.session.execute(
+    db.update(CartItem).where(CartItem.user_id == user_id).values(quantity=CartItem.quantity)
+    .execution_options(synchronize_session=False)
+  )
+
+def validate_cart_operation(operation):
+  # devolve a mensagem de erro, ou None se a operacao e valida
+  if not isinstance(operation, dict):
+    return 'Operation must be a JSON object'
+  if operation.get('op') not in ('add', 'remove', 'set'):
+    return 'op must be add, remove or set'
+  product_id = operation.get('product_id')
+  if isinstance(product_id, bool) or not isinstance(product_id, int) or not 1 <= product_id <= SQLITE_MAX_INTEGER:
+    return 'product_id must be a positive integer'
+  if 'quantity' not in operation and operation['op'] == 'set':
+    return 'quantity is required for set'
+  quantity = operation.get('quantity', 1)
+  minimum = 0 if operation['op'] == 'set' else 1
+  maximum = current_app.config['CART_MAX_QUANTITY']
+  if isinstance(quantity, bool) or not isinstance(quantity, int) or not minimum <= quantity <= maximum:
+    return f'quantity must be an integer between {minimum} and {maximum}'
+  return None
 
 # Rota de checkout
-@application.route('/api/cart/checkout', methods=["POST"])
+checkout_lock = None # um por processo, criado em init_process_state
+@routes.route('/api/cart/checkout', methods=["POST"])
 @login_required
+@idempotent
+@retry_on_locked
 def checkout():
   """
-  Checkout and clear the user's shopping cart
+  Checkout, reserve the stock, record an order and clear the user's shopping cart
   ---
   tags:
     - Cart
+  parameters:
+    - name: Idempotency-Key
+      in: header
+      type: string
+      required: false
+      description: Unique key for this operation (up to 255 characters). Retries with the same key return the stored response (header Idempotent-Replayed) without running it again; a retry that arrives while the first request is still running waits for it. Reusing a key with a different request returns 422
   responses:
     200:
-      description: Checkout completed successfully. Cart has been cleared.
+      description: Checkout completed successfully. An order was recorded and the cart has been cleared. With an empty cart nothing is recorded and only the message is returned
       schema:
         type: object
         properties:
           message:
             type: string
             example: "Checkout successful. Cart has been cleared."
+          order_id:
+            type: integer
+            example: 1
+            description: Absent when the cart was empty
+          total:
+            type: number
+            format: float
+            example: 249.98
+            description: Absent when the cart was empty
     401:
       description: Unauthorized. User must be logged in.
       schema:
@@ -802,18 +3370,296 @@ def checkout():
           message:
             type: string
             example: "Unauthorized. No active session"
+    409:
+      description: Some lines could not be reserved. Nothing was charged, no stock was taken and the cart is unchanged
+      schema:
+        type: object
+        properties:
+          message:
+            type: string
+            example: "Insufficient stock"
+          lines:
+            type: array
+            items:
+              type: object
+              properties:
+                product_id:
+                  type: integer
+                  example: 5
+                requested:
+                  type: integer
+                  example: 3
+                available:
+                  type: integer
+                  example: 1
+                  description: Units left, null when the product no longer exists
+                message:
+                  type: string
+                  example: "Insufficient stock"
   security:
     - ApiKeyAuth: []
   """
-  user = User.query.get(int(current_user.id))
-  cart_items = user.cart
-  for cart_item in cart_items:
-    db.session.delete(cart_item)
-  db.session.commit()
-  return jsonify({'message': 'Checkout successful. Cart has been cleared.'})
+  # tudo numa transacao: a reserva do estoque e o primeiro comando (um UPDATE so), entao o lock
+  # de escrita do SQLite e pego logo e solto no commit. Se alguma linha falhar nada e gravado.
+  # checkout_lock enfileira os checkouts do processo: o proximo entra assim que o anterior faz
+  # commit, em vez de esperar as pausas do busy_timeout do SQLite
+  with checkout_lock:
+    reserved, failures = reserve_stock(current_user.id)
+    if failures:
+      db.session.rollback()
+      return jsonify({'message': 'Insufficient stock', 'lines': failures}), 409
+    order = place_order(current_user.id)
+    if order is None:
+      # carrinho vazio: mesma resposta de antes dos pedidos, sem gravar um pedido vazio
+      db.session.rollback()
+      return jsonify({'message': 'Checkout successful. Cart has been cleared.'})
+    # os efeitos colaterais entram na fila no mesmo commit do pedido e rodam depois da resposta
+    enqueue_jobs([(kind, {'order_id': order['order_id']}) for kind in CHECKOUT_JOBS])
+    db.session.commit()
+  job_workers.notify()
+  for product_id in reserved:
+    invalidate_product(product_id)
+  return jsonify({'message': 'Checkout successful. Cart has been cleared.', **order})
+
+def reserve_stock(user_id):
+  # baixa o estoque de todas as linhas do carrinho com um UPDATE condicional so:
+  #   UPDATE product SET stock = stock - <quantidade> WHERE id IN (carrinho) AND stock >= <quantidade>
+  # a condicao e conferida pelo SQLite na propria escrita, entao duas compras nunca vendem a mesma unidade.
+  # Produto sem controle (stock NULL) sempre passa e continua NULL.
+  # devolve (ids com estoque baixado, falhas por linha); com falhas quem chamou desfaz tudo
+  cart = (CartItem.user_id == user_id)
+  quantity = (
+    db.select(CartItem.quantity)
+    .where(cart, CartItem.product_id == Product.id)
+    .scalar_subquery()
+  )
+  # o produto recebe a versao que o catalogo vai ter (bump_catalog_version logo abaixo)
+  next_version = db.select(CatalogVersion.version + 1).where(CatalogVersion.id == 1).scalar_subquery()
+  rows = db.session.execute(
+    db.update(Product)
+    .where(Product.id.in_(db.select(CartItem.product_id).where(cart)))
+    .where(db.or_(Product.stock.is_(None), Product.stock >= quantity))
+    .values(
+      stock=Product.stock - quantity,
+      version=db.case((Product.stock.is_(None), Product.version), else_=next_version),
+    )
+    .returning(Product.id, Product.stock)
+    .execution_options(synchronize_session=False)
+  ).all()
+  # linhas que o UPDATE nao pegou: estoque insuficiente ou produto apagado
+  failed = db.session.execute(
+    db.select(CartItem.product_id, CartItem.quantity, Product.stock, Product.id)
+    .outerjoin(Product, Product.id == CartItem.product_id)
+    .where(cart, CartItem.product_id.not_in([row.id for row in rows]))
+    .order_by(CartItem.product_id)
+  ).all()
+  failures = [{
+                "product_id": line.product_id,
+                "requested": line.quantity,
+                "available": line.stock,
+                "message": "Insufficient stock" if line.id is not None else "Product not found"
+              } for line in failed]
+  reserved = [row.id for row in rows if row.stock is not None]
+  if reserved and not failures:
+    bump_catalog_version()
+  return reserved, failures
+
+def place_order(user_id):
+  # grava Order + OrderLine a partir do carrinho (INSERT ... SELECT) e limpa o carrinho com um DELETE.
+  # devolve None se o carrinho estiver vazio; o commit fica com quem chamou
+  cart = (CartItem.user_id == user_id)
+  total = (
+    db.select(db.func.sum(Product.price * CartItem.quantity))
+    .select_from(CartItem)
+    .join(Product, Product.id == CartItem.product_id)
+    .where(cart)
+    .scalar_subquery()
+  )
+  order = db.session.execute(
+    db.insert(Order)
+    .from_select(['user_id', 'total'], db.select(db.literal(user_id), total).where(total.isnot(None)))
+    .returning(Order.id, Order.total)
+  ).first()
+  if order is None:
+    return None
+  order_id = order.id
+  db.session.execute(
+    db.insert(OrderLine).from_select(
+      ['order_id', 'product_id', 'product_name', 'unit_price', 'quantity'],
+      db.select(db.literal(order_id), Product.id, Product.name, Product.price, CartItem.quantity)
+      .join(Product, Product.id == CartItem.product_id)
+      .where(cart)
+    )
+  )
+  db.session.execute(db.delete(CartItem).where(cart))
+  return {'order_id': order_id, 'total': order.total}
+
+# Efeitos colaterais do checkout (fila de jobs). Por enquanto cada um gera o registro e o manda
+# para o log da aplicacao; o envio de verdade (email, analytics, ERP) entra no lugar do log
+CHECKOUT_JOBS = ('order_confirmation', 'analytics_event', 'stock_sync')
+
+def order_with_lines(order_id):
+  order = db.session.get(Order, order_id)
+  if order is None:
+    return None, []
+  lines = db.session.execute(
+    db.select(OrderLine.product_id, OrderLine.product_name, OrderLine.unit_price, OrderLine.quantity)
+    .where(OrderLine.order_id == order_id)
+    .order_by(OrderLine.id)
+  ).all()
+  return order, lines
+
+@job_handler('order_confirmation')
+def send_order_confirmation(payload):
+  order, lines = order_with_lines(payload['order_id'])
+  if order is None:
+    return
+  username = db.session.execute(db.select(User.username).where(User.id == order.user_id)).scalar()
+  current_app.logger.info(json.dumps({
+    'event': 'order_confirmation',
+    'order_id': order.id,
+    'username': username,
+    'total': order.total,
+    'created_at': order.created_at.isoformat(),
+    'lines': [{'product': line.product_name, 'unit_price': line.unit_price, 'quantity': line.quantity} for line in lines],
+  }))
+
+@job_handler('analytics_event')
+def send_checkout_analytics(payload):
+  # event_id fixo por pedido: quem recebe descarta o repetido se o job rodar duas vezes
+  order, lines = order_with_lines(payload['order_id'])
+  if order is None:
+    return
+  current_app.logger.info(json.dumps({
+    'event': 'checkout',
+    'event_id': f'checkout-{order.id}',
+    'user_id': order.user_id,
+    'total': order.total,
+    'items': sum(line.quantity for line in lines),
+    'products': [line.product_id for line in lines],
+  }))
+
+@job_handler('stock_sync')
+def sync_order_stock(payload):
+  # manda o estoque atual (nao o delta), entao repetir e seguro
+  products = [line.product_id for line in order_with_lines(payload['order_id'])[1]]
+  rows = db.session.execute(
+    db.select(Product.id, Product.stock).where(Product.id.in_(products), Product.stock.isnot(None))
+  ).all()
+  if rows:
+    current_app.logger.info(json.dumps({
+      'event': 'stock_sync',
+      'stock': {str(row.id): row.stock for row in rows},
+    }))
+
+# Fabrica da aplicacao
+# create_app(config) cria uma app nova: configuracao padrao (lida do ambiente) mais `config`,
+# extensoes, rotas do blueprint e documentacao. O import do modulo nao cria app nenhuma; quem
+# serve chama a fabrica: flask --app application (acha o create_app sozinho), gunicorn
+# "application:create_app()", ou create_app({'SQLALCHEMY_DATABASE_URI': ...}) nos testes.
+# Caches, pools e filas sao do processo (init_process_state) e seguem a configuracao da ultima app criada
+process_apps = weakref.WeakSet() # apps deste processo, para o hook de fork descartar os pools herdados
+
+def init_process_state(app):
+  # tudo que nao pode ser dividido entre processos: threads, locks e caches em memoria
+  global product_cache, request_metrics, password_pool, password_slots, token_serializer, token_version_cache
+  global checkout_lock, idempotency_lock, idempotency_in_flight, compressed_cache, rate_limiter, job_workers
+  global recent_writers
+  config = app.config
+  product_cache = LRUCache(config['PRODUCT_CACHE_SIZE'], config['PRODUCT_CACHE_TTL'])
+  request_metrics = RequestMetrics(config['METRICS_BUCKETS'])
+  password_pool = ThreadPoolExecutor(config['PASSWORD_HASH_WORKERS'], thread_name_prefix='password')
+  password_slots = threading.BoundedSemaphore(config['PASSWORD_HASH_WORKERS'] + config['PASSWORD_HASH_QUEUE'])
+  token_serializer = URLSafeTimedSerializer(
+    config['SECRET_KEY'], salt='api-token', signer_kwargs={'digest_method': hashlib.sha256}
+  )
+  token_version_cache = LRUCache(10000, config['AUTH_TOKEN_VERSION_TTL'])
+  checkout_lock = threading.Lock()
+  idempotency_lock = threading.Lock()
+  idempotency_in_flight = {}
+  rate_limiter = TokenBucketStore(config['RATELIMIT_MAX_BUCKETS'])
+  compressed_cache = LRUCache(config['COMPRESSION_CACHE_SIZE'], config['PRODUCT_CACHE_TTL'])
+  job_workers = JobWorkers(app, config['JOB_WORKERS'])
+  recent_writers = LRUCache(100000, config['READ_YOUR_WRITES_SECONDS'])
+
+def create_app(config=None):
+  app = Flask(__name__)
+  configure_defaults(app)
+  app.config.update(config or {})
+  if app.config['DB_PROFILE'] not in SQLITE_PROFILES:
+    raise ValueError(f"Unknown DB_PROFILE {app.config['DB_PROFILE']!r}, use one of {sorted(SQLITE_PROFILES)}")
+  if app.config['SWAGGER_MODE'] not in ('flasgger', 'static', 'off'):
+    raise ValueError(f"Unknown SWAGGER_MODE {app.config['SWAGGER_MODE']!r}, use flasgger, static or off")
+  app.config['SQLITE_PRAGMAS'] = SQLITE_PROFILES[app.config['DB_PROFILE']]
+  # prefixo que o werkzeug grava para o metodo configurado ("scrypt" vira "scrypt:32768:8:1"):
+  # check_password compara com ele. Um metodo invalido falha aqui, e nao no primeiro login
+  app.config['PASSWORD_HASH_PREFIX'] = generate_password_hash('', method=app.config['PASSWORD_HASH_METHOD']).split('$', 1)[0]
+  if not app.config['PASSWORD_HASH_PREFIX'].startswith(('scrypt:', 'pbkdf2:')):
+    raise ValueError(f"Unknown PASSWORD_HASH_METHOD {app.config['PASSWORD_HASH_METHOD']!r}, use scrypt or pbkdf2")
+  if 'SQLALCHEMY_ENGINE_OPTIONS' not in (config or {}):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config, app.config['SQLALCHEMY_DATABASE_URI'])
+  if 'SQLALCHEMY_BINDS' not in (config or {}):
+    # bind 'read': o pool de leitura. Nenhum modelo usa esse bind, entao create_all nao mexe nele
+    read_uri = app.config['DATABASE_READ_URI'] or read_only_uri(app.config['SQLALCHEMY_DATABASE_URI'])
+    app.config['SQLALCHEMY_BINDS'] = {}
+    if app.config['READ_ROUTING_ENABLED'] and read_uri:
+      app.config['SQLALCHEMY_BINDS']['read'] = {
+        'url': read_uri, **engine_options(app.config, read_uri, app.config['DB_READ_POOL_SIZE'])
+      }
+
+  db.init_app(app)
+  with app.app_context():
+    for engine in db.engines.values():
+      apply_sqlite_pragmas(engine, app.config['SQLITE_PRAGMAS'])
+  login_manager.init_app(app)
+  CORS(app)
+  app.url_map.converters['int'] = SQLiteIntegerConverter # antes das rotas, que usam <int:...>
+  app.register_blueprint(routes)
+  init_docs(app)
+  init_process_state(app)
+  process_apps.add(app)
+  return app
+
+def after_fork_in_child():
+  # o filho herda as conexoes abertas do pool do pai, threads que nao existem mais nele
+  # e locks que podiam estar presos. dispose(close=False) esquece as conexoes sem fecha-las
+  # (o pai continua usando); cada processo abre as suas
+  apps = list(process_apps)
+  for app in apps:
+    with app.app_context():
+      for engine in db.engines.values():
+        engine.dispose(close=False)
+  if apps:
+    init_process_state(apps[-1])
+
+os.register_at_fork(after_in_child=after_fork_in_child)
+
+def warm_up(app, products=1000):
+  # roda em cada worker antes de aceitar conexoes: a primeira requisicao nao paga a abertura
+  # das conexoes (com os PRAGMAs), o cache de produtos vazio nem o hash do usuario inexistente
+  global dummy_password_hash
+  with app.app_context():
+    # o primario primeiro: ele deixa o banco em WAL antes das conexoes read-only abrirem
+    connections = [db.engine.connect() for _ in range(app.config['SQLALCHEMY_ENGINE_OPTIONS'].get('pool_size', 1))]
+    if read_engine() is not None:
+      connections += [read_engine().connect() for _ in range(read_engine().pool.size())]
+    for connection in connections:
+      connection.exec_driver_sql('SELECT 1')
+      connection.close() # volta aberta para o pool
+    if products and db.inspect(db.engine).has_table('product'):
+      rows = db.session.execute(
+        db.select(*product_serializer.columns(), Product.version).order_by(Product.id).limit(products)
+      ).all()
+      for row in rows:
+        product_cache.set(row.id, (product_etag(row.id, row.version), product_serializer.dumps_one(row)))
+    db.session.remove()
+    if dummy_password_hash is None:
+      dummy_password_hash = hash_password('dummy-password')
+  # jobs deixados na fila por um processo anterior comecam a rodar ja
+  job_workers.start()
 
 if __name__ == "__main__":
-  application.run(debug=True)
+  create_app().run(debug=True)
 
 #db.session.commit()
 # session e a conecção com o banco
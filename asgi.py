@@ -0,0 +1,249 @@
+# Versao ASGI das leituras quentes de produto: GET /api/products e GET /api/products/<id>
+# rodam no engine assincrono do SQLAlchemy (aiosqlite). Uma leitura esperando o banco nao
+# prende uma thread, entao o mesmo processo atende muito mais leituras simultaneas.
+# Validacao, queries, serializadores, cache de produtos, ETags, metricas e limite de
+# requisicoes sao os do application.py, entao as respostas sao as mesmas. As outras rotas seguem para o Flask
+# pelo adaptador WSGI (em threads), sem mudanca nenhuma.
+# precisa de: pip install aiosqlite asgiref uvicorn
+# uso: uvicorn asgi:app --host 0.0.0.0 --port 5000 --workers 4
+import asyncio
+import math
+import re
+import time
+from urllib.parse import parse_qsl
+
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.datastructures import MultiDict
+from itsdangerous import BadSignature
+from werkzeug.http import parse_accept_header, parse_cookie, parse_etags, quote_etag
+
+import application as api
+from application import db
+
+# a app Flask deste processo: atende as outras rotas e da a configuracao (e o app context) das rotas daqui
+application = api.create_app()
+
+PRODUCT_DETAILS_PATH = re.compile(r'/api/products/(\d+)')
+product_id_converter = api.SQLiteIntegerConverter(application.url_map) # o mesmo <int:product_id> da rota do Flask
+
+def async_database_url():
+  # mesmo arquivo do engine do Flask (que ja resolveu caminhos relativos para instance/)
+  with application.app_context():
+    url = db.engine.url
+  if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+    raise ValueError('asgi.py needs a SQLite file database (an in-memory one would not be shared with Flask)')
+  return url.set(drivername='sqlite+aiosqlite')
+
+engine = create_async_engine(async_database_url(), **application.config['SQLALCHEMY_ENGINE_OPTIONS'])
+event.listen(engine.sync_engine, 'connect',
+             lambda dbapi_connection, connection_record: api.set_sqlite_pragmas(dbapi_connection, application.config['SQLITE_PRAGMAS']))
+
+flask_app = WsgiToAsgi(application)
+
+# Respostas
+def header(scope, name):
+  for key, value in scope['headers']:
+    if key == name:
+      return value.decode('latin-1')
+  return None
+
+def response_headers(scope, etag=None, content_type='application/json', encoding=None):
+  headers = [(b'content-type', content_type.encode())] if content_type else []
+  if etag is not None:
+    # com compressao o ETag e fraco, como no compress_response do Flask
+    headers += [(b'etag', quote_etag(etag, weak=encoding is not None).encode()), (b'cache-control', b'no-cache')]
+  if application.config['COMPRESSION_ENABLED']:
+    headers.append((b'vary', b'Accept-Encoding'))
+  if header(scope, b'origin') is not None:
+    headers.append((b'access-control-allow-origin', b'*')) # igual ao flask_cors com a configuracao padrao
+  return headers
+
+def negotiate_encoding(scope):
+  if not application.config['COMPRESSION_ENABLED']:
+    return None
+  return api.choose_encoding(parse_accept_header(header(scope, b'accept-encoding')))
+
+def compress(scope, body, etag=None):
+  # devolve (encoding ou None, corpo): mesmo limite de tamanho e cache do Flask
+  encoding = negotiate_encoding(scope)
+  if encoding is None or len(body) < application.config['COMPRESSION_MIN_SIZE']:
+    return None, body
+  return encoding, api.compressed_body(body, encoding, etag)
+
+def encoded_headers(scope, etag, encoding):
+  headers = response_headers(scope, etag, encoding=encoding)
+  if encoding is not None:
+    headers.append((b'content-encoding', encoding.encode()))
+  return headers
+
+def session_user_id(scope):
+  # o _user_id do cookie de sessao do Flask (Flask-Login), lido como o SecureCookieSessionInterface le
+  cookie = parse_cookie(header(scope, b'cookie')).get(application.config['SESSION_COOKIE_NAME'])
+  serializer = application.session_interface.get_signing_serializer(application)
+  if not cookie or serializer is None:
+    return None
+  try:
+    data = serializer.loads(cookie, max_age=int(application.permanent_session_lifetime.total_seconds()))
+  except BadSignature:
+    return None
+  return data.get('_user_id') if isinstance(data, dict) else None
+
+def client_key(scope):
+  # a mesma chave do client_key do Flask: o usuario da sessao ou do token, sem login o IP
+  user_id = session_user_id(scope)
+  if user_id is None:
+    payload = api.parse_token(header(scope, b'authorization') or '')
+    user_id = payload[0] if payload else None
+  if user_id is not None:
+    return f'u{user_id}'
+  client = scope.get('client')
+  return f"ip{client[0] if client else None}"
+
+def rate_limited(scope, endpoint):
+  # mesmos baldes do check_rate_limit do Flask
+  if not application.config['RATELIMIT_ENABLED']:
+    return None
+  return api.rate_limit_retry_after(endpoint, client_key(scope))
+
+async def too_many_requests(scope, send, route, retry_after):
+  headers = response_headers(scope) + [(b'retry-after', str(max(1, math.ceil(retry_after))).encode())]
+  body = api.dumps_json({"message": "Too many requests"})
+  await respond(send, 429, finish(scope, route, 429, api.QueryStats(), headers), body)
+
+async def respond(send, status, headers, body=b''):
+  headers = headers + [(b'content-length', str(len(body)).encode())]
+  await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+  await send({'type': 'http.response.body', 'body': body})
+
+async def run_query(stats, connection, query):
+  # mesma conta do before/after_cursor_execute do Flask (que so vale dentro de requisicao do Flask)
+  started = time.perf_counter()
+  result = await connection.execute(query)
+  elapsed = time.perf_counter() - started
+  stats.count += 1
+  stats.duration += elapsed
+  if elapsed > stats.slowest:
+    stats.slowest = elapsed
+    stats.slowest_statement = query # o SQL so vira texto se a requisicao for para o log de lentas
+  return result
+
+def finish(scope, route, status, stats, headers):
+  server_timing = api.finish_request_metrics('GET', scope['path'], route, status, stats)
+  if server_timing:
+    headers.append((b'server-timing', server_timing.encode()))
+  return headers
+
+# Rotas
+async def product_details(scope, send, product_id):
+  route = '/api/products/<int:product_id>'
+  retry_after = rate_limited(scope, 'get_product_details')
+  if retry_after is not None:
+    return await too_many_requests(scope, send, route, retry_after)
+  stats = api.QueryStats()
+  if_none_match = parse_etags(header(scope, b'if-none-match'))
+  entry = api.product_cache.get(product_id)
+  async with engine.connect() as connection:
+    if entry is not None:
+      # mesma conferencia do get_product_entry: o acerto so vale se a versao do banco e a mesma
+      version = (await run_query(stats, connection, api.product_version_query(product_id))).scalar()
+      entry = api.fresh_product_entry(product_id, entry, version, if_none_match)
+    if entry is None:
+      generation = api.product_cache_generation
+      row = (await run_query(stats, connection, api.product_details_query(product_id))).first()
+      entry = api.product_entry_from_row(product_id, row, generation, if_none_match)
+  if entry is None:
+    body = api.dumps_json({"message": "Product not found"})
+    return await respond(send, 404, finish(scope, route, 404, stats, response_headers(scope)), body)
+  etag, body = entry
+  if body is None:
+    headers = response_headers(scope, etag, None, negotiate_encoding(scope))
+    return await respond(send, 304, finish(scope, route, 304, stats, headers))
+  encoding, body = compress(scope, body, etag)
+  await respond(send, 200, finish(scope, route, 200, stats, encoded_headers(scope, etag, encoding)), body)
+
+async def product_listing(scope, send):
+  route = '/api/products'
+  retry_after = rate_limited(scope, 'get_products')
+  if retry_after is not None:
+    return await too_many_requests(scope, send, route, retry_after)
+  stats = api.QueryStats()
+  args = MultiDict(parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True))
+  listing = api.build_product_listing(args)
+  if listing is None:
+    body = api.dumps_json({"message": "Invalid query parameters"})
+    return await respond(send, 400, finish(scope, route, 400, stats, response_headers(scope)), body)
+  query, fields, skip, limit, sort = listing
+
+  async with engine.connect() as connection:
+    # a versao e lida antes das linhas, como na rota do Flask
+    version = (await run_query(stats, connection, api.catalog_version_query())).scalar() or 0
+    etag = api.catalog_etag(version, scope['query_string'])
+    if parse_etags(header(scope, b'if-none-match')).contains_weak(etag):
+      headers = response_headers(scope, etag, None, negotiate_encoding(scope))
+      return await respond(send, 304, finish(scope, route, 304, stats, headers))
+
+    if limit is None:
+      # stream: um pedaco do array JSON por lote do yield_per, com a conexao aberta ate o fim
+      encoding = negotiate_encoding(scope)
+      if encoding:
+        compress_chunk, finish_stream = api.stream_compressor(encoding)
+      else:
+        compress_chunk, finish_stream = (lambda chunk: chunk), (lambda: b'')
+      headers = finish(scope, route, 200, stats, encoded_headers(scope, etag, encoding))
+      await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+      result = await connection.stream(query.execution_options(yield_per=application.config['PRODUCTS_STREAM_BATCH']))
+      row_to_dict = api.product_serializer.compile(fields, skip)
+      separator = b'['
+      async for rows in result.partitions():
+        chunk = b','.join(api.dumps_json(row_to_dict(row)) for row in rows)
+        await send({'type': 'http.response.body', 'body': compress_chunk(separator + chunk), 'more_body': True})
+        separator = b','
+      end = compress_chunk(b'[]' if separator == b'[' else b']') + finish_stream()
+      await send({'type': 'http.response.body', 'body': end})
+      return
+
+    rows = (await run_query(stats, connection, query)).all()
+  body, cursor = api.product_page(rows, fields, skip, limit, sort)
+  encoding, body = compress(scope, body, etag)
+  headers = encoded_headers(scope, etag, encoding)
+  if cursor:
+    headers.append((b'x-next-cursor', cursor.encode()))
+  await respond(send, 200, finish(scope, route, 200, stats, headers), body)
+
+async def lifespan(receive, send):
+  while True:
+    message = await receive()
+    if message['type'] == 'lifespan.startup':
+      # aquece os dois lados: pool do Flask e cache de produtos, e as conexoes do engine assincrono
+      api.warm_up(application)
+      async def open_connection():
+        async with engine.connect() as connection:
+          await connection.exec_driver_sql('SELECT 1')
+      await asyncio.gather(*(open_connection() for _ in range(application.config['SQLALCHEMY_ENGINE_OPTIONS'].get('pool_size', 1))))
+      await send({'type': 'lifespan.startup.complete'})
+    elif message['type'] == 'lifespan.shutdown':
+      await engine.dispose()
+      await asyncio.get_running_loop().run_in_executor(None, api.stop_job_workers, 30)
+      await send({'type': 'lifespan.shutdown.complete'})
+      return
+
+async def app(scope, receive, send):
+  if scope['type'] == 'lifespan':
+    return await lifespan(receive, send)
+  if scope['type'] == 'http' and scope['method'] == 'GET':
+    # as funcoes do application.py leem a configuracao do current_app
+    if scope['path'] == '/api/products':
+      with application.app_context():
+        return await product_listing(scope, send)
+    match = PRODUCT_DETAILS_PATH.fullmatch(scope['path'])
+    if match:
+      try:
+        product_id = product_id_converter.to_python(match.group(1))
+      except api.ValidationError:
+        product_id = None # fora do intervalo do SQLite: o Flask responde o mesmo 404 das outras rotas
+      if product_id is not None:
+        with application.app_context():
+          return await product_details(scope, send, product_id)
+  await flask_app(scope, receive, send)
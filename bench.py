@@ -0,0 +1,374 @@
+# Benchmark / teste de carga de todas as rotas da API
+# Monta um banco SQLite com N usuarios, M produtos e K linhas de carrinho e chama cada
+# rota pelo test client do Flask e por um servidor WSGI local (threads + HTTP de verdade).
+# Mostra p50/p95/p99, vazao e consultas SQL por requisicao, e grava tudo em JSON para
+# comparar entre commits (--compare devolve codigo 1 se algo piorou alem do limite)
+# uso: python bench.py [--users 100] [--products 10000] [--cart-lines 1000] [--requests 200]
+#                      [--mode client|server|both] [--concurrency 8] [--route products]
+#                      [--output bench.json] [--compare baseline.json]
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# banco em arquivo (e nao em memoria) para medir com o perfil do SQLite de producao
+if 'DATABASE_URI' not in os.environ:
+  os.environ['DATABASE_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='bench-'), 'bench.db')
+# teste de carga nao e abuso: sem limite de requisicoes (tambem vale para os servidores que os benchmarks sobem)
+os.environ.setdefault('RATELIMIT_ENABLED', '0')
+
+from sqlalchemy import event
+from werkzeug.serving import make_server
+
+from application import create_app, db, User, Product, CartItem, hash_password, issue_token, upsert_cart_item
+
+application = create_app()
+
+PASSWORD = 'secret'
+WORDS = ['wireless', 'headphones', 'keyboard', 'mouse', 'monitor', 'cable', 'charger', 'speaker',
+         'camera', 'laptop', 'tablet', 'phone', 'watch', 'router', 'printer', 'microphone']
+
+# Contador de consultas: toda instrucao que passa pelo engine, em qualquer thread menos as da
+# fila de jobs (efeitos colaterais rodam depois da resposta e nao sao custo da requisicao)
+class QueryCounter:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.count = 0
+
+  def __call__(self, *args):
+    if threading.current_thread().name.startswith('jobs-'):
+      return
+    with self.lock:
+      self.count += 1
+
+query_counter = QueryCounter()
+
+def percentile(values, fraction):
+  ordered = sorted(values)
+  return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+# Dados
+def seed(users, products, cart_lines):
+  db.drop_all()
+  db.create_all()
+  password = hash_password(PASSWORD) # um hash so: o custo do seed nao depende de N
+  db.session.execute(User.__table__.insert(), [
+    {'username': f'bench{number}', 'password': password} for number in range(users)
+  ])
+  rng = random.Random(0)
+  db.session.execute(Product.__table__.insert(), [
+    {'name': f'{rng.choice(WORDS)} {rng.choice(WORDS)} {number}', 'price': round(rng.uniform(1, 1000), 2),
+     'description': ' '.join(rng.choice(WORDS) for _ in range(12))}
+    for number in range(products)
+  ])
+  # linha j vai para o usuario j % N com o produto j // N: nunca repete (usuario, produto)
+  db.session.execute(CartItem.__table__.insert(), [
+    {'user_id': line % users + 1, 'product_id': line // users % products + 1, 'quantity': 1}
+    for line in range(cart_lines)
+  ])
+  db.session.commit()
+  return password
+
+def new_user(prefix, password, cart=()):
+  # usuario descartavel com token proprio, para rotas que apagam ou revogam
+  user = User(username=f'{prefix}-{random.getrandbits(64):x}', password=password)
+  db.session.add(user)
+  db.session.flush()
+  for product_id in cart:
+    db.session.add(CartItem(user_id=user.id, product_id=product_id, quantity=1))
+  return user
+
+def bearer(token):
+  return {'Authorization': f'Bearer {token}'}
+
+# Cenarios: um por rota (ou variante). setup(i) roda antes da medicao, fora do tempo,
+# e devolve o que a requisicao i precisa; request(i, data) -> (metodo, caminho, corpo, headers)
+def build_scenarios(options, state):
+  products, users = options.products, options.users
+  reader, writer = bearer(state['reader_token']), bearer(state['writer_token'])
+  lines_per_cart = max(1, options.cart_lines // users)
+  rng = random.Random(1)
+
+  def product_id(i):
+    return rng.randint(1, products)
+
+  def json_body(value):
+    return json.dumps(value).encode(), 'application/json'
+
+  def login_body(i):
+    return json_body({'username': f'bench{i % users}', 'password': PASSWORD})
+
+  def user_setup(prefix, cart=()):
+    def setup(i):
+      user = new_user(prefix, state['password'], cart)
+      return {'id': user.id, 'token': issue_token(user)}
+    return setup
+
+  def product_setup(i):
+    product = Product(name=f'delete me {i}', price=1.0, description='', version=0)
+    db.session.add(product)
+    db.session.flush()
+    return product.id
+
+  def cart_setup(i):
+    # uma unidade a mais no carrinho do writer para cada remocao medida
+    upsert_cart_item(state['writer_id'], i % products + 1, 1)
+    return i % products + 1
+
+  bulk_rows = b'\n'.join(json.dumps({'name': f'bulk {n}', 'price': n * 0.5}).encode() for n in range(options.bulk_rows))
+  low = 100.0
+
+  return [
+    dict(name='GET /', request=lambda i, data: ('GET', '/', None, {})),
+    dict(name='POST /login', request=lambda i, data: ('POST', '/login', login_body(i), {})),
+    dict(name='POST /logout', request=lambda i, data: ('POST', '/logout', None, reader)),
+    dict(name='POST /api/token', request=lambda i, data: ('POST', '/api/token', login_body(i), {})),
+    dict(name='POST /api/token/revoke', setup=user_setup('revoke'),
+         request=lambda i, data: ('POST', '/api/token/revoke', None, bearer(data['token']))),
+    dict(name='POST /api/user/add',
+         request=lambda i, data: ('POST', '/api/user/add',
+                                  json_body({'username': f'new-{random.getrandbits(64):x}', 'password': PASSWORD}), {})),
+    dict(name='PUT /api/user/update/<id>', setup=user_setup('update'),
+         request=lambda i, data: ('PUT', f"/api/user/update/{data['id']}",
+                                  json_body({'username': f'updated-{data["id"]}'}), bearer(data['token']))),
+    dict(name='DELETE /api/user/delete/<id>', setup=user_setup('delete'),
+         request=lambda i, data: ('DELETE', f"/api/user/delete/{data['id']}", None, bearer(data['token']))),
+    dict(name='POST /api/products/add',
+         request=lambda i, data: ('POST', '/api/products/add',
+                                  json_body({'name': f'added {i}', 'price': 9.99, 'description': 'bench'}), writer)),
+    dict(name='POST /api/products/bulk', count=max(1, options.requests // 20),
+         request=lambda i, data: ('POST', '/api/products/bulk', (bulk_rows, 'application/x-ndjson'), writer)),
+    dict(name='PUT /api/products/update/<id>',
+         request=lambda i, data: ('PUT', f'/api/products/update/{product_id(i)}', json_body({'price': 19.99}), writer)),
+    dict(name='DELETE /api/products/delete/<id>', setup=product_setup,
+         request=lambda i, data: ('DELETE', f'/api/products/delete/{data}', None, writer)),
+    dict(name='GET /api/products/<id>',
+         request=lambda i, data: ('GET', f'/api/products/{product_id(i)}', None, {})),
+    dict(name='GET /api/products', request=lambda i, data: ('GET', '/api/products', None, {})),
+    dict(name='GET /api/products (gzip)',
+         request=lambda i, data: ('GET', '/api/products', None, {'Accept-Encoding': 'gzip'})),
+    dict(name='GET /api/products?sort=price&min_price',
+         request=lambda i, data: ('GET', f'/api/products?fields=id,name,price&sort=price&min_price={low}&max_price={low * 3}',
+                                  None, {})),
+    dict(name='GET /api/products?stream=1', count=max(1, options.requests // 20),
+         request=lambda i, data: ('GET', '/api/products?stream=1', None, {})),
+    dict(name='GET /api/products/search',
+         request=lambda i, data: ('GET', f'/api/products/search?q={rng.choice(WORDS)}+{rng.choice(WORDS)}', None, {})),
+    dict(name='GET /api/cache/stats', request=lambda i, data: ('GET', '/api/cache/stats', None, writer)),
+    dict(name='POST /api/cart/add/<id>',
+         request=lambda i, data: ('POST', f'/api/cart/add/{product_id(i)}', None, writer)),
+    dict(name='DELETE /api/cart/remove/<id>', setup=cart_setup,
+         request=lambda i, data: ('DELETE', f'/api/cart/remove/{data}', None, writer)),
+    # "repetir a ultima compra": 30 linhas numa requisicao, num carrinho vazio
+    dict(name='POST /api/cart/batch (30 lines)', setup=user_setup('batch'),
+         request=lambda i, data: ('POST', '/api/cart/batch', json_body({'operations': [
+           {'op': 'add', 'product_id': (i * 30 + n) % products + 1, 'quantity': 1} for n in range(30)
+         ]}), bearer(data['token']))),
+    dict(name='GET /api/cart', request=lambda i, data: ('GET', '/api/cart', None, reader)),
+    dict(name='GET /api/cart?aggregate=1', request=lambda i, data: ('GET', '/api/cart?aggregate=1', None, reader)),
+    dict(name='POST /api/cart/checkout',
+         setup=user_setup('checkout', [n % products + 1 for n in range(lines_per_cart)]),
+         request=lambda i, data: ('POST', '/api/cart/checkout', None, bearer(data['token']))),
+  ]
+
+def prepare(scenario, count):
+  # roda os setups de todas as iteracoes antes de medir (um commit so)
+  setup = scenario.get('setup')
+  prepared = [setup(i) if setup else None for i in range(count)]
+  db.session.commit()
+  return [scenario['request'](i, data) for i, data in enumerate(prepared)]
+
+def split_body(body):
+  # corpo vem como (bytes, content type) ou None
+  return body if body is not None else (None, None)
+
+# Execucao pelo test client: sequencial, sem rede; mede o custo da aplicacao
+def run_client(requests):
+  client = application.test_client(use_cookies=False)
+  latencies, statuses = [], {}
+  queries = 0
+  started = time.perf_counter()
+  for method, path, body, headers in requests:
+    data, content_type = split_body(body)
+    before = query_counter.count
+    start = time.perf_counter()
+    response = client.open(path, method=method, data=data, content_type=content_type, headers=headers)
+    response.get_data() # inclui o corpo gerado em streaming
+    latencies.append(time.perf_counter() - start)
+    queries += query_counter.count - before
+    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+    response.close()
+  return latencies, statuses, queries, time.perf_counter() - started
+
+# Execucao por HTTP: servidor WSGI local com uma thread por requisicao e C clientes
+def run_server(requests, port, concurrency):
+  latencies, statuses = [], {}
+  lock = threading.Lock()
+
+  def worker(number):
+    own, own_statuses = [], {}
+    for method, path, body, headers in requests[number::concurrency]:
+      data, content_type = split_body(body)
+      headers = dict(headers, **({'Content-Type': content_type} if content_type else {}))
+      start = time.perf_counter()
+      connection = http.client.HTTPConnection('127.0.0.1', port)
+      connection.request(method, path, data, headers)
+      response = connection.getresponse()
+      response.read()
+      own.append(time.perf_counter() - start)
+      connection.close()
+      own_statuses[response.status] = own_statuses.get(response.status, 0) + 1
+    with lock:
+      latencies.extend(own)
+      for status, count in own_statuses.items():
+        statuses[status] = statuses.get(status, 0) + count
+
+  before = query_counter.count
+  started = time.perf_counter()
+  workers = [threading.Thread(target=worker, args=(number,)) for number in range(concurrency)]
+  for thread in workers:
+    thread.start()
+  for thread in workers:
+    thread.join()
+  return latencies, statuses, query_counter.count - before, time.perf_counter() - started
+
+def summarize(name, mode, latencies, statuses, queries, elapsed):
+  errors = sum(count for status, count in statuses.items() if status >= 400)
+  return {
+    'route': name,
+    'mode': mode,
+    'requests': len(latencies),
+    'errors': errors,
+    'statuses': {str(status): count for status, count in sorted(statuses.items())},
+    'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+    'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+    'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    'throughput_rps': round(len(latencies) / elapsed, 1),
+    'queries_per_request': round(queries / len(latencies), 2),
+  }
+
+def git_commit():
+  try:
+    return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+  except OSError:
+    return None
+
+# Gate de regressao: compara com um JSON de uma execucao anterior
+def compare(results, baseline_path, max_latency, max_throughput):
+  with open(baseline_path) as baseline_file:
+    baseline = {(row['mode'], row['route']): row for row in json.load(baseline_file)['results']}
+  regressions = []
+  for row in results:
+    old = baseline.get((row['mode'], row['route']))
+    if old is None:
+      continue
+    key = f"{row['mode']} {row['route']}"
+    # consultas por requisicao sao quase deterministicas; a folga cobre caches frios
+    # (ex. a versao do token, consultada uma vez por usuario)
+    if row['queries_per_request'] > old['queries_per_request'] + 0.1:
+      regressions.append(f"{key}: queries/request {old['queries_per_request']} -> {row['queries_per_request']}")
+    if row['p95_ms'] > old['p95_ms'] * (1 + max_latency):
+      regressions.append(f"{key}: p95 {old['p95_ms']}ms -> {row['p95_ms']}ms")
+    if row['throughput_rps'] < old['throughput_rps'] * (1 - max_throughput):
+      regressions.append(f"{key}: throughput {old['throughput_rps']} -> {row['throughput_rps']} req/s")
+    if row['errors'] > old['errors']:
+      regressions.append(f"{key}: errors {old['errors']} -> {row['errors']}")
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description='Latency, throughput and queries per request for every route')
+  parser.add_argument('--users', type=int, default=100)
+  parser.add_argument('--products', type=int, default=10000)
+  parser.add_argument('--cart-lines', type=int, default=1000)
+  parser.add_argument('--requests', type=int, default=200, help='requests per route (bulk and stream use 1/20)')
+  parser.add_argument('--bulk-rows', type=int, default=500, help='products per bulk import request')
+  parser.add_argument('--mode', choices=['client', 'server', 'both'], default='both')
+  parser.add_argument('--concurrency', type=int, default=8, help='HTTP clients in server mode')
+  parser.add_argument('--route', action='append', help='only routes containing this text (repeatable)')
+  parser.add_argument('--output', help='write the results as JSON to this file')
+  parser.add_argument('--compare', help='JSON from a previous run; exit 1 on regressions')
+  parser.add_argument('--max-latency-regression', type=float, default=0.25, help='allowed p95 increase (0.25 = 25%%)')
+  parser.add_argument('--max-throughput-regression', type=float, default=0.20, help='allowed throughput drop')
+  options = parser.parse_args()
+
+  logging.getLogger('werkzeug').setLevel(logging.ERROR) # sem uma linha de log por requisicao
+  modes = ['client', 'server'] if options.mode == 'both' else [options.mode]
+  results = []
+  with application.app_context():
+    for engine in db.engines.values(): # primario e pool de leitura
+      event.listen(engine, 'before_cursor_execute', query_counter)
+    password = seed(options.users, options.products, options.cart_lines)
+    writer = new_user('writer', password)
+    state = {
+      'password': password,
+      'reader_token': issue_token(db.session.get(User, 1)),
+      'writer_id': writer.id,
+      'writer_token': issue_token(writer),
+    }
+    db.session.commit()
+  scenarios = build_scenarios(options, state)
+  if options.route:
+    scenarios = [scenario for scenario in scenarios if any(text in scenario['name'] for text in options.route)]
+
+  server = None
+  if 'server' in modes:
+    server = make_server('127.0.0.1', 0, application, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+  print(f"{options.users} users, {options.products} products, {options.cart_lines} cart lines, "
+        f"{application.config['SQLALCHEMY_DATABASE_URI']}")
+  print(f"{'mode':<7} {'route':<40} {'req':>5} {'err':>4} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8} {'q/req':>6}")
+  try:
+    for scenario in scenarios:
+      for mode in modes:
+        # o contexto do setup fecha antes da medicao: cada requisicao abre o seu
+        # (um contexto aberto aqui seria reaproveitado pelo test client, com g e sessao juntos)
+        with application.app_context():
+          requests = prepare(scenario, scenario.get('count', options.requests))
+        if mode == 'client':
+          measured = run_client(requests)
+        else:
+          measured = run_server(requests, server.port, options.concurrency)
+        row = summarize(scenario['name'], mode, *measured)
+        results.append(row)
+        print(f"{mode:<7} {row['route']:<40} {row['requests']:>5} {row['errors']:>4} {row['p50_ms']:>8.2f} "
+              f"{row['p95_ms']:>8.2f} {row['p99_ms']:>8.2f} {row['throughput_rps']:>8.1f} {row['queries_per_request']:>6.2f}")
+  finally:
+    if server is not None:
+      server.shutdown()
+
+  report = {
+    'meta': {
+      'commit': git_commit(),
+      'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+      'python': platform.python_version(),
+      'users': options.users,
+      'products': options.products,
+      'cart_lines': options.cart_lines,
+      'requests': options.requests,
+      'concurrency': options.concurrency,
+    },
+    'results': results,
+  }
+  if options.output:
+    with open(options.output, 'w') as output:
+      json.dump(report, output, indent=2)
+  if options.compare:
+    regressions = compare(results, options.compare, options.max_latency_regression, options.max_throughput_regression)
+    for regression in regressions:
+      print(f'REGRESSION {regression}')
+    if regressions:
+      sys.exit(1)
+    print('no regressions')
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,174 @@
+# Benchmark das leituras de produto: WSGI em threads (gunicorn gthread) x ASGI (asgi.py no uvicorn)
+# Sobe os dois servidores com um worker cada, no mesmo banco SQLite, e chama GET /api/products
+# e GET /api/products/<id> com C clientes simultaneos (asyncio, uma conexao por requisicao).
+# Para cada nivel de concorrencia mostra vazao, p50/p99, erros e a memoria do processo que
+# atende (pico de RSS) e o maximo de threads durante a medicao: com a mesma memoria, quantas leituras
+# simultaneas cada modelo aguenta
+# precisa de: pip install aiosqlite asgiref uvicorn gunicorn
+# uso: python bench_asgi.py [--products 10000] [--requests 2000] [--concurrency 10 50 200]
+#                           [--output bench_asgi.json]
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import bench # ja escolhe o banco temporario (DATABASE_URI) antes de criar a app
+from bench import application
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+def free_port():
+  with socket.socket() as probe:
+    probe.bind(('127.0.0.1', 0))
+    return probe.getsockname()[1]
+
+def wait_for_port(port, process, timeout=60):
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    if process.poll() is not None:
+      raise RuntimeError(f'server exited with status {process.returncode}')
+    try:
+      socket.create_connection(('127.0.0.1', port), timeout=1).close()
+      return
+    except OSError:
+      time.sleep(0.2)
+  raise RuntimeError(f'server did not listen on port {port}')
+
+def start_server(kind, port):
+  # devolve (processo iniciado, pid do processo que atende as requisicoes)
+  if kind == 'wsgi':
+    command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}', '--workers', '1']
+  else:
+    command = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(port),
+               '--log-level', 'warning', '--no-access-log']
+  env = dict(os.environ, SWAGGER_MODE='off')
+  # sem o log dos servidores na saida
+  process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  wait_for_port(port, process)
+  if kind == 'wsgi':
+    # o gunicorn e o processo principal; quem atende e o worker filho
+    with open(f'/proc/{process.pid}/task/{process.pid}/children') as children:
+      return process, int(children.read().split()[0])
+  return process, process.pid
+
+def process_status(pid):
+  # pico de RSS em MB (VmHWM) e numero de threads, do /proc (Linux)
+  status = {}
+  with open(f'/proc/{pid}/status') as status_file:
+    for line in status_file:
+      key, _, value = line.partition(':')
+      if key in ('VmHWM', 'Threads'):
+        status[key] = value.split()[0]
+  return round(int(status['VmHWM']) / 1024, 1), int(status['Threads'])
+
+async def fetch(port, path):
+  reader, writer = await asyncio.open_connection('127.0.0.1', port)
+  writer.write(f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n'.encode())
+  await writer.drain()
+  response = await reader.read()
+  writer.close()
+  return int(response.split(b' ', 2)[1])
+
+async def run_level(port, paths, concurrency, pid):
+  # devolve (latencias, status, tempo total, maximo de threads do servidor durante a medicao)
+  latencies, statuses = [], {}
+  queue = iter(paths)
+  running = True
+
+  async def client():
+    for path in queue:
+      start = time.perf_counter()
+      try:
+        status = await asyncio.wait_for(fetch(port, path), 30)
+      except (OSError, asyncio.TimeoutError, IndexError, ValueError):
+        status = 0 # conexao recusada, cortada ou sem resposta
+      latencies.append(time.perf_counter() - start)
+      statuses[status] = statuses.get(status, 0) + 1
+
+  async def sample_threads():
+    # as threads do WSGI somem quando a requisicao termina: amostra enquanto roda
+    peak = 0
+    while running:
+      peak = max(peak, process_status(pid)[1])
+      await asyncio.sleep(0.05)
+    return peak
+
+  sampler = asyncio.create_task(sample_threads())
+  started = time.perf_counter()
+  await asyncio.gather(*(client() for _ in range(concurrency)))
+  elapsed = time.perf_counter() - started
+  running = False
+  return latencies, statuses, elapsed, await sampler
+
+def build_paths(products, count):
+  # metade listagem (paginas por cursor, com e sem fields), metade detalhe (com e sem cache)
+  rng = random.Random(2)
+  paths = []
+  for number in range(count):
+    if number % 2:
+      paths.append(f'/api/products/{rng.randint(1, products)}')
+    elif number % 4:
+      paths.append(f'/api/products?limit=20&after={rng.randint(0, products)}')
+    else:
+      paths.append(f'/api/products?limit=50&fields=name,price&after={rng.randint(0, products)}')
+  return paths
+
+def main():
+  parser = argparse.ArgumentParser(description='Threaded WSGI vs ASGI benchmark of the product read routes')
+  parser.add_argument('--products', type=int, default=10000)
+  parser.add_argument('--requests', type=int, default=2000, help='requests per concurrency level')
+  parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 50, 200])
+  parser.add_argument('--server', choices=['wsgi', 'asgi'], action='append', help='only this server (repeatable)')
+  parser.add_argument('--output', help='write the results as JSON to this file')
+  options = parser.parse_args()
+
+  with application.app_context():
+    bench.seed(10, options.products, 1)
+  paths = build_paths(options.products, options.requests)
+
+  results = []
+  print(f"{options.products} products, {options.requests} requests per level, {application.config['SQLALCHEMY_DATABASE_URI']}")
+  print(f"{'server':<6} {'conc':>5} {'err':>4} {'p50 ms':>8} {'p99 ms':>8} {'req/s':>8} {'peak MB':>8} {'threads':>8}")
+  for kind in options.server or ['wsgi', 'asgi']:
+    port = free_port()
+    process, pid = start_server(kind, port)
+    try:
+      asyncio.run(run_level(port, paths[:50], 5, pid)) # aquecimento, fora da medicao
+      for concurrency in options.concurrency:
+        latencies, statuses, elapsed, threads = asyncio.run(run_level(port, paths, concurrency, pid))
+        peak_mb = process_status(pid)[0]
+        row = {
+          'server': kind,
+          'concurrency': concurrency,
+          'requests': len(latencies),
+          'errors': sum(count for status, count in statuses.items() if status == 0 or status >= 400),
+          'statuses': {str(status): count for status, count in sorted(statuses.items())},
+          'p50_ms': round(bench.percentile(latencies, 0.50) * 1000, 3),
+          'p99_ms': round(bench.percentile(latencies, 0.99) * 1000, 3),
+          'throughput_rps': round(len(latencies) / elapsed, 1),
+          'peak_rss_mb': peak_mb,
+          'threads': threads,
+        }
+        results.append(row)
+        print(f"{kind:<6} {concurrency:>5} {row['errors']:>4} {row['p50_ms']:>8.2f} {row['p99_ms']:>8.2f} "
+              f"{row['throughput_rps']:>8.1f} {peak_mb:>8.1f} {threads:>8}")
+    finally:
+      process.terminate()
+      process.wait()
+
+  if options.output:
+    report = {
+      'meta': {'commit': bench.git_commit(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+               'products': options.products, 'requests': options.requests},
+      'results': results,
+    }
+    with open(options.output, 'w') as output:
+      json.dump(report, output, indent=2)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,167 @@
+# Teste de carga do checkout num produto disputado: U usuarios com o mesmo produto (estoque S)
+# no carrinho fazem checkout ao mesmo tempo, por um servidor WSGI local com C clientes.
+# No fim confere no banco que nada foi vendido alem do estoque: estoque final >= 0, unidades
+# nos pedidos == S - estoque final == unidades dos checkouts com 200, e todo checkout recusado
+# (409) pedia mais do que sobrou. Os efeitos colaterais de cada pedido vao para a fila de jobs:
+# --job-cost-ms deixa cada job mais lento e o p99 do checkout nao deve mudar; no fim espera a
+# fila esvaziar e confere que todo job rodou. Mostra a vazao e p50/p99 e devolve codigo 1 se algo falhar
+# uso: python bench_checkout.py [--users 500] [--stock 300] [--max-quantity 3] [--concurrency 32]
+#                               [--job-cost-ms 0]
+import argparse
+import http.client
+import logging
+import random
+import sys
+import threading
+import time
+
+import bench # ja escolhe o banco temporario (DATABASE_URI) antes de importar a app
+from werkzeug.serving import make_server
+
+import application as api
+from application import create_app, db, User, Product, CartItem, Order, OrderLine, OutboxJob, issue_token
+
+application = create_app()
+
+def seed(users, stock, max_quantity):
+  # devolve {token: quantidade do produto disputado no carrinho}
+  db.drop_all()
+  db.create_all()
+  hot = Product(name='hot sku', price=10.0, description='', stock=stock, version=0)
+  extra = Product(name='untracked', price=1.0, description='', version=0) # sem controle de estoque
+  db.session.add_all([hot, extra])
+  db.session.execute(User.__table__.insert(), [
+    {'username': f'buyer{number}', 'password': 'x'} for number in range(users)
+  ])
+  db.session.flush()
+  rng = random.Random(0)
+  carts = {user.id: rng.randint(1, max_quantity) for user in User.query}
+  db.session.execute(CartItem.__table__.insert(), [
+    {'user_id': user_id, 'product_id': hot.id, 'quantity': quantity} for user_id, quantity in carts.items()
+  ] + [
+    {'user_id': user_id, 'product_id': extra.id, 'quantity': 1} for user_id in carts
+  ])
+  db.session.commit()
+  return hot.id, {issue_token(user): carts[user.id] for user in User.query}
+
+def run(port, carts, concurrency):
+  latencies, results = [], [] # results: (status, quantidade pedida)
+  lock = threading.Lock()
+  tokens = list(carts)
+
+  def worker(number):
+    own_latencies, own_results = [], []
+    for token in tokens[number::concurrency]:
+      start = time.perf_counter()
+      connection = http.client.HTTPConnection('127.0.0.1', port)
+      connection.request('POST', '/api/cart/checkout', headers=bench.bearer(token))
+      response = connection.getresponse()
+      response.read()
+      connection.close()
+      own_latencies.append(time.perf_counter() - start)
+      own_results.append((response.status, carts[token]))
+    with lock:
+      latencies.extend(own_latencies)
+      results.extend(own_results)
+
+  started = time.perf_counter()
+  workers = [threading.Thread(target=worker, args=(number,)) for number in range(concurrency)]
+  for thread in workers:
+    thread.start()
+  for thread in workers:
+    thread.join()
+  return latencies, results, time.perf_counter() - started
+
+def slow_job_handlers(cost):
+  # cada handler de job passa a demorar `cost` segundos a mais (um envio lento, por exemplo)
+  def slow(handler):
+    def run(payload):
+      time.sleep(cost)
+      return handler(payload)
+    return run
+  for kind, handler in list(api.job_handlers.items()):
+    api.job_handlers[kind] = slow(handler)
+
+def wait_for_jobs(timeout):
+  # devolve (segundos ate a fila esvaziar, jobs que sobraram por status)
+  started = time.perf_counter()
+  while True:
+    with application.app_context():
+      left = dict(db.session.execute(
+        db.select(OutboxJob.status, db.func.count()).group_by(OutboxJob.status)
+      ).all())
+    if not left.get('pending') or time.perf_counter() - started > timeout:
+      return time.perf_counter() - started, left
+    time.sleep(0.05)
+
+def check(stock, final_stock, sold, results):
+  # devolve a lista de problemas encontrados
+  problems = []
+  accepted = sum(quantity for status, quantity in results if status == 200)
+  others = [status for status, _ in results if status not in (200, 409)]
+  if final_stock < 0:
+    problems.append(f'stock went negative: {final_stock}')
+  if sold != stock - final_stock:
+    problems.append(f'oversold: order lines hold {sold} units, stock only dropped by {stock - final_stock}')
+  if sold != accepted:
+    problems.append(f'order lines hold {sold} units but successful checkouts asked for {accepted}')
+  # o estoque so diminui: um 409 so e certo se a quantidade pedida nao cabe nem no que sobrou no fim
+  refused = [quantity for status, quantity in results if status == 409 and quantity <= final_stock]
+  if refused:
+    problems.append(f'{len(refused)} checkouts were refused while enough stock was left')
+  if others:
+    problems.append(f'{len(others)} checkouts failed with other statuses: {sorted(set(others))}')
+  return problems
+
+def main():
+  parser = argparse.ArgumentParser(description='Concurrent checkouts against one hot product')
+  parser.add_argument('--users', type=int, default=500)
+  parser.add_argument('--stock', type=int, default=300)
+  parser.add_argument('--max-quantity', type=int, default=3, help='units of the hot product per cart (1..N)')
+  parser.add_argument('--concurrency', type=int, default=32)
+  parser.add_argument('--job-cost-ms', type=float, default=0, help='extra time each checkout side-effect job takes')
+  parser.add_argument('--job-timeout', type=float, default=120, help='seconds to wait for the job queue to drain')
+  options = parser.parse_args()
+
+  logging.getLogger('werkzeug').setLevel(logging.ERROR)
+  slow_job_handlers(options.job_cost_ms / 1000)
+  with application.app_context():
+    hot_id, carts = seed(options.users, options.stock, options.max_quantity)
+  server = make_server('127.0.0.1', 0, application, threaded=True)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  try:
+    latencies, results, elapsed = run(server.port, carts, options.concurrency)
+  finally:
+    server.shutdown()
+  drain, left = wait_for_jobs(options.job_timeout)
+
+  with application.app_context():
+    final_stock = db.session.get(Product, hot_id).stock
+    sold = db.session.execute(
+      db.select(db.func.coalesce(db.func.sum(OrderLine.quantity), 0)).where(OrderLine.product_id == hot_id)
+    ).scalar()
+    orders = db.session.execute(db.select(db.func.count()).select_from(Order)).scalar()
+  jobs = api.job_workers.stats()
+  statuses = {}
+  for status, _ in results:
+    statuses[status] = statuses.get(status, 0) + 1
+  demand = sum(carts.values())
+  print(f"{options.users} checkouts ({demand} units asked) for {options.stock} units, {options.concurrency} clients, "
+        f"{application.config['SQLALCHEMY_DATABASE_URI']}")
+  print(f"statuses {dict(sorted(statuses.items()))}, sold {sold}, stock left {final_stock}")
+  print(f"p50 {bench.percentile(latencies, 0.50) * 1000:.2f} ms, p99 {bench.percentile(latencies, 0.99) * 1000:.2f} ms, "
+        f"{len(latencies) / elapsed:.1f} checkouts/s")
+  print(f"jobs: {jobs['processed']} done, {jobs['retried']} retried, {jobs['dead_lettered']} dead, "
+        f"queue drained {drain:.2f} s after the last checkout ({options.job_cost_ms:g} ms per job)")
+  problems = check(options.stock, final_stock, sold, results)
+  expected = orders * len(api.CHECKOUT_JOBS)
+  if left or jobs['processed'] != expected:
+    problems.append(f"{orders} orders should run {expected} jobs, {jobs['processed']} ran and {left or 0} are left")
+  for problem in problems:
+    print(f'FAIL {problem}')
+  if problems:
+    sys.exit(1)
+  print('no oversell')
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,81 @@
+# Benchmark de login: vazao do /login para cada custo de hash de senha
+# uso: python bench_login.py [--threads 8] [--seconds 5] [--method scrypt:16384:8:1 ...]
+import argparse
+import os
+import threading
+import time
+
+# banco em memoria, para medir so o custo do hash e da rota
+os.environ.setdefault('DATABASE_URI', 'sqlite://')
+
+from application import create_app, db, User, hash_password
+
+application = create_app()
+
+DEFAULT_METHODS = [
+  'pbkdf2:sha256:100000',
+  'pbkdf2:sha256:600000',
+  'scrypt:16384:8:1',
+  'scrypt:32768:8:1',
+  'scrypt:65536:8:1',
+]
+
+def percentile(values, fraction):
+  ordered = sorted(values)
+  return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def run(method, threads, seconds):
+  application.config['PASSWORD_HASH_METHOD'] = method
+  with application.app_context():
+    db.drop_all()
+    db.create_all()
+    for number in range(threads):
+      db.session.add(User(username=f'bench{number}', password=hash_password('secret')))
+    db.session.commit()
+
+  latencies = []
+  lock = threading.Lock()
+  deadline = time.perf_counter() + seconds
+
+  def worker(number):
+    client = application.test_client()
+    body = {'username': f'bench{number}', 'password': 'secret'}
+    own = []
+    while time.perf_counter() < deadline:
+      start = time.perf_counter()
+      response = client.post('/login', json=body)
+      own.append(time.perf_counter() - start)
+      assert response.status_code == 200, response.status_code
+    with lock:
+      latencies.extend(own)
+
+  started = time.perf_counter()
+  workers = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+  for thread in workers:
+    thread.start()
+  for thread in workers:
+    thread.join()
+  elapsed = time.perf_counter() - started
+  return {
+    'method': method,
+    'logins': len(latencies),
+    'per_second': len(latencies) / elapsed,
+    'p50_ms': percentile(latencies, 0.50) * 1000,
+    'p95_ms': percentile(latencies, 0.95) * 1000,
+  }
+
+def main():
+  parser = argparse.ArgumentParser(description='Login throughput for each password hash cost')
+  parser.add_argument('--threads', type=int, default=8, help='concurrent clients')
+  parser.add_argument('--seconds', type=float, default=5, help='duration of each run')
+  parser.add_argument('--method', action='append', help='hash method to measure (repeatable)')
+  args = parser.parse_args()
+
+  print(f"hash workers: {application.config['PASSWORD_HASH_WORKERS']}, clients: {args.threads}")
+  print(f"{'method':<24} {'logins/s':>10} {'p50 ms':>9} {'p95 ms':>9}")
+  for method in args.method or DEFAULT_METHODS:
+    result = run(method, args.threads, args.seconds)
+    print(f"{result['method']:<24} {result['per_second']:>10.1f} {result['p50_ms']:>9.1f} {result['p95_ms']:>9.1f}")
+
+if __name__ == '__main__':
+  main()
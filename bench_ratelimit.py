@@ -0,0 +1,51 @@
+# Custo do limite de requisicoes: mede o TokenBucketStore.take (a checagem feita em cada
+# requisicao) com 1 e com varias threads, com poucas chaves (sempre no mesmo balde) e com
+# muitas (clientes diferentes, com despejo dos baldes parados quando passa do maximo).
+# Mostra microssegundos por checagem; a meta e ficar bem abaixo de 10 us
+# uso: python bench_ratelimit.py [--checks 200000] [--threads 1 4 16] [--keys 1 100000]
+import argparse
+import threading
+import time
+
+import bench # ja escolhe o banco temporario (DATABASE_URI) antes de criar a app
+from application import TokenBucketStore
+from bench import application
+
+def run(store, checks, threads, keys):
+  # devolve microssegundos por checagem (tempo de parede / total de checagens)
+  names = [f'get_products:ip10.0.{number // 256}.{number % 256}' for number in range(keys)]
+  rule = application.config['RATELIMIT_RULES']['get_products']
+  per_thread = checks // threads
+
+  def worker(offset):
+    take = store.take
+    for number in range(per_thread):
+      take(names[(offset + number) % keys], *rule)
+
+  workers = [threading.Thread(target=worker, args=(number * 7919,)) for number in range(threads)]
+  started = time.perf_counter()
+  for thread in workers:
+    thread.start()
+  for thread in workers:
+    thread.join()
+  return (time.perf_counter() - started) / (per_thread * threads) * 1e6
+
+def main():
+  parser = argparse.ArgumentParser(description='Cost of one rate limit check')
+  parser.add_argument('--checks', type=int, default=200000)
+  parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16])
+  parser.add_argument('--keys', type=int, nargs='+', default=[1, 100000])
+  parser.add_argument('--max-buckets', type=int, default=application.config['RATELIMIT_MAX_BUCKETS'])
+  options = parser.parse_args()
+
+  print(f"{options.checks} checks per run, max {options.max_buckets} buckets")
+  print(f"{'threads':>7} {'keys':>7} {'us/check':>9} {'buckets':>8} {'evicted':>8}")
+  for keys in options.keys:
+    for threads in options.threads:
+      store = TokenBucketStore(options.max_buckets)
+      micros = run(store, options.checks, threads, keys)
+      stats = store.stats()
+      print(f"{threads:>7} {keys:>7} {micros:>9.2f} {stats['buckets']:>8} {stats['evictions']:>8}")
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,76 @@
+# Microbenchmark de serializacao: listagem de N produtos no caminho antigo
+# (ORM + dicts montados a mao + jsonify) contra linhas do Core + RowSerializer
+# uso: python bench_serializers.py [--products 10000] [--repeat 20]
+import argparse
+import json
+import os
+import time
+
+# banco em memoria, para medir so a leitura e a serializacao
+os.environ.setdefault('DATABASE_URI', 'sqlite://')
+
+from flask import jsonify
+
+from application import create_app, db, Product, product_serializer, orjson
+
+application = create_app()
+
+def orm_jsonify():
+  # como get_products fazia antes: objetos do ORM, dict por produto, jsonify
+  products = Product.query.all()
+  product_list = []
+  for product in products:
+    product_list.append({
+      "id": product.id,
+      "name": product.name,
+      "price": product.price,
+      "description": product.description
+    })
+  return jsonify(product_list).get_data()
+
+def core_serializer():
+  rows = db.session.execute(db.select(*product_serializer.columns())).all()
+  return product_serializer.dumps(rows)
+
+def core_serializer_stdlib():
+  # mesmo caminho, forcando o json da biblioteca padrao
+  rows = db.session.execute(db.select(*product_serializer.columns())).all()
+  row_to_dict = product_serializer.compile()
+  return json.dumps([row_to_dict(row) for row in rows], separators=(',', ':')).encode()
+
+def measure(function, products, repeat):
+  function() # aquece caches (compilacao do SQL e do serializador)
+  timings = []
+  for _ in range(repeat):
+    db.session.expunge_all() # o caminho do ORM nao pode reaproveitar o identity map
+    start = time.perf_counter()
+    function()
+    timings.append(time.perf_counter() - start)
+  best = min(timings)
+  return products / best, best * 1000
+
+def main():
+  parser = argparse.ArgumentParser(description='Rows/sec serialized for a product listing')
+  parser.add_argument('--products', type=int, default=10000)
+  parser.add_argument('--repeat', type=int, default=20)
+  args = parser.parse_args()
+
+  with application.app_context(), application.test_request_context():
+    db.create_all()
+    db.session.execute(Product.__table__.insert(), [
+      {'name': f'Product {number}', 'price': number * 0.99, 'description': 'Noise-canceling wireless headphones ' * 3}
+      for number in range(args.products)
+    ])
+    db.session.commit()
+
+    cases = [('orm + jsonify (antes)', orm_jsonify), ('core + serializer (json)', core_serializer_stdlib)]
+    if orjson is not None:
+      cases.append(('core + serializer (orjson)', core_serializer))
+    print(f'{args.products} products, best of {args.repeat}')
+    print(f"{'path':<28} {'rows/s':>12} {'ms':>8}")
+    for name, function in cases:
+      rows_per_second, milliseconds = measure(function, args.products, args.repeat)
+      print(f'{name:<28} {rows_per_second:>12,.0f} {milliseconds:>8.1f}')
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,74 @@
+# Custo de subir um worker em cada SWAGGER_MODE: cada medida roda num processo novo, que importa a
+# application, chama create_app e faz o primeiro GET /apispec_1.json. Mostra o tempo ate a app
+# pronta, os modulos importados, a memoria e o tempo da primeira resposta do spec (mediana das
+# repeticoes). A memoria e a RSS atual no Linux (a maxima nos outros sistemas). O modo static le
+# um apispec.json gerado antes com flask build-apispec
+# uso: python bench_startup.py [--repeat 5] [--modes flasgger static off]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+CHILD = '''
+import json, os, resource, sys, time
+started = time.perf_counter()
+from application import create_app
+application = create_app()
+ready = time.perf_counter()
+response = application.test_client().get('/apispec_1.json')
+first_spec = time.perf_counter() - ready
+try:
+  # RSS atual; a maxima inclui o pico do hash de senha que create_app faz uma vez (scrypt usa ~32 MB)
+  with open('/proc/self/statm') as statm:
+    rss_mb = int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+except OSError:
+  rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+print(json.dumps({
+  'startup_ms': (ready - started) * 1000,
+  'modules': len(sys.modules),
+  'rss_mb': rss_mb,
+  'first_spec_ms': first_spec * 1000 if response.status_code == 200 else None,
+}))
+'''
+
+def child_env(directory, mode):
+  env = dict(os.environ)
+  env.update({
+    'SWAGGER_MODE': mode,
+    'APISPEC_FILE': os.path.join(directory, 'apispec.json'),
+    'DATABASE_URI': 'sqlite://', # nada de banco em arquivo: mede so a subida
+    'JOB_WORKERS': '0',
+  })
+  return env
+
+def measure(directory, mode):
+  output = subprocess.run([sys.executable, '-c', CHILD], env=child_env(directory, mode), cwd=os.path.dirname(os.path.abspath(__file__)),
+                          check=True, capture_output=True, text=True).stdout
+  return json.loads(output.splitlines()[-1])
+
+def median(samples, key):
+  values = [sample[key] for sample in samples if sample[key] is not None]
+  return statistics.median(values) if values else None
+
+def main():
+  parser = argparse.ArgumentParser(description='Worker startup cost for each SWAGGER_MODE')
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('--modes', nargs='+', default=['flasgger', 'static', 'off'])
+  options = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as directory:
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'application', 'build-apispec'],
+                   env=child_env(directory, 'off'), cwd=os.path.dirname(os.path.abspath(__file__)),
+                   check=True, capture_output=True)
+    print(f"{'mode':10} {'startup ms':>11} {'modules':>8} {'RSS MB':>7} {'1st spec ms':>12}")
+    for mode in options.modes:
+      samples = [measure(directory, mode) for _ in range(options.repeat)]
+      first_spec = median(samples, 'first_spec_ms')
+      print(f"{mode:10} {median(samples, 'startup_ms'):11.1f} {median(samples, 'modules'):8.0f} "
+            f"{median(samples, 'rss_mb'):7.1f} {'-' if first_spec is None else f'{first_spec:.1f}':>12}")
+
+if __name__ == '__main__':
+  main()
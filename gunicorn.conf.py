@@ -0,0 +1,33 @@
+# Configuracao do servidor de producao (gunicorn): N workers pre-forkados (padrao: um por CPU),
+# cada um com threads (gthread), aceitando conexoes no mesmo socket.
+# A app e importada uma vez no processo principal (preload_app) e dividida com os filhos; o hook
+# de fork do application.py descarta as conexoes herdadas. Cada worker aquece conexoes e caches
+# (warm_up) antes de aceitar conexoes.
+# Sinais para o processo principal:
+#   HUP        sobe workers novos e encerra os antigos sem derrubar requisicoes. Com preload_app
+#              o codigo e o ja carregado; um worker que nao sobe nao troca os que estao atendendo
+#   USR2       codigo novo: sobe um processo principal novo ao lado do atual (depois WINCH e QUIT no antigo).
+#              Se o codigo novo nao carrega, o processo novo sai e o antigo segue atendendo
+#   TERM       encerra esperando as requisicoes em andamento (graceful_timeout)
+# uso: gunicorn -c gunicorn.conf.py   (PORT, WEB_WORKERS, WEB_THREADS e WARMUP_PRODUCTS no ambiente)
+import os
+
+wsgi_app = 'application:create_app()'
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 8)) # requisicoes simultaneas por worker
+preload_app = True
+backlog = 1024
+graceful_timeout = 30 # segundos para um worker terminar as requisicoes antes do SIGKILL
+timeout = 60 # worker sem responder ao processo principal por mais tempo e reiniciado
+
+def post_worker_init(worker):
+  # roda no worker antes do primeiro accept; worker.wsgi e a app criada no processo principal
+  from application import warm_up
+  warm_up(worker.wsgi, int(os.environ.get('WARMUP_PRODUCTS', 1000)))
+
+def worker_exit(server, worker):
+  # termina os jobs em andamento; os outros ficam na fila para o proximo worker
+  from application import stop_job_workers
+  stop_job_workers(graceful_timeout)
@@ -0,0 +1,60 @@
+# Configuracao dos testes: banco SQLite em memoria, sem limite de requisicoes e sem fila de
+# jobs rodando em outra thread. Tem que vir antes do import da application, que le o ambiente
+import os
+
+os.environ.setdefault('DATABASE_URI', 'sqlite://')
+os.environ.setdefault('RATELIMIT_ENABLED', '0')
+os.environ.setdefault('JOB_WORKERS', '0')
+os.environ.setdefault('SWAGGER_MODE', 'off')
+os.environ.setdefault('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:1000') # hash barato, so para os testes
+
+import pytest
+from sqlalchemy import event
+
+from application import create_app, db, User, hash_password, issue_token, init_process_state
+
+application = create_app()
+
+PASSWORD = 'secret'
+
+@pytest.fixture
+def app():
+  # tabelas, caches e baldes do rate limit novos a cada teste. O teste nao fica dentro de um
+  # app context: cada requisicao do test client abre o seu e tem a sua sessao, como no servidor;
+  # quem mexe no banco direto usa "with app.app_context()"
+  init_process_state(application)
+  with application.app_context():
+    db.drop_all()
+    db.create_all()
+  return application
+
+@pytest.fixture
+def client(app):
+  return app.test_client()
+
+@pytest.fixture
+def statements(app):
+  # SQL mandado ao banco durante o teste, na ordem
+  executed = []
+  def record(conn, cursor, statement, parameters, context, executemany):
+    executed.append(statement)
+  with app.app_context():
+    engine = db.engine
+  event.listen(engine, 'before_cursor_execute', record)
+  yield executed
+  event.remove(engine, 'before_cursor_execute', record)
+
+@pytest.fixture
+def user(app):
+  # (id, token) de um usuario com a senha PASSWORD
+  with app.app_context():
+    user = User(username='alice', password=hash_password(PASSWORD))
+    db.session.add(user)
+    db.session.commit()
+    return user.id, issue_token(user)
+
+@pytest.fixture
+def session_client(client, user):
+  # cliente logado por cookie de sessao (/login)
+  assert client.post('/login', json={'username': 'alice', 'password': PASSWORD}).status_code == 200
+  return client
@@ -0,0 +1,119 @@
+# Carrinho: limites de quantidade e consultas por requisicao
+import threading
+
+import pytest
+
+from application import create_app, db, issue_token, CartItem, Order, OrderLine, Product, User
+
+@pytest.fixture
+def product(app):
+  with app.app_context():
+    product = Product(name='Keyboard', price=10)
+    db.session.add(product)
+    db.session.commit()
+    return product.id
+
+def cart_quantity(app, product_id):
+  with app.app_context():
+    return db.session.execute(db.select(CartItem.quantity).where(CartItem.product_id == product_id)).scalar()
+
+@pytest.mark.parametrize('quantity', ['0', '10001', '99999999999999999999'])
+def test_add_rejects_quantity_out_of_range(session_client, product, quantity):
+  response = session_client.post(f'/api/cart/add/{product}?quantity={quantity}')
+  assert response.status_code == 400
+
+def test_add_keeps_the_line_under_the_maximum(app, session_client, product):
+  assert session_client.post(f'/api/cart/add/{product}?quantity=10000').status_code == 200
+  assert session_client.post(f'/api/cart/add/{product}').status_code == 400
+  assert cart_quantity(app, product) == 10000
+
+@pytest.mark.parametrize('quantity', ['0', '99999999999999999999'])
+def test_remove_rejects_quantity_out_of_range(app, session_client, product, quantity):
+  session_client.post(f'/api/cart/add/{product}?quantity=3')
+  assert session_client.delete(f'/api/cart/remove/{product}?quantity={quantity}').status_code == 400
+  assert cart_quantity(app, product) == 3
+
+@pytest.mark.parametrize('operations, index', [
+  ([{'op': 'set', 'product_id': 1, 'quantity': 2 ** 70}], 0),
+  ([{'op': 'add', 'product_id': 1, 'quantity': 10001}], 0),
+  ([{'op': 'add', 'product_id': 1, 'quantity': 6000}, {'op': 'add', 'product_id': 1, 'quantity': 6000}], 1),
+  ([{'op': 'set', 'product_id': 1, 'quantity': 10000}, {'op': 'add', 'product_id': 1}], 1),
+])
+def test_batch_reports_quantity_out_of_range_by_index(app, session_client, product, operations, index):
+  response = session_client.post('/api/cart/batch', json={'operations': operations})
+  assert response.status_code == 400
+  assert [error['index'] for error in response.get_json()['errors']] == [index]
+  assert cart_quantity(app, product) is None
+
+def test_batch_reports_product_id_out_of_range_by_index(app, session_client, product):
+  operations = [{'op': 'add', 'product_id': product}, {'op': 'add', 'product_id': 2 ** 70}]
+  response = session_client.post('/api/cart/batch', json={'operations': operations})
+  assert response.status_code == 400
+  assert [error['index'] for error in response.get_json()['errors']] == [1]
+  assert cart_quantity(app, product) is None
+
+def add_cart_lines(app, user_id, lines):
+  with app.app_context():
+    products = [Product(name=f'Product {number}', price=number + 1) for number in range(lines)]
+    db.session.add_all(products)
+    db.session.flush()
+    db.session.add_all([CartItem(user_id=user_id, product_id=product.id, quantity=2) for product in products])
+    db.session.commit()
+
+def statements_per_view(client, statements, query=''):
+  statements.clear()
+  response = client.get('/api/cart' + query)
+  assert response.status_code == 200
+  return len(statements), response.get_json()
+
+@pytest.mark.parametrize('query', ['', '?aggregate=1'])
+def test_view_cart_query_count_does_not_grow_with_the_cart(app, session_client, user, statements, query):
+  user_id, _ = user
+  add_cart_lines(app, user_id, 1)
+  small, cart = statements_per_view(session_client, statements, query)
+  add_cart_lines(app, user_id, 49)
+  large, cart = statements_per_view(session_client, statements, query)
+  assert small == large
+  assert len(cart['items'] if query else cart) == 50
+
+def test_checkout_of_an_empty_cart_records_no_order(app, session_client):
+  response = session_client.post('/api/cart/checkout')
+  assert response.status_code == 200
+  assert response.get_json() == {'message': 'Checkout successful. Cart has been cleared.'}
+  with app.app_context():
+    assert db.session.execute(db.select(db.func.count()).select_from(Order)).scalar() == 0
+
+def test_concurrent_checkouts_never_oversell(tmp_path):
+  # banco em arquivo: cada thread tem a sua conexao, como no servidor. 8 usuarios pedem 2 unidades
+  # cada de um produto com 5; no maximo 2 checkouts passam e o resto recebe 409.
+  # Sem o bind 'read': o db guarda os binds de todas as apps e o drop_all da app dos outros testes falharia
+  app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "checkout.db"}', 'READ_ROUTING_ENABLED': False})
+  with app.app_context():
+    db.create_all()
+    product = Product(name='Hot', price=10, stock=5)
+    db.session.add(product)
+    db.session.add_all([User(username=f'buyer{number}', password='x') for number in range(8)])
+    db.session.flush()
+    db.session.add_all([CartItem(user_id=user.id, product_id=product.id, quantity=2) for user in User.query])
+    db.session.commit()
+    product_id = product.id
+    tokens = [issue_token(user) for user in User.query]
+  statuses = []
+  barrier = threading.Barrier(len(tokens))
+  def buy(token):
+    client = app.test_client()
+    barrier.wait()
+    statuses.append(client.post('/api/cart/checkout', headers={'Authorization': f'Bearer {token}'}).status_code)
+  threads = [threading.Thread(target=buy, args=(token,)) for token in tokens]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  with app.app_context():
+    stock = db.session.get(Product, product_id).stock
+    sold = db.session.execute(db.select(db.func.sum(OrderLine.quantity)).where(OrderLine.product_id == product_id)).scalar()
+    for engine in db.engines.values():
+      engine.dispose()
+  assert sorted(statuses) == [200, 200] + [409] * 6
+  assert stock == 1
+  assert sold == 5 - stock == 2 * statuses.count(200)
@@ -0,0 +1,80 @@
+# Listagem de produtos: planos de consulta dos filtros/ordenacoes e cursores invalidos
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from application import db, Product, build_product_listing, encode_cursor
+
+FILTERS = [
+  {},
+  {'min_price': '1'},
+  {'max_price': '5'},
+  {'min_price': '1', 'max_price': '5'},
+  {'name_prefix': 'ab'},
+  {'min_price': '1', 'name_prefix': 'ab'},
+]
+CURSORS = {'id': '5', 'price': encode_cursor(1.0, 3), 'name': encode_cursor('a', 3)}
+
+def query_plan(app, args):
+  with app.app_context():
+    query = build_product_listing(MultiDict(args))[0]
+    sql = str(query.compile(db.engine, compile_kwargs={'literal_binds': True}))
+    return [row[3] for row in db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + sql)]
+
+def add_products(app, products):
+  with app.app_context():
+    db.session.add_all([Product(name=name, price=price) for name, price in products])
+    db.session.commit()
+
+def index_ordered(sort, filters):
+  # a ordem sai pronta do indice quando o filtro e a ordem usam a mesma coluna (ou nao ha filtro);
+  # nas outras combinacoes o filtro usa o seu indice e as linhas filtradas sao ordenadas
+  if 'name_prefix' in filters:
+    return sort == 'name'
+  return not filters or sort == 'price'
+
+@pytest.mark.parametrize('paged', [False, True])
+@pytest.mark.parametrize('filters', FILTERS)
+@pytest.mark.parametrize('sort', ['id', 'price', 'name'])
+def test_listing_never_scans_the_table(app, sort, filters, paged):
+  args = {'sort': sort, **filters}
+  if paged:
+    args['after'] = CURSORS[sort]
+  plan = query_plan(app, args)
+
+  for step in plan:
+    if step.startswith('SCAN'):
+      # percorrer o indice da ordem so vale sem filtro nem cursor, quando o LIMIT para a leitura
+      assert step == f'SCAN product USING INDEX ix_product_{sort}_id' and not filters and not paged, plan
+    else:
+      assert step.startswith('SEARCH product USING') or step == 'USE TEMP B-TREE FOR ORDER BY', plan
+  assert ('USE TEMP B-TREE FOR ORDER BY' in plan) != index_ordered(sort, filters), plan
+
+@pytest.mark.parametrize('query', [
+  'sort=price&after=NQ==', # JSON valido que nao e um par
+  'sort=price&after=' + encode_cursor(1, 2 ** 70),
+  'after=99999999999999999999',
+  'sort=nope',
+])
+def test_invalid_listing_parameters(client, query):
+  assert client.get('/api/products?' + query).status_code == 400
+
+@pytest.mark.parametrize('prefix', ['\U0010ffff', 'b\U0010ffff', 'b\ud7ff'])
+def test_name_prefix_at_the_end_of_unicode(app, client, prefix):
+  # U+10FFFF nao tem proximo caractere e o proximo de U+D7FF seria um surrogate
+  add_products(app, [('a', 1), (prefix + 'x', 1), ('c', 1)])
+  response = client.get('/api/products', query_string={'name_prefix': prefix})
+  assert response.status_code == 200
+  assert [product['name'] for product in response.get_json()] == [prefix + 'x']
+
+@pytest.mark.parametrize('sort', ['id', 'name'])
+def test_price_filter_pages_follow_the_sort(app, client, sort):
+  add_products(app, [('e', 1), ('d', 3), ('c', 2), ('b', 5), ('a', 4), ('f', 2)])
+  names, after = [], None
+  while True:
+    query = {'sort': sort, 'min_price': 2, 'limit': 2, **({'after': after} if after else {})}
+    response = client.get('/api/products', query_string=query)
+    names += [product['name'] for product in response.get_json()]
+    after = response.headers.get('X-Next-Cursor')
+    if not after:
+      break
+  assert names == (['d', 'c', 'b', 'a', 'f'] if sort == 'id' else ['a', 'b', 'c', 'd', 'f'])
@@ -0,0 +1,58 @@
+# Produtos: importacao em massa (POST /api/products/bulk) e ids fora do intervalo do SQLite
+import json
+
+import pytest
+
+import application as application_module
+from application import db, Product
+
+def ndjson(rows):
+  return ''.join(json.dumps(row) + '\n' for row in rows).encode()
+
+def bulk(client, body, content_type='application/x-ndjson'):
+  return client.post('/api/products/bulk', data=body, content_type=content_type)
+
+def test_bulk_reads_the_body_before_taking_the_write_lock(app, session_client, monkeypatch):
+  # enquanto as linhas chegam, a conexao nao pode estar numa transacao de escrita
+  in_transaction = []
+  read_ndjson = application_module.read_ndjson
+  def watched_read_ndjson(stream):
+    for item in read_ndjson(stream):
+      in_transaction.append(db.session.connection().connection.dbapi_connection.in_transaction)
+      yield item
+  monkeypatch.setattr(application_module, 'read_ndjson', watched_read_ndjson)
+  response = bulk(session_client, ndjson([{'name': f'p{number}', 'price': number} for number in range(100)]))
+  assert response.status_code == 200
+  assert response.get_json()['inserted'] == 100
+  assert len(in_transaction) == 100 and not any(in_transaction)
+
+def test_bulk_invalid_body_writes_nothing(app, session_client):
+  response = bulk(session_client, b'[{"name": "a", "price": 1}, {"name": ', 'application/json')
+  assert response.status_code == 400
+  with app.app_context():
+    assert db.session.execute(db.select(db.func.count()).select_from(Product)).scalar() == 0
+
+def test_bulk_update_keeps_omitted_fields(app, session_client):
+  assert bulk(session_client, ndjson([{'id': 7, 'name': 'a', 'price': 1, 'description': 'kept', 'stock': 3}])).status_code == 200
+  response = bulk(session_client, ndjson([{'id': 7, 'name': 'b', 'price': 2}, {'id': 2 ** 70, 'name': 'c', 'price': 1}]))
+  assert response.get_json()['errors'] == [{'row': 2, 'message': 'id must be a positive integer'}]
+  with app.app_context():
+    product = db.session.get(Product, 7)
+    assert (product.name, product.price, product.description, product.stock) == ('b', 2, 'kept', 3)
+
+@pytest.mark.parametrize('method, path', [
+  ('get', '/api/products/{}'),
+  ('put', '/api/products/update/{}'),
+  ('delete', '/api/products/delete/{}'),
+  ('post', '/api/cart/add/{}'),
+  ('delete', '/api/cart/remove/{}'),
+])
+@pytest.mark.parametrize('product_id', [2 ** 63, 2 ** 70, '9' * 5000])
+def test_product_id_above_the_sqlite_range_is_not_found(session_client, method, path, product_id):
+  response = getattr(session_client, method)(path.format(product_id), json={})
+  assert response.status_code == 404
+
+def test_largest_sqlite_product_id_still_routes(client):
+  response = client.get(f'/api/products/{2 ** 63 - 1}')
+  assert response.status_code == 404
+  assert response.get_json() == {'message': 'Product not found'}
@@ -0,0 +1,35 @@
+# Chave do cliente (rate limit e read-your-writes) sem carregar o usuario do banco
+import pytest
+
+from application import client_key
+
+@pytest.fixture
+def rate_limited(app, monkeypatch):
+  monkeypatch.setitem(app.config, 'RATELIMIT_ENABLED', True)
+  monkeypatch.setitem(app.config, 'RATELIMIT_RULES', {**app.config['RATELIMIT_RULES'], 'get_products': (1, 60)})
+
+def test_session_client_is_limited_without_loading_the_user(rate_limited, session_client, statements):
+  assert session_client.get('/api/products').status_code == 200
+  assert session_client.get('/api/products').status_code == 429
+  assert not [statement for statement in statements if 'FROM user' in statement]
+
+def test_each_user_has_its_own_bucket(app, rate_limited, session_client, user):
+  _, token = user
+  assert session_client.get('/api/products').status_code == 200
+  # mesmo usuario por token: mesmo balde
+  other = app.test_client()
+  assert other.get('/api/products', headers={'Authorization': f'Bearer {token}'}).status_code == 429
+  # anonimo: balde do IP
+  assert other.get('/api/products').status_code == 200
+
+@pytest.mark.parametrize('authorization', [None, 'Bearer not-a-token'])
+def test_anonymous_client_is_keyed_by_ip(app, authorization):
+  headers = {'Authorization': authorization} if authorization else {}
+  with app.test_request_context('/api/products', headers=headers, environ_base={'REMOTE_ADDR': '10.0.0.7'}):
+    assert client_key() == 'ip10.0.0.7'
+
+def test_token_client_is_keyed_by_user(app, user, statements):
+  user_id, token = user
+  with app.test_request_context('/api/products', headers={'Authorization': f'Bearer {token}'}):
+    assert client_key() == f'u{user_id}'
+  assert statements == []
@@ -0,0 +1,31 @@
+# Usuarios: rehash de senha no login e validacao do update
+import pytest
+
+from application import create_app, check_password, hash_password
+from conftest import PASSWORD
+
+@pytest.mark.parametrize('method', ['pbkdf2', 'pbkdf2:sha256'])
+def test_password_hashed_with_current_method_is_not_rehashed(method):
+  # metodo sem os parametros completos: o hash guarda a forma canonica e o login nao refaz o hash
+  app = create_app({'PASSWORD_HASH_METHOD': method})
+  with app.app_context():
+    assert check_password(hash_password('secret'), 'secret') == (True, None)
+
+def test_password_hashed_with_other_cost_is_rehashed(app):
+  with app.app_context():
+    old = hash_password('secret')
+    app.config['PASSWORD_HASH_PREFIX'] = 'pbkdf2:sha256:2000'
+    ok, new_hash = check_password(old, 'secret')
+  assert ok and new_hash is not None
+
+@pytest.mark.parametrize('method', ['md5', 'bogus'])
+def test_create_app_rejects_unknown_password_method(method):
+  with pytest.raises(ValueError):
+    create_app({'PASSWORD_HASH_METHOD': method})
+
+@pytest.mark.parametrize('password', [None, 123, ['secret']])
+def test_update_rejects_password_that_is_not_a_string(session_client, user, password):
+  user_id, _ = user
+  response = session_client.put(f'/api/user/update/{user_id}', json={'password': password})
+  assert response.status_code == 400
+  assert session_client.post('/login', json={'username': 'alice', 'password': PASSWORD}).status_code == 200